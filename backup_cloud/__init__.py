@@ -1,5 +1,7 @@
 import backup_cloud.s3 as s3
+import backup_cloud.restore as restore
 from backup_cloud.base import BackupContext
 
 s3
+restore
 BackupContext
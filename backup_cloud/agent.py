@@ -0,0 +1,198 @@
+import os
+import socketserver
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkdtemp
+from threading import Lock, Thread
+from backup_cloud.agent_client import send_message, recv_request
+from backup_cloud.base import BackupContext, UploadError
+
+# requests handled at the same time; handler threads are reused so that
+# their gpg contexts and S3 resources stay warm.
+AGENT_WORKERS = 8
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server: AgentServer = self.server  # type: ignore
+        server.request_started()
+        fds = []
+        try:
+            try:
+                message, fds = recv_request(self.connection)
+                reply = server.dispatch(message, fds)
+            except UploadError as e:
+                reply = dict(
+                    status="error",
+                    message=str(e),
+                    failures=[name + ": " + repr(error) for name, error in e.failures],
+                )
+            except Exception as e:
+                eprint("backup agent request failed: " + repr(e))
+                reply = dict(status="error", message=repr(e))
+            send_message(self.connection, reply)
+        finally:
+            for fd in fds:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            server.request_finished()
+
+
+class AgentServer(socketserver.UnixStreamServer):
+    """serve encryption and upload requests from a warm BackupContext
+
+    The context, with its SSM configuration, S3 connections and
+    imported keys, is set up once and then each request from a shell
+    script only costs the work itself.  Requests are one JSON line in
+    each direction (see backup_cloud.agent_client).
+
+    The agent stops after idle_timeout seconds without requests.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        backup_context: BackupContext,
+        idle_timeout: float = 3600,
+        workers: int = AGENT_WORKERS,
+    ):
+        super().__init__(socket_path, _AgentHandler)
+        os.chmod(socket_path, 0o600)
+        self.socket_path = socket_path
+        self.backup_context = backup_context
+        self.idle_timeout = idle_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._activity_lock = Lock()
+        self._active = 0
+        self._last_activity = time.monotonic()
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def request_started(self):
+        with self._activity_lock:
+            self._active += 1
+
+    def request_finished(self):
+        with self._activity_lock:
+            self._active -= 1
+            self._last_activity = time.monotonic()
+
+    def idle(self) -> bool:
+        with self._activity_lock:
+            return (
+                self._active == 0
+                and time.monotonic() - self._last_activity > self.idle_timeout
+            )
+
+    def dispatch(self, message, fds=()):
+        """carry out one request
+
+        a src of "-" means the client passed its standard input (and
+        for encrypt its standard output) as fds.
+        """
+        op = message.get("op")
+        bc = self.backup_context
+        if op == "ping":
+            pass
+        elif op == "encrypt" and message["src"] == "-":
+            # closefd=False - the handler closes passed fds itself
+            with open(fds[0], "rb", closefd=False) as source, open(
+                fds[1], "wb", closefd=False
+            ) as sink:
+                bc.encrypt_stream(source, sink)
+        elif op == "encrypt":
+            src = message["src"]
+            if not os.path.isfile(src):
+                raise Exception("file " + src + " is not a plain file we can encrypt")
+            with open(src, "rb") as source, open(src + ".gpg", "wb") as sink:
+                bc.encrypt_stream(source, sink)
+        elif op == "upload" and message["src"] == "-":
+            with open(fds[0], "rb", closefd=False) as source:
+                bc.upload_stream(
+                    source, message["dest"], segmented=message.get("segmented", False)
+                )
+        elif op == "upload":
+            bc.upload_path(
+                message["src"],
+                message["dest"],
+                workers=message["workers"],
+                index_path=message.get("index"),
+                force=message.get("force", False),
+                pack=message.get("pack", False),
+                volume_size=message.get("volume_size"),
+                sharded=message.get("sharded", False),
+                shard_digits=message.get("shard_digits"),
+                adaptive=message.get("adaptive", False),
+                max_workers=message.get("max_workers"),
+            )
+        elif op == "stop":
+            Thread(target=self.shutdown, daemon=True).start()
+        else:
+            raise Exception("unknown backup agent operation: " + repr(op))
+        return dict(status="ok")
+
+    def serve_until_idle(self, poll_interval: float = 1.0):
+        def watchdog():
+            while not self.idle():
+                time.sleep(poll_interval)
+            eprint("backup agent idle for " + str(self.idle_timeout) + "s, stopping")
+            self.shutdown()
+
+        Thread(target=watchdog, daemon=True).start()
+        try:
+            self.serve_forever(poll_interval=poll_interval)
+        finally:
+            self.executor.shutdown(wait=True)
+            self.server_close()
+            os.unlink(self.socket_path)
+
+
+def start_agent(backup_context: BackupContext, idle_timeout: float = 3600) -> str:
+    """start a background agent process for backup_context
+
+    The socket is created in a new private directory and is listening
+    before this returns, so clients can connect straight away.  The
+    agent is forked off into its own session with its output going to
+    agent.log next to the socket.  Returns the socket path.
+    """
+    agent_dir = mkdtemp(prefix="backup-cloud-agent-")
+    socket_path = os.path.join(agent_dir, "agent.sock")
+    server = AgentServer(socket_path, backup_context, idle_timeout=idle_timeout)
+
+    pid = os.fork()
+    if pid > 0:
+        # parent - the child owns the listening socket now
+        server.socket.close()
+        return socket_path
+
+    status = 1
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        log_path = os.path.join(agent_dir, "agent.log")
+        log = os.open(log_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        os.dup2(devnull, 0)
+        os.dup2(devnull, 1)
+        os.dup2(log, 2)
+        server.serve_until_idle()
+        os.unlink(log_path)
+        os.rmdir(agent_dir)
+        status = 0
+    finally:
+        os._exit(status)
@@ -0,0 +1,182 @@
+"""thin client for the backup agent (see backup_cloud.agent)
+
+This file is run directly as a script by the commands which
+BackupContext.setup_commands() generates when an agent is running.  It
+deliberately uses only the standard library and does not import the
+backup_cloud package so that it starts in milliseconds; all the real
+work happens in the agent.
+
+usage:
+
+    agent_client.py SOCKET encrypt FILE
+    agent_client.py SOCKET upload SOURCE_DIR DEST_S3_PATH [OPTIONS]
+    agent_client.py SOCKET ping|stop
+
+Where FILE or SOURCE_DIR is - our standard input (and for encrypt our
+standard output) file descriptors are passed over the socket so the
+agent reads and writes them directly.
+
+upload takes the same options as backup-cloud-upload so that a script
+works the same with or without an agent.  Those in CONTEXT_OPTIONS
+configure the agent's whole context and are refused.
+"""
+
+import argparse
+import array
+import json
+import os
+import socket
+import sys
+
+# most file descriptors which may be passed with a request
+MAX_FDS = 2
+# backup-cloud-upload options which set up the whole backup context, so
+# can't be changed for one request to a running agent: (option, action)
+CONTEXT_OPTIONS = [
+    ("--key-cache-dir", "store"),
+    ("--metrics-textfile", "store"),
+    ("--metrics-json", "store"),
+    ("--small-file-threshold", "store"),
+    ("--envelope", "store_true"),
+    ("--compress", "store"),
+    ("--stats-report", "store"),
+]
+
+
+def send_message(sock, message, fds=()) -> None:
+    data = json.dumps(message).encode("utf-8") + b"\n"
+    if fds:
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+        sent = sock.sendmsg([data], ancdata)
+        data = data[sent:]
+    if data:
+        sock.sendall(data)
+
+
+def recv_request(sock):
+    """read one request line from a socket along with any passed fds"""
+    fd_size = array.array("i").itemsize
+    data = b""
+    fds = []
+    while not data.endswith(b"\n"):
+        chunk, ancdata, _flags, _addr = sock.recvmsg(
+            4096, socket.CMSG_SPACE(MAX_FDS * fd_size)
+        )
+        if not chunk:
+            raise ConnectionError("connection closed before request was complete")
+        data += chunk
+        for level, kind, cdata in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                whole_fds = len(cdata) - len(cdata) % fd_size
+                received = array.array("i")
+                received.frombytes(cdata[:whole_fds])
+                fds.extend(received)
+    return json.loads(data.decode("utf-8")), fds
+
+
+def recv_message(sockfile):
+    line = sockfile.readline()
+    if not line:
+        raise ConnectionError("backup agent closed the connection without replying")
+    return json.loads(line.decode("utf-8"))
+
+
+def request(socket_path: str, message, fds=()):
+    """send one request to the agent and wait for its reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        send_message(sock, message, fds)
+        with sock.makefile("rb") as sockfile:
+            return recv_message(sockfile)
+
+
+def add_upload_arguments(parser) -> None:
+    """the arguments backup-cloud-upload takes after its ssm_path"""
+    parser.add_argument("source_dir")
+    parser.add_argument("dest_s3_path")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--index")
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--segmented", action="store_true")
+    parser.add_argument("--pack", action="store_true")
+    parser.add_argument("--volume-size", type=int)
+    parser.add_argument("--shard", action="store_true")
+    parser.add_argument("--shard-digits", type=int)
+    parser.add_argument("--adaptive", action="store_true")
+    parser.add_argument("--max-workers", type=int)
+    for option, action in CONTEXT_OPTIONS:
+        parser.add_argument(option, action=action, default=None)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Send a request to the backup agent.")
+    parser.add_argument("socket", help="unix socket the agent is listening on")
+    subparsers = parser.add_subparsers(dest="op")
+    encrypt_parser = subparsers.add_parser("encrypt", help="encrypt FILE to FILE.gpg")
+    encrypt_parser.add_argument("file")
+    upload_parser = subparsers.add_parser(
+        "upload", help="encrypt and upload a directory"
+    )
+    add_upload_arguments(upload_parser)
+    subparsers.add_parser("ping", help="check the agent is running")
+    subparsers.add_parser("stop", help="stop the agent")
+
+    args = parser.parse_args(argv)
+    if args.op is None:
+        parser.error("missing operation")
+
+    message = dict(op=args.op)
+    fds = []
+    if args.op == "encrypt":
+        if args.file == "-":
+            message.update(src="-")
+            fds = [sys.stdin.fileno(), sys.stdout.fileno()]
+        else:
+            message.update(src=os.path.abspath(args.file))
+    elif args.op == "upload":
+        for option, _action in CONTEXT_OPTIONS:
+            if getattr(args, option[2:].replace("-", "_")) is not None:
+                upload_parser.error(
+                    option + " is not supported via the backup agent; "
+                    "give it when starting the agent or run without one"
+                )
+        if args.segmented and args.source_dir != "-":
+            upload_parser.error("--segmented is only for standard input")
+        if args.source_dir == "-":
+            message.update(src="-")
+            fds = [sys.stdin.fileno()]
+        else:
+            message.update(src=os.path.abspath(args.source_dir))
+        message.update(
+            dest=args.dest_s3_path,
+            workers=args.workers,
+            index=os.path.abspath(args.index) if args.index else None,
+            force=args.force,
+            segmented=args.segmented,
+            pack=args.pack,
+            volume_size=args.volume_size,
+            sharded=args.shard,
+            shard_digits=args.shard_digits,
+            adaptive=args.adaptive,
+            max_workers=args.max_workers,
+        )
+
+    try:
+        reply = request(args.socket, message, fds)
+    except (OSError, ValueError) as e:
+        print(
+            "failed to talk to backup agent at " + args.socket + ": " + str(e),
+            file=sys.stderr,
+        )
+        return 7
+
+    if reply.get("status") != "ok":
+        print("backup agent: " + reply.get("message", "unknown error"), file=sys.stderr)
+        for failure in reply.get("failures", []):
+            print("failed: " + failure, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,19 +4,185 @@ import boto3  # type: ignore
 import os
 import sys
 import gpg  # type: ignore
+import io
 import re
 from tempfile import TemporaryDirectory, mkdtemp, NamedTemporaryFile
+from boto3.s3.transfer import TransferConfig  # type: ignore
+from botocore.config import Config  # type: ignore
 from botocore.exceptions import ClientError  # type: ignore
-from typing import Dict, List, Generator, Tuple
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Generator,
+    Tuple,
+    Iterable,
+    Iterator,
+    Optional,
+)
+from threading import Thread, local, Lock
+from contextlib import contextmanager, nullcontext
+from functools import partial
+import time
+from backup_cloud.concurrency import DEFAULT_MAX_FACTOR, AdaptiveConcurrency
+from backup_cloud.index import FileIndex, HashingReader, IndexEntry, file_sha256
+from backup_cloud.keycache import KeyCache
+from backup_cloud.metrics import CountingReader, RunMetrics
+from backup_cloud.pipeline_stats import PipelineStats
+
+# parameters under ssm_path which we know about.  Used if we are not
+# allowed to list the whole path.
+SSM_PARAMETERS = ["s3_bucket", "s3_path"]
+# HTTP connections kept open by the S3 client shared between threads
+S3_MAX_POOL_CONNECTIONS = 32
+# public key objects downloaded at the same time
+KEY_FETCH_WORKERS = 8
+# files smaller than this are encrypted in memory and sent with a single
+# PUT; the same as boto3's default multipart threshold.
+SMALL_FILE_THRESHOLD = 8 * 1024 * 1024
+# S3 user metadata describing how each backup object was written
+FORMAT_METADATA = "backup-cloud-format"
+ENCODING_METADATA = "backup-cloud-encoding"
+CODEC_METADATA = "backup-cloud-codec"
+RECIPIENTS_METADATA = "backup-cloud-recipients"
+# version of the object layout the metadata describes
+FORMAT_VERSION = "1"
+# codec of objects which were not compressed
+NO_CODEC = "none"
 
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def _encrypt_worker(backup_context, source_stream, encrypted_stream):
-    backup_context.encrypt(source_stream, sink=encrypted_stream)
+def read_exactly(stream, amount: int, required: bool = False) -> bytes:
+    """read amount bytes, or fewer only at the end of the stream
+
+    If required, a stream ending early is an error instead.
+    """
+    chunks = []
+    count = 0
+    while count < amount:
+        chunk = stream.read(amount - count)
+        if not chunk:
+            if required:
+                raise Exception(
+                    "stream ended after {} of {} bytes".format(count, amount)
+                )
+            break
+        chunks.append(chunk)
+        count += len(chunk)
+    return b"".join(chunks)
+
+
+class PrefixedReader:
+    """a stream which gives back bytes already read before the rest"""
+
+    def __init__(self, prefix: bytes, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, amount=-1):
+        if not self.prefix:
+            return self.stream.read(amount)
+        if amount is None or amount < 0:
+            data = self.prefix + self.stream.read()
+            self.prefix = b""
+            return data
+        data = self.prefix[:amount]
+        self.prefix = self.prefix[amount:]
+        return data
+
+
+class _StreamCallbacks:
+    """adapt a python stream to the gpg.Data callback interface
+
+    gpgme pulls plaintext and pushes ciphertext through these
+    callbacks a small buffer at a time so that we never hold more than
+    one buffer of the stream in Python.  Only sequential access is
+    supported since we are normally working on pipes and S3 bodies.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+
+    def read(self, amount, hook=None):
+        chunk = self.stream.read(amount)
+        self.position += len(chunk)
+        return chunk
+
+    def write(self, data, hook=None):
+        self.stream.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence, hook=None):
+        if offset == 0 and whence == os.SEEK_CUR:
+            return self.position
+        raise io.UnsupportedOperation("backup streams are not seekable")
+
+    def release(self, hook=None):
+        pass
+
+    def cbs(self):
+        return (self.read, self.write, self.seek, self.release)
+
+
+def _gpgme_can_use_fd(stream) -> bool:
+    """true if gpgme can work on the file descriptor of stream directly
+
+    gpgme then reads or writes the descriptor itself rather than
+    calling back into Python for every buffer.  That is only safe when
+    Python holds no buffered data for the stream: unbuffered files,
+    writers once flushed and seekable readers which haven't read ahead.
+    """
+    if not isinstance(stream, (io.FileIO, io.BufferedReader, io.BufferedWriter)):
+        return False
+    try:
+        fd = stream.fileno()
+        if isinstance(stream, io.BufferedWriter):
+            stream.flush()
+        elif isinstance(stream, io.BufferedReader):
+            # fails on pipes, where we can't tell if anything was read ahead
+            return stream.tell() == os.lseek(fd, 0, os.SEEK_CUR)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def _gpg_data(stream):
+    """wrap a stream as a gpg.Data, by file descriptor if we can"""
+    if _gpgme_can_use_fd(stream):
+        return gpg.Data(file=stream)
+    return gpg.Data(cbs=_StreamCallbacks(stream).cbs())
+
+
+def _encrypt_timed(backup_context, source_stream, encrypted_stream):
+    stats = backup_context.pipeline_stats
+    if stats is None:
+        backup_context.encrypt_stream(source_stream, encrypted_stream)
+        return
+    sink = stats.writer(encrypted_stream, "encrypt_pipe_write")
+    with stats.work("encrypt") as work:
+        backup_context.encrypt_stream(source_stream, sink)
+        work.amount = sink.count
+
+
+def _encrypt_worker(backup_context, source_stream, encrypted_stream, errors=None):
+    try:
+        _encrypt_timed(backup_context, source_stream, encrypted_stream)
+    except Exception as e:
+        eprint("encryption failed: " + repr(e))
+        try:
+            encrypted_stream.close()
+        except BrokenPipeError:
+            pass
+        if errors is None:
+            raise e
+        errors.append(e)
+        return
     try:
         encrypted_stream.flush()
     except BrokenPipeError as e:
@@ -25,11 +191,22 @@ def _encrypt_worker(backup_context, source_stream, encrypted_stream):
     encrypted_stream.close()
 
 
-def _encrypt_worker_debug(backup_context, source_stream, encrypted_stream):
-    plaintext = source_stream.read()
-    eprint("read plaintext: " + str(len(plaintext)) + " bytes\n")
-    ciphertext, result, sign_result = backup_context.encrypt(plaintext)
-    encrypted_stream.write(ciphertext)
+def _encrypt_worker_debug(backup_context, source_stream, encrypted_stream, errors=None):
+    try:
+        plaintext = source_stream.read()
+        eprint("read plaintext: " + str(len(plaintext)) + " bytes\n")
+        ciphertext, result, sign_result = backup_context.encrypt(plaintext)
+        encrypted_stream.write(ciphertext)
+    except Exception as e:
+        eprint("encryption failed: " + repr(e))
+        try:
+            encrypted_stream.close()
+        except BrokenPipeError:
+            pass
+        if errors is None:
+            raise e
+        errors.append(e)
+        return
     try:
         encrypted_stream.flush()
     except BrokenPipeError as e:
@@ -38,12 +215,223 @@ def _encrypt_worker_debug(backup_context, source_stream, encrypted_stream):
     encrypted_stream.close()
 
 
+class ProgressLog:
+    """report progress of a transfer at most once every interval seconds
+
+    Thread safe so that several parts of one transfer can report into
+    the same log.
+    """
+
+    def __init__(self, description: str, interval: float = 30.0):
+        self.description = description
+        self.interval = interval
+        self.done = 0
+        self._lock = Lock()
+        self._start = self._last = time.monotonic()
+
+    def add(self, amount: int) -> None:
+        with self._lock:
+            self.done += amount
+            now = time.monotonic()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+        self.report()
+
+    def report(self, final: bool = False) -> None:
+        elapsed = time.monotonic() - self._start
+        rate = self.done / elapsed / 1024 / 1024 if elapsed > 0 else 0.0
+        eprint(
+            self.description
+            + (" finished: " if final else ": ")
+            + str(self.done)
+            + " bytes in "
+            + "{:.1f}s ({:.1f} MB/s)".format(elapsed, rate)
+        )
+
+
+class UploadError(Exception):
+    """one or more files failed to upload
+
+    failures: list of (source file, exception) pairs
+    """
+
+    def __init__(self, failures: List[Tuple[str, Exception]]):
+        self.failures = failures
+        super().__init__(
+            str(len(failures))
+            + " file(s) failed to upload: "
+            + ", ".join([name for name, _e in failures[:10]])
+        )
+
+
+def _clean_s3_path(path: str) -> str:
+    """remove the initial slash and any double slashes from an S3 key"""
+    path = re.sub("/{2,}", "/", path)
+    return re.sub("^/", "", path)
+
+
+def bounded_transfer_config():
+    """boto3 transfer settings for running many uploads at once
+
+    boto3 buffers chunks from unseekable streams in memory so we limit
+    each upload to a couple of chunks in flight.
+    """
+    transfer_config = TransferConfig(max_concurrency=2)
+    transfer_config.max_in_memory_upload_chunks = 2
+    return transfer_config
+
+
+def run_bounded(
+    function,
+    jobs: Iterable,
+    workers: int,
+    name=str,
+    what: str = "process",
+    limit: Optional[AdaptiveConcurrency] = None,
+) -> List[Tuple[str, Exception]]:
+    """call function on each job using a pool of worker threads
+
+    Only a couple of jobs per worker are taken from jobs at any time
+    so that a huge generator of work doesn't build up an unbounded
+    backlog.  Failures don't stop the other jobs; they are returned as
+    (name(job), exception) pairs.
+
+    With limit the pool has limit.maximum threads but only as many jobs
+    as the adaptive limit allows run at once, and jobs failing with
+    errors worth retrying are tried again (see backup_cloud.concurrency).
+    """
+    if limit is not None:
+        workers = limit.maximum
+        function = partial(limit.call, function)
+    failures: List[Tuple[str, Exception]] = []
+    pending: Dict = {}
+
+    def collect(done):
+        for future in done:
+            e = future.exception()
+            if e is not None:
+                eprint("failed to " + what + " " + pending[future] + ": " + repr(e))
+                failures.append((pending[future], e))
+            del pending[future]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for job in jobs:
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending[executor.submit(function, job)] = name(job)
+        done, _ = wait(pending)
+        collect(done)
+
+    return failures
+
+
+def _upload_encrypted_stream(
+    backup_context,
+    source_stream,
+    dest_obj,
+    debug=False,
+    transfer_config=None,
+    metadata: Optional[Dict[str, str]] = None,
+):
+    """encrypt a stream in a separate thread and upload it to an S3 object
+
+    The encryption thread writes into a pipe which boto3 reads from
+    and uploads in multipart chunks so only the pipe buffer and the
+    boto3 part buffers are ever in memory.  If encryption fails the
+    truncated object is deleted and the error is raised here.
+    metadata is stored as the user metadata of the object.
+    """
+    (r_encrypt, w_encrypt) = os.pipe()
+    r_encrypt_file = os.fdopen(r_encrypt, mode="rb")
+    w_encrypt_file = os.fdopen(w_encrypt, mode="wb")
+
+    errors: List[Exception] = []
+    upload_stream = r_encrypt_file
+    if backup_context.pipeline_stats is not None:
+        upload_stream = backup_context.pipeline_stats.reader(
+            r_encrypt_file, "encrypt_pipe_read"
+        )
+    encrypt_thread = Thread(
+        target=_encrypt_worker_debug if debug else _encrypt_worker,
+        args=(backup_context, source_stream, w_encrypt_file, errors),
+        daemon=True,
+    )
+    encrypt_thread.start()
+
+    progress = ProgressLog("uploaded s3://" + dest_obj.bucket_name + "/" + dest_obj.key)
+
+    extra_args: Dict = {}
+    if transfer_config is not None:
+        extra_args["Config"] = transfer_config
+    if metadata:
+        extra_args["ExtraArgs"] = {"Metadata": metadata}
+    try:
+        dest_obj.upload_fileobj(upload_stream, Callback=progress.add, **extra_args)
+    finally:
+        # unblock the encryption thread if the upload stopped reading early
+        r_encrypt_file.close()
+        encrypt_thread.join()
+
+    if errors:
+        eprint("removing incomplete backup object: " + dest_obj.key)
+        dest_obj.delete()
+        raise errors[0]
+    progress.report(final=True)
+
+
+def _put_encrypted(
+    backup_context, source_stream, dest_obj, metadata: Optional[Dict[str, str]] = None
+) -> str:
+    """encrypt a small stream in memory and upload it with one PUT
+
+    This avoids the pipe, thread and multipart upload of
+    _upload_encrypted_stream() which cost far more than the data for
+    small files.  Returns the ETag of the new object.
+    """
+    ciphertext = io.BytesIO()
+    stats = backup_context.pipeline_stats
+    if stats is None:
+        backup_context.encrypt_stream(source_stream, ciphertext)
+    else:
+        with stats.work("encrypt") as work:
+            backup_context.encrypt_stream(source_stream, ciphertext)
+            work.amount = ciphertext.tell()
+    body = ciphertext.getvalue()
+    extra_args = {}
+    if metadata:
+        extra_args["Metadata"] = metadata
+    response = dest_obj.put(Body=body, ContentLength=len(body), **extra_args)
+    return response["ETag"]
+
+
 class BackupContext:
     """provide a context which will allow us to easily run backups and encrypt them
     ssm_path: path in SSM to find configuration parameters
     recipients: specific list of gpg recipients to encrypted to.
     bindir: directory in create scripts used for encryption etc.
     no_clean: don't delete GPG data directory when garbage collected (useful for scripts)
+    config_ttl: seconds after which configuration is re-read from SSM;
+      by default it is read once for the life of the context.
+    key_cache_dir: directory for keeping downloaded public keys between
+      runs (see backup_cloud.keycache); by default keys are always downloaded.
+    gnupg_home: gpg home directory holding the secret keys used by the
+      restore_*() methods; by default the user's normal keyring.
+    small_file_threshold: files smaller than this many bytes are
+      encrypted in memory and uploaded with a single PUT.
+    envelope: encrypt streams with a data key made once for the context
+      instead of to each recipient (see backup_cloud.envelope).
+    compression: name of a codec ("zstd" or "gzip") used to compress
+      backups before they are encrypted (see backup_cloud.compress);
+      by default nothing is compressed.
+    armor: write ASCII armored OpenPGP as older versions did; the
+      default binary output is about a quarter smaller.  Restores
+      accept either.
+    instrument: time every stage of streamed backups into
+      pipeline_stats (see backup_cloud.pipeline_stats).
+    metrics: a backup_cloud.metrics.RunMetrics to count the objects,
+      bytes and AWS calls of the run into.
     """
 
     def __init__(
@@ -52,6 +440,15 @@ class BackupContext:
         recipients: List[str] = None,
         bindir: str = None,
         clean: bool = True,
+        config_ttl: Optional[float] = None,
+        key_cache_dir: Optional[str] = None,
+        gnupg_home: Optional[str] = None,
+        small_file_threshold: int = SMALL_FILE_THRESHOLD,
+        envelope: bool = False,
+        compression: Optional[str] = None,
+        armor: bool = False,
+        instrument: bool = False,
+        metrics: Optional[RunMetrics] = None,
     ):
         if bindir is None:
             bindir = os.getcwd() + "/bin"
@@ -60,6 +457,39 @@ class BackupContext:
         self.bindir = bindir
         self.ssm_path = ssm_path
         self.ssm = boto3.client("ssm")
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.watch_client(self.ssm)
+        self.config_ttl = config_ttl
+        self.key_cache_dir = key_cache_dir
+        self.gnupg_home = gnupg_home
+        self.small_file_threshold = small_file_threshold
+        self.envelope = envelope
+        self._envelope_key = None
+        self._envelope_data_keys: Dict[str, bytes] = {}
+        self._envelope_lock = Lock()
+        if compression is not None:
+            from backup_cloud.compress import get_codec
+
+            # fail now rather than at the first backup if zstandard is missing
+            get_codec(compression)
+        self.compression = compression
+        self.armor = armor
+        self._config: Optional[Dict[str, str]] = None
+        self._config_time = 0.0
+        self._config_lock = Lock()
+        # clients are thread safe so one pool of connections is shared
+        self.s3 = boto3.client(
+            "s3", config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+        )
+        self.pipeline_stats: Optional[PipelineStats] = None
+        if instrument:
+            self.pipeline_stats = PipelineStats()
+        # adaptive concurrency limits told about throttling (see adapting())
+        self._concurrency_limits: List[AdaptiveConcurrency] = []
+        self._watch_s3_client(self.s3)
+        # gpg contexts and boto3 resources must not be shared between threads
+        self._local = local()
 
         # recipients are specific recipents we are told to encrypt only to
         self.recipients = recipients
@@ -67,7 +497,7 @@ class BackupContext:
         # in our bucket - gathered here.
         self.all_recipients: List[str] = []
 
-        c = gpg.Context(armor=True)
+        c = gpg.Context(armor=self.armor)
         if clean:
             self._gpgdir = TemporaryDirectory()
             self.dirname = self._gpgdir.name
@@ -76,6 +506,7 @@ class BackupContext:
         c.home_dir = self.dirname
         self.get_gpg_keys(c)
         self.gpg_context = c
+        self._local.gpg_context = c
 
     def get_recipients(self):
         """return the recipients we should encrypt to
@@ -89,40 +520,125 @@ class BackupContext:
         else:
             return self.recipients
 
-    def s3_path(self) -> str:
-        """return the base path in S3 where we should work - read from SSM
+    def _read_ssm_parameters(self) -> Dict[str, str]:
+        """read all our configuration from SSM in as few calls as possible
+
+        normally this is one GetParametersByPath call (more if there
+        are many parameters).  If we aren't allowed to list the path we
+        fall back to fetching the parameters we know about with one
+        GetParameters call.
         """
-        ssm_path: str = self.ssm_path
-        ssm_paramdef = dict(Name=ssm_path + "/s3_path")
+        prefix = self.ssm_path.rstrip("/") + "/"
+        config: Dict[str, str] = {}
         try:
-            s3_path = self.ssm.get_parameter(**ssm_paramdef)["Parameter"]["Value"]
-            if s3_path.startswith("/"):
-                s3_path = s3_path[1:]
+            paginator = self.ssm.get_paginator("get_parameters_by_path")
+            for page in paginator.paginate(Path=prefix.rstrip("/")):
+                for par in page["Parameters"]:
+                    config[par["Name"].rpartition("/")[2]] = par["Value"]
         except ClientError as e:
-            eprint("Failed to get parameter: " + ssm_paramdef["Name"])
-            raise e
+            eprint("Failed to list parameters under: " + prefix + ": " + repr(e))
+            names = [prefix + x for x in SSM_PARAMETERS]
+            try:
+                response = self.ssm.get_parameters(Names=names)
+            except ClientError as e:
+                eprint("Failed to get parameters: " + ", ".join(names))
+                raise e
+            for par in response["Parameters"]:
+                config[par["Name"].rpartition("/")[2]] = par["Value"]
+        return config
+
+    def ssm_parameter(self, name: str) -> str:
+        """return a configuration parameter from under our ssm_path
+
+        All parameters are read together on first use and kept until
+        config_ttl expires so repeated calls don't go back to SSM.
+        """
+        with self._config_lock:
+            expired = (
+                self.config_ttl is not None
+                and time.monotonic() - self._config_time > self.config_ttl
+            )
+            if self._config is None or expired:
+                self._config = self._read_ssm_parameters()
+                self._config_time = time.monotonic()
+            config = self._config
+        try:
+            return config[name]
+        except KeyError:
+            full_name = self.ssm_path.rstrip("/") + "/" + name
+            eprint("Failed to get parameter: " + full_name)
+            raise ClientError(
+                {
+                    "Error": {
+                        "Code": "ParameterNotFound",
+                        "Message": "parameter " + full_name + " not found",
+                    }
+                },
+                "GetParameter",
+            )
+
+    def s3_path(self) -> str:
+        """return the base path in S3 where we should work - read from SSM
+        """
+        s3_path = self.ssm_parameter("s3_path")
+        if s3_path.startswith("/"):
+            s3_path = s3_path[1:]
         return s3_path
 
+    def s3_resource(self):
+        """return an S3 resource for the current thread
+
+        boto3 resources are not thread safe so each thread gets its
+        own, created once from a private session.
+        """
+        s3 = getattr(self._local, "s3_resource", None)
+        if s3 is None:
+            s3 = self._local.s3_resource = boto3.session.Session().resource(
+                "s3", config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+            )
+            self._watch_s3_client(s3.meta.client)
+        return s3
+
+    def _watch_s3_client(self, client) -> None:
+        """hook our stats, metrics and concurrency limits into an S3 client"""
+        if self.pipeline_stats is not None:
+            self.pipeline_stats.watch_client(client)
+        if self.metrics is not None:
+            self.metrics.watch_client(client)
+        client.meta.events.register(
+            "needs-retry.s3",
+            self._notice_response,
+            unique_id="backup-cloud-limits-%d" % id(self),
+        )
+
+    def _notice_response(self, **kwargs) -> None:
+        for limit in list(self._concurrency_limits):
+            limit.notice_response(**kwargs)
+
+    @contextmanager
+    def adapting(self, *limits: AdaptiveConcurrency) -> Iterator[None]:
+        """tell limits about throttling responses to our S3 calls in the block
+
+        so that they back off at the first SlowDown rather than when
+        botocore's retries have been used up.
+        """
+        self._concurrency_limits.extend(limits)
+        try:
+            yield
+        finally:
+            for limit in limits:
+                self._concurrency_limits.remove(limit)
+
     # here we can't easily and safely do type annotations due to
     # Boto3's dynamic code.  Potentially see the
     # boto3-type-annotations module however.
     def s3_bucket(self):
-        ssm_path = self.ssm_path
-        ssm_paramdef: Dict[str, str] = dict(Name=ssm_path + "/s3_bucket")
-        try:
-            s3_bucket_name = self.ssm.get_parameter(**ssm_paramdef)["Parameter"][
-                "Value"
-            ]
-        except (ClientError) as e:
-            eprint("Failed to get parameter: " + ssm_paramdef["Name"])
-            raise e
-        s3 = boto3.resource("s3")
-        return s3.Bucket(s3_bucket_name)
+        return self.s3_resource().Bucket(self.ssm_parameter("s3_bucket"))
 
     def s3_target_url(self) -> str:
         s3path = self.s3_path()
         if s3path.endswith("/") or not s3path:
-            full_path = self.s3_path() + "backup"
+            full_path = s3path + "backup"
         else:
             full_path = s3path + "/backup"
         return full_path
@@ -135,26 +651,86 @@ class BackupContext:
             full_path = s3path + "/config/public-keys/"
         return full_path
 
+    def _fetch_gpg_key(self, bucket_name: str, key: str, cache) -> Optional[bytes]:
+        """get one key object, only downloading it if it has changed
+
+        when we have a cached copy we send its ETag so S3 can answer
+        with 304 Not Modified rather than the key.  The ETag is only
+        sent if the cached key itself can be read.
+        """
+        options = dict(Bucket=bucket_name, Key=key)
+        cached_etag = cache.etag(key) if cache is not None else None
+        cached_key = None
+        if cached_etag is not None:
+            cached_key = cache.read(key)
+            if cached_key is not None:
+                options["IfNoneMatch"] = cached_etag
+        try:
+            response = self.s3.get_object(**options)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if cached_key is not None and code in ("304", "NotModified"):
+                return cached_key
+            eprint(
+                "Failed to get public key: s3://"
+                + bucket_name
+                + "/"
+                + key
+                + "\nIgnoring file and continuing.\n"
+            )
+            return None
+        gpg_key = response["Body"].read()
+        if cache is not None:
+            cache.store(key, response["ETag"], str(response["LastModified"]), gpg_key)
+        return gpg_key
+
     def download_gpg_keys(self) -> Generator[bytes, None, None]:
+        """get all the public keys from the config/public-keys folder
+
+        with a key_cache_dir, keys whose ETag and LastModified in the
+        listing match the cache are not downloaded at all and the rest
+        are fetched in parallel.
+        """
         bucket = self.s3_bucket()
 
-        if self.s3_path().endswith("/") or not self.s3_path():
-            folder_path = self.s3_path() + "config/public-keys/"
+        s3path = self.s3_path()
+        if s3path.endswith("/") or not s3path:
+            folder_path = s3path + "config/public-keys/"
         else:
-            folder_path = self.s3_path() + "/config/public-keys/"
-        for obj in bucket.objects.filter(Prefix=folder_path):
-            if obj.key == folder_path:
-                continue
-            try:
-                gpg_key = obj.get()["Body"].read()
-            except ClientError:
-                eprint(
-                    "Failed to get public key: s3://"
-                    + obj.bucket_name
-                    + "/"
-                    + obj.key
-                    + "\nIgnoring file and continuing.\n"
+            folder_path = s3path + "/config/public-keys/"
+        key_objects = [
+            obj
+            for obj in bucket.objects.filter(Prefix=folder_path)
+            if obj.key != folder_path
+        ]
+
+        cache = None
+        if self.key_cache_dir:
+            cache = KeyCache(self.key_cache_dir, bucket.name, folder_path)
+
+        keys: Dict[str, Optional[bytes]] = {}
+        to_fetch = []
+        for obj in key_objects:
+            if cache is not None:
+                keys[obj.key] = cache.lookup(obj.key, obj.e_tag, str(obj.last_modified))
+            if keys.get(obj.key) is None:
+                to_fetch.append(obj)
+
+        if to_fetch:
+            with ThreadPoolExecutor(max_workers=KEY_FETCH_WORKERS) as executor:
+                fetched = executor.map(
+                    lambda obj: self._fetch_gpg_key(obj.bucket_name, obj.key, cache),
+                    to_fetch,
                 )
+                for obj, gpg_key in zip(to_fetch, fetched):
+                    keys[obj.key] = gpg_key
+
+        if cache is not None:
+            cache.save(set(keys))
+
+        for obj in key_objects:
+            gpg_key = keys[obj.key]
+            if gpg_key is None:
                 continue
 
             if len(gpg_key) < 64:
@@ -195,23 +771,189 @@ class BackupContext:
                 "No recipients found in keys - need to have at least one public key configured"
             )
 
+    def _thread_gpg_context(self):
+        """return a gpg context for the current thread
+
+        all the contexts share our keyring directory but gpgme contexts
+        cannot safely be used from more than one thread at a time.
+        """
+        c = getattr(self._local, "gpg_context", None)
+        if c is None:
+            c = gpg.Context(armor=self.armor)
+            c.home_dir = self.dirname
+            self._local.gpg_context = c
+        return c
+
+    def _thread_decrypt_context(self):
+        """return a gpg context with our secret keys for the current thread
+
+        our own keyring only holds public keys so decryption uses the
+        gnupg_home keyring instead.
+        """
+        c = getattr(self._local, "decrypt_context", None)
+        if c is None:
+            c = gpg.Context()
+            if self.gnupg_home is not None:
+                c.home_dir = self.gnupg_home
+            self._local.decrypt_context = c
+        return c
+
     def encrypt(self, plaintext, *args, **kwargs):
-        """TODO: encrypt_stream - encrypt a stream into another stream
+        """encrypt data to our recipients
 
-        Given a stream of plaintext data return a stream of encrypted
-        data.  This looks very much like gpg.Context.encrypt except it
+        This looks very much like gpg.Context.encrypt except it
         provides defaults for recipients, sets always_trust True so
         our imported keys work and sign False since we don't have a
-        key to sign from (yet?).
+        key to sign from (yet?).  For large data use encrypt_stream().
         """
 
-        c = self.gpg_context
+        c = self._thread_gpg_context()
         recipient_keys = [c.get_key(k) for k in self.get_recipients()]
         options = dict(recipients=recipient_keys, sign=False, always_trust=True)
         options.update(kwargs)
 
         return c.encrypt(plaintext, *args, **options)
 
+    def decrypt(self, ciphertext, *args, **kwargs):
+        """decrypt data with the secret keys from gnupg_home
+
+        like gpg.Context.decrypt except that signatures are not
+        required since we don't sign backups.
+        """
+        options = dict(verify=False)
+        options.update(kwargs)
+        return self._thread_decrypt_context().decrypt(ciphertext, *args, **options)
+
+    def envelope_key(self):
+        """return the data key for this context, creating it on first use
+
+        the key is wrapped to all our recipients and uploaded before
+        anything is encrypted with it.
+        """
+        from backup_cloud.envelope import EnvelopeKey, store_envelope_key
+
+        with self._envelope_lock:
+            if self._envelope_key is None:
+                key = EnvelopeKey.generate()
+                store_envelope_key(self, key)
+                self._envelope_key = key
+            return self._envelope_key
+
+    def _envelope_data_key(self, key_id: str) -> bytes:
+        """unwrap a data key for restore, once per key"""
+        from backup_cloud.envelope import fetch_envelope_key
+
+        with self._envelope_lock:
+            if key_id not in self._envelope_data_keys:
+                self._envelope_data_keys[key_id] = fetch_envelope_key(self, key_id)
+            return self._envelope_data_keys[key_id]
+
+    def encrypt_stream(self, source_stream, sink_stream, **kwargs):
+        """encrypt a stream into another stream
+
+        source_stream: anything with a read(amount) method - a file, a
+        pipe or an S3 StreamingBody.
+        sink_stream: anything with a write() method.
+
+        Data is passed through gpgme in small buffers so memory use
+        stays constant whatever the size of the stream.  Real files and
+        pipes are handed to gpgme as file descriptors so the data
+        doesn't pass through Python at all.  With envelope set the
+        stream is encrypted under our data key instead.  Streams from
+        prepare_stream() which are already compressed, or which looked
+        incompressible, are not compressed again by gpg.
+        """
+        if self.envelope:
+            from backup_cloud.envelope import envelope_encrypt_stream
+
+            return envelope_encrypt_stream(
+                self.envelope_key(), source_stream, sink_stream
+            )
+        if not getattr(source_stream, "gpg_compress", True):
+            kwargs.setdefault("compress", False)
+        plaintext = _gpg_data(source_stream)
+        ciphertext = _gpg_data(sink_stream)
+        return self.encrypt(plaintext, sink=ciphertext, **kwargs)
+
+    def format_metadata(self, encoding: Optional[str] = None) -> Dict[str, str]:
+        """S3 user metadata recording how we encrypt backup objects
+
+        the recipients are given as the long key ids of their keys.
+        encoding overrides the encoding our settings would give, for
+        objects which are always encrypted one way.
+        """
+        if encoding is None:
+            if self.envelope:
+                encoding = "envelope"
+            elif self.armor:
+                encoding = "openpgp-armor"
+            else:
+                encoding = "openpgp"
+        c = self._thread_gpg_context()
+        key_ids = [c.get_key(r).fpr[-16:] for r in self.get_recipients()]
+        return {
+            FORMAT_METADATA: FORMAT_VERSION,
+            ENCODING_METADATA: encoding,
+            CODEC_METADATA: NO_CODEC,
+            RECIPIENTS_METADATA: " ".join(key_ids),
+        }
+
+    def prepare_stream(self, source_stream) -> Tuple[object, Dict[str, str]]:
+        """compress source_stream if we compress and it looks worthwhile
+
+        returns the stream to encrypt and the S3 user metadata for the
+        object, from format_metadata() plus the codec restores should
+        decompress it with.
+        """
+        metadata = self.format_metadata()
+        if self.compression is None:
+            return source_stream, metadata
+        from backup_cloud.compress import compression_stage
+
+        source_stream, codec = compression_stage(source_stream, self.compression)
+        # either way there is nothing left for gpg's own compression to do
+        source_stream.gpg_compress = False
+        if codec is not None:
+            metadata[CODEC_METADATA] = codec
+        return source_stream, metadata
+
+    def encrypt_segments(
+        self, source_stream, segment_size: Optional[int] = None, processes=None
+    ):
+        """encrypt a stream as independent segments on all cores
+
+        an opt-in alternative to encrypt_stream() for very large data
+        where one gpg stream is too slow.  Yields each segment as a
+        separate OpenPGP message, in order; see
+        backup_cloud.segment.encrypt_segments().
+        """
+        from backup_cloud.segment import DEFAULT_SEGMENT_SIZE, encrypt_segments
+
+        return encrypt_segments(
+            self, source_stream, segment_size or DEFAULT_SEGMENT_SIZE, processes
+        )
+
+    def decrypt_stream(self, source_stream, sink_stream):
+        """decrypt a stream into another stream
+
+        the reverse of encrypt_stream(), using the secret keys from
+        gnupg_home.  Data is passed through gpgme in small buffers and
+        gpgme accepts both binary and ASCII armored OpenPGP, so backups
+        made before binary output became the default still restore.
+        Enveloped streams are recognised and their data key is only
+        unwrapped the first time it is seen.
+        """
+        from backup_cloud.envelope import ENVELOPE_MAGIC, envelope_decrypt_stream
+
+        magic = read_exactly(source_stream, len(ENVELOPE_MAGIC))
+        if magic == ENVELOPE_MAGIC:
+            return envelope_decrypt_stream(
+                self._envelope_data_key, source_stream, sink_stream
+            )
+        source_stream = PrefixedReader(magic, source_stream)
+        ciphertext = gpg.Data(cbs=_StreamCallbacks(source_stream).cbs())
+        return self.decrypt(ciphertext, sink=_gpg_data(sink_stream))
+
     def create_script(self, script: str) -> str:
         script_file = NamedTemporaryFile(delete=False)
         script_file.write(script.encode("utf-8"))
@@ -219,12 +961,17 @@ class BackupContext:
         subprocess.call(["chmod", "a+x", script_file.name])
         return script_file.name
 
-    def setup_commands(self) -> Tuple[str, str]:
+    def setup_commands(self, agent_socket: Optional[str] = None) -> Tuple[str, str]:
         """prepare a command that can be used in scripts for encrypting data
 
         this will be done for you automatically if you use the
         backup_context.run() - we create a command backup_encrypt
         which will run the encryption for you.
+
+        agent_socket: socket of a running backup agent (see
+        backup_cloud.agent).  If given the commands hand their work to
+        the agent instead of starting gpg or a new python process
+        which builds its own context.
         """
 
         recipients = self.get_recipients()
@@ -238,9 +985,34 @@ class BackupContext:
             '--recipient "' + '" --recipient "'.join([str(x) for x in recipients]) + '"'
         )
 
+        if agent_socket is None:
+            gpg_command = (
+                'gpg --batch --homedir "{HOMEDIR}" {RCPTS} --encrypt '
+                "--trust-model always"
+            ).format(HOMEDIR=self.dirname, RCPTS=rcpt_clause)
+            # gpg encrypts stdin to stdout when given no file
+            encrypt_stdin_command = "exec " + gpg_command
+            encrypt_command = gpg_command + " $1"
+            upload_command = 'backup-cloud-upload {SSM_PATH} "$@"'.format(
+                SSM_PATH=self.ssm_path
+            )
+        else:
+            client = '"{PYTHON}" "{CLIENT}" "{SOCKET}"'.format(
+                PYTHON=sys.executable,
+                CLIENT=os.path.join(os.path.dirname(__file__), "agent_client.py"),
+                SOCKET=agent_socket,
+            )
+            encrypt_command = "exec " + client + ' encrypt "$1"'
+            encrypt_stdin_command = encrypt_command
+            upload_command = "exec " + client + ' upload "$@"'
+
         encrypt_script = """\
 #!/bin/sh
 set -evx
+if [[ "$1" == "-" ]]
+then
+        {ENCRYPT_STDIN}
+fi
 if [[ ! -e $1 ]]
 then
         echo "file $1 doesn't exist to encrypt - aborting" >&2
@@ -252,16 +1024,14 @@ then
         exit 6
 fi
 rm -f $1.gpg
-gpg --batch --homedir "{HOMEDIR}" {RCPTS} --encrypt --trust-model always $1
-""".format(
-            HOMEDIR=self.dirname, RCPTS=rcpt_clause
-        )
+{ENCRYPT}
+""".format(ENCRYPT=encrypt_command, ENCRYPT_STDIN=encrypt_stdin_command)
 
         self.encrypt_script_path = self.create_script(encrypt_script)
         upload_script = """\
 #!/bin/sh
 set -evx
-if [[ ! -e "$1" ]]
+if [[ "$1" != "-" && ! -e "$1" ]]
 then
         echo "file $1 doesn't exist to upload - aborting" >&2
         exit 6
@@ -271,10 +1041,8 @@ then
         echo "missing argument - backup-cloud-upload requires source_directory and dest_s3_path"
         exit 6
 fi
-backup-cloud-upload {SSM_PATH} $1 $2
-""".format(
-            SSM_PATH=self.ssm_path
-        )
+{UPLOAD}
+""".format(UPLOAD=upload_command)
 
         self.upload_script_path = self.create_script(upload_script)
 
@@ -328,7 +1096,20 @@ backup-cloud-upload {SSM_PATH} $1 $2
             cp.check_returncode()
         return cp
 
-    def upload_path(self, src_directory, dest_s3_path):
+    def upload_path(
+        self,
+        src_directory,
+        dest_s3_path,
+        workers: int = 1,
+        index_path: Optional[str] = None,
+        force: bool = False,
+        pack: bool = False,
+        volume_size: Optional[int] = None,
+        adaptive: bool = False,
+        max_workers: Optional[int] = None,
+        sharded: bool = False,
+        shard_digits: Optional[int] = None,
+    ):
         """upload a directory to s3 encrypting the individual file(s)
         as we go.
 
@@ -349,36 +1130,468 @@ backup-cloud-upload {SSM_PATH} $1 $2
         will not end up leaing your customer's personal information,
         which solves a major commercial problem.
 
+        workers: number of files to encrypt and upload at the same
+        time.  With more than one worker a failing file does not stop
+        the others; all failures are reported together in an
+        UploadError at the end.  Each worker holds at most a few
+        multipart chunks in memory.
+
+        index_path: SQLite file recording what has already been
+        uploaded (see backup_cloud.index.FileIndex).  Files whose size
+        and modification time match the index are skipped without
+        being read; files which were only touched are hashed and
+        skipped if their content is unchanged.  force uploads
+        everything anyway while still updating the index.
+
+        pack: gather the files into a few encrypted volumes of about
+        volume_size bytes with an encrypted index instead of writing an
+        object per file, which is far quicker for many small files and
+        keeps their names out of S3 (see backup_cloud.pack.pack_path()).
+        workers and index_path do not apply to packed uploads.
+
+        adaptive starts with workers files at once and then adjusts
+        that between one and max_workers (by default four times
+        workers): fewer when S3 throttles us and more while it keeps up
+        (see backup_cloud.concurrency).  Files which fail with
+        throttling or other temporary errors are tried again.
+
+        sharded spreads the files over 16 ** shard_digits (by default
+        256) hashed sub-prefixes so that very high request rates aren't
+        throttled by S3's limit per prefix.  Uploads to a prefix which
+        is already sharded keep its shard_digits.  Where each file went is
+        added to the upload's manifest, which is written at the end
+        even if some files fail, so restore_path() and list_path() still
+        work by the files' paths (see backup_cloud.shard).
+
         """
         if not os.path.isdir(src_directory):
             raise Exception("upload_path() can only handle directories right now!")
 
+        if pack:
+            from backup_cloud.pack import DEFAULT_VOLUME_SIZE, pack_path
+
+            if index_path is not None:
+                raise Exception("packed uploads cannot use an index")
+            if sharded:
+                raise Exception("packed uploads cannot be sharded")
+            pack_path(
+                self,
+                src_directory,
+                self.s3_path() + "/backup/" + dest_s3_path,
+                volume_size=volume_size or DEFAULT_VOLUME_SIZE,
+            )
+            return
+
+        jobs: Iterable[Tuple[str, str]]
+        jobs = self._upload_path_jobs(src_directory, dest_s3_path)
+        done: Optional[Callable[[str], None]] = None
+        if sharded:
+            from backup_cloud.shard import (
+                open_shard_manifest,
+                shard_jobs,
+                write_shard_manifest,
+            )
+
+            prefix = self.backup_key(dest_s3_path).rstrip("/")
+            shards = open_shard_manifest(
+                self, self.ssm_parameter("s3_bucket"), prefix, shard_digits
+            )
+            jobs = shard_jobs(jobs, prefix, shards)
+            done = shards.finished
+        index = FileIndex(index_path) if index_path else None
+        try:
+            if adaptive:
+                limit = AdaptiveConcurrency(
+                    "upload", workers, max_workers or workers * DEFAULT_MAX_FACTOR
+                )
+                with self.adapting(limit):
+                    self._upload_files_concurrently(
+                        jobs, workers, index, force, limit, done
+                    )
+            elif workers > 1:
+                self._upload_files_concurrently(jobs, workers, index, force, done=done)
+            else:
+                bucket = self.s3_bucket()
+                for src_name, dest_name in jobs:
+                    self._upload_file_if_changed(
+                        src_name, bucket, dest_name, index, force
+                    )
+                    if done is not None:
+                        done(dest_name)
+        finally:
+            if index is not None:
+                index.close()
+            # even after failures, so the files which made it can be found
+            if sharded:
+                write_shard_manifest(
+                    self, self.ssm_parameter("s3_bucket"), prefix, shards
+                )
+
+    def _upload_file_if_changed(
+        self,
+        src_name: str,
+        bucket,
+        dest_name: str,
+        index: Optional[FileIndex],
+        force: bool,
+        transfer_config=None,
+    ) -> bool:
+        """upload a file unless the index shows it is already backed up
+
+        returns True if the file was uploaded.
+        """
+        if index is None:
+            self.backup_file_to_s3(
+                src_name, bucket, dest_name, transfer_config=transfer_config
+            )
+            return True
+
+        dest_key = _clean_s3_path(dest_name)
+        st = os.stat(src_name)
+        entry = index.lookup(dest_key)
+        if not force and entry is not None and entry.path == src_name:
+            if entry.size == st.st_size and entry.mtime_ns == st.st_mtime_ns:
+                self._count_skipped()
+                return False
+            if entry.size == st.st_size and file_sha256(src_name) == entry.sha256:
+                index.record(entry._replace(mtime_ns=st.st_mtime_ns))
+                self._count_skipped()
+                return False
+
+        with open(src_name, "rb") as f:
+            reader = HashingReader(f)
+            etag = self.backup_stream_to_s3(
+                reader,
+                bucket,
+                dest_key,
+                transfer_config=transfer_config,
+                name=src_name,
+                size=st.st_size,
+            )
+        if etag is None:
+            etag = bucket.Object(dest_key).e_tag
+        index.record(
+            IndexEntry(
+                dest_key,
+                src_name,
+                st.st_size,
+                st.st_mtime_ns,
+                reader.hexdigest(),
+                etag,
+            )
+        )
+        return True
+
+    def _count_skipped(self) -> None:
+        if self.metrics is not None:
+            self.metrics.count("backup_cloud_objects_total", result="skipped")
+
+    def _upload_path_jobs(
+        self, src_directory: str, dest_s3_path: str
+    ) -> Generator[Tuple[str, str], None, None]:
         basepath, target_dirname = os.path.split(src_directory)
+        s3_path = self.s3_path()
 
         for subdir, _dirs, files in os.walk(src_directory):
+            rel = os.path.relpath(subdir, basepath)
             for file in files:
                 src_name = os.path.join(subdir, file)
-                rel = os.path.relpath(subdir, basepath)
-                dest_name = (
-                    self.s3_path() + "/backup/" + dest_s3_path + "/" + rel + "/" + file
-                )
+                dest_name = s3_path + "/backup/" + dest_s3_path + "/" + rel + "/" + file
+                yield src_name, dest_name
+
+    def _upload_files_concurrently(
+        self,
+        jobs: Iterable[Tuple[str, str]],
+        workers: int,
+        index: Optional[FileIndex] = None,
+        force: bool = False,
+        limit: Optional[AdaptiveConcurrency] = None,
+        done: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        """upload the files in jobs using a pool of worker threads
+
+        done, if given, is called with the destination of each file
+        once it is uploaded or found unchanged.
+        """
+        transfer_config = bounded_transfer_config()
+
+        def upload_one(job):
+            src_name, dest_name = job
+            self._upload_file_if_changed(
+                src_name,
+                self.s3_bucket(),
+                dest_name,
+                index,
+                force,
+                transfer_config=transfer_config,
+            )
+            if done is not None:
+                done(dest_name)
+
+        failures = run_bounded(
+            upload_one,
+            jobs,
+            workers,
+            name=lambda job: job[0],
+            what="upload",
+            limit=limit,
+        )
+        if failures:
+            raise UploadError(failures)
+
+    def upload_stream(
+        self, source_stream, dest_s3_path: str, segmented: bool = False
+    ) -> None:
+        """encrypt a stream and upload it under our backup location
+
+        This is for data which never exists as a file, e.g. the
+        output of pg_dump piped into us.  The object is written to
+        <s3_path>/backup/<dest_s3_path>.  segmented encrypts it in
+        parallel segments (see backup_stream_to_s3()).
+        """
+        dest_name = self.s3_path() + "/backup/" + dest_s3_path
+        self.backup_stream_to_s3(
+            source_stream, self.s3_bucket(), dest_name, segmented=segmented
+        )
+
+    def backup_key(self, backup_path: str) -> str:
+        """return the S3 key for backup_path under our backup location"""
+        return _clean_s3_path(self.s3_target_url() + "/" + backup_path)
+
+    def _restore_options(self, bucket: str, key: str, kwargs: Dict) -> Dict:
+        """add segmented=True to kwargs if key is a segmented backup"""
+        from backup_cloud.segment import is_segmented
+
+        if "segmented" not in kwargs and is_segmented(self, bucket, key):
+            return dict(kwargs, segmented=True)
+        return kwargs
+
+    def restore_stream(self, backup_path: str, sink_stream, **kwargs) -> None:
+        """decrypt the backup object at backup_path into a stream
+
+        backup_path is relative to our backup location, as given to
+        upload_stream().  The object is downloaded with parallel
+        ranged GETs and streamed through decryption so memory use does
+        not depend on its size; keyword arguments tune the download
+        (see backup_cloud.restore.restore_object_to_stream()).
+        """
+        from backup_cloud.restore import restore_object_to_stream
+
+        bucket = self.ssm_parameter("s3_bucket")
+        key = self.backup_key(backup_path)
+        restore_object_to_stream(
+            self, bucket, key, sink_stream, **self._restore_options(bucket, key, kwargs)
+        )
+
+    def restore_file(self, backup_path: str, dest_file: str, **kwargs) -> None:
+        """decrypt the backup object at backup_path into a local file"""
+        from backup_cloud.restore import restore_object_to_file
 
-                self.backup_file_to_s3(src_name, self.s3_bucket(), dest_name)
+        bucket = self.ssm_parameter("s3_bucket")
+        key = self.backup_key(backup_path)
+        restore_object_to_file(
+            self, bucket, key, dest_file, **self._restore_options(bucket, key, kwargs)
+        )
 
-    def backup_file_to_s3(self, src_file: str, dest_bucket, dest_path: str):
+    def restore_to_s3(
+        self, backup_path: str, dest_bucket: str, dest_key: str, **kwargs
+    ) -> None:
+        """decrypt the backup object at backup_path into another S3 object"""
+        from backup_cloud.restore import restore_object_to_s3
+
+        bucket = self.ssm_parameter("s3_bucket")
+        key = self.backup_key(backup_path)
+        restore_object_to_s3(
+            self,
+            bucket,
+            key,
+            dest_bucket,
+            dest_key,
+            **self._restore_options(bucket, key, kwargs)
+        )
+
+    def restore_path(
+        self, backup_path: str, dest_directory: str, workers: int = 1, **kwargs
+    ) -> None:
+        """restore a directory tree written by upload_path()
+
+        upload_path(src, backup_path) stores src/x/y as
+        backup_path/<basename of src>/x/y; restoring backup_path into
+        dest_directory recreates dest_directory/<basename of src>/x/y.
+        Objects are restored largest first by workers threads and an
+        interrupted restore picks up where it left off when run again.
+        See backup_cloud.restore.restore_tree().  Packed uploads are
+        recognised and restored with backup_cloud.pack.restore_packed_tree()
+        and sharded uploads are restored to the paths in their manifest.
+        """
+        from backup_cloud.pack import is_packed, restore_packed_tree
+        from backup_cloud.restore import restore_tree
+        from backup_cloud.shard import read_shard_manifest
+
+        bucket = self.ssm_parameter("s3_bucket")
+        prefix = self.backup_key(backup_path)
+        if is_packed(self, bucket, prefix):
+            restore_packed_tree(
+                self, bucket, prefix, dest_directory, workers=workers, **kwargs
+            )
+            return
+        shards = read_shard_manifest(self, bucket, prefix)
+        if shards is not None:
+            kwargs["layout"] = shards.layout(prefix)
+        restore_tree(self, bucket, prefix, dest_directory, workers=workers, **kwargs)
+
+    def list_path(self, backup_path: str) -> List[str]:
+        """the paths of the files in a directory tree written by upload_path()
+
+        Paths start with the name of the directory which was uploaded,
+        as for restore_member(), whether or not the upload was packed
+        or sharded.
+        """
+        from backup_cloud.pack import is_packed, read_pack_index
+        from backup_cloud.restore import _logical_objects
+        from backup_cloud.s3 import list_objects_parallel
+        from backup_cloud.shard import read_shard_manifest
+
+        bucket = self.ssm_parameter("s3_bucket")
+        prefix = self.backup_key(backup_path).rstrip("/")
+        if is_packed(self, bucket, prefix):
+            return sorted(read_pack_index(self, bucket, prefix)["files"])
+        shards = read_shard_manifest(self, bucket, prefix)
+        if shards is not None:
+            return shards.names()
+        listing = list_objects_parallel(self.s3, bucket, prefix + "/")
+        return sorted(
+            obj["Key"].replace(prefix + "/", "", 1) for obj in _logical_objects(listing)
+        )
+
+    def restore_member(self, backup_path: str, name: str, dest_file: str) -> None:
+        """restore the single file name from an upload_path() at backup_path
+
+        name is the path of the file in the backup, starting with the
+        name of the directory which was uploaded.  Packed and sharded
+        uploads are looked up in their index or manifest.
+        """
+        from backup_cloud.pack import is_packed
+        from backup_cloud.shard import read_shard_manifest
+
+        bucket = self.ssm_parameter("s3_bucket")
+        prefix = self.backup_key(backup_path).rstrip("/")
+        if is_packed(self, bucket, prefix):
+            self.restore_packed_file(backup_path, name, dest_file)
+            return
+        name = name.strip("/")
+        shards = read_shard_manifest(self, bucket, prefix)
+        if shards is not None:
+            if name not in shards.files:
+                raise Exception("no file " + name + " in sharded upload " + prefix)
+            name = shards.files[name]["key"]
+        self.restore_file(backup_path.rstrip("/") + "/" + name, dest_file)
+
+    def restore_packed_file(self, backup_path: str, name: str, dest_file: str) -> None:
+        """restore the single file name from a packed upload at backup_path
+
+        name is the path of the file in the backup, starting with the
+        name of the directory which was uploaded.
+        """
+        from backup_cloud.pack import restore_packed_file
+
+        restore_packed_file(
+            self,
+            self.ssm_parameter("s3_bucket"),
+            self.backup_key(backup_path),
+            name,
+            dest_file,
+        )
+
+    def backup_file_to_s3(
+        self,
+        src_file: str,
+        dest_bucket,
+        dest_path: str,
+        debug: bool = False,
+        transfer_config=None,
+        segmented: bool = False,
+        processes: Optional[int] = None,
+        resumable: bool = False,
+        resume_state_dir: Optional[str] = None,
+    ):
         """backup a single file to S3
 
         Take a single file encrypt it and upload it into an S3 object.
+        See backup_stream_to_s3() for the details.
+
+        resumable uploads the file in checkpointed parts so that if the
+        upload is interrupted running it again carries on from the last
+        part finished (see backup_cloud.resumable); the checkpoint is
+        kept in resume_state_dir.
+        """
+        if resumable:
+            from backup_cloud.resumable import backup_file_resumable
+
+            backup_file_resumable(
+                self,
+                src_file,
+                dest_bucket.name,
+                dest_path,
+                state_dir=resume_state_dir,
+                processes=processes,
+            )
+            return
+        with open(src_file, "rb") as f:
+            self.backup_stream_to_s3(
+                f,
+                dest_bucket,
+                dest_path,
+                debug=debug,
+                transfer_config=transfer_config,
+                name=src_file,
+                size=os.fstat(f.fileno()).st_size,
+                segmented=segmented,
+                processes=processes,
+            )
+
+    def backup_stream_to_s3(
+        self,
+        source_stream,
+        dest_bucket,
+        dest_path: str,
+        debug: bool = False,
+        transfer_config=None,
+        name: str = "stream",
+        size: Optional[int] = None,
+        segmented: bool = False,
+        processes: Optional[int] = None,
+    ) -> Optional[str]:
+        """backup a stream of data to S3
+
+        Encrypt everything readable from source_stream and upload it
+        into an S3 object.  The data is streamed through encryption so
+        memory use does not depend on its size.  debug reads the whole
+        stream into memory first which can make gpg problems easier to
+        see.  name is used in messages about the upload.
+
+        If size is given and is below small_file_threshold the stream
+        is instead encrypted in memory and sent with one PUT.  The ETag
+        of the new object is returned in that case, otherwise None.
+
+        segmented is for very large data: the stream is split into
+        segments which are encrypted independently by a pool of
+        processes (one per core unless processes is given) and
+        uploaded in parallel as numbered objects with a manifest (see
+        backup_cloud.segment.backup_stream_segmented()).  The restore_*()
+        methods recognise segmented backups.
+
+        If the context has a compression codec the stream is compressed
+        before encryption unless its start looks incompressible.
 
         We delete the initial slash and any double slashes from any
         path to stop empty folder names coming through
         """
-        dest_path = re.sub("/{2,}", "/", dest_path)
-        dest_path = re.sub("^/", "", dest_path)
+        dest_path = _clean_s3_path(dest_path)
 
         eprint(
             "uploading "
-            + src_file
+            + name
             + " to bucket "
             + dest_bucket.name
             + " with path "
@@ -386,34 +1599,71 @@ backup-cloud-upload {SSM_PATH} $1 $2
             + "\n"
         )
 
-        (r_encrypt, w_encrypt) = os.pipe()
-
-        with open(src_file, "rb") as f:
-            r_encrypt_file = os.fdopen(r_encrypt, mode="rb")
-            w_encrypt_file = os.fdopen(w_encrypt, mode="wb")
-
-            encrypt_thread = Thread(
-                target=_encrypt_worker_debug,
-                args=(self, f, w_encrypt_file),
-                daemon=True,
+        dest_obj = dest_bucket.Object(dest_path)
+        if self.metrics is not None and size is None:
+            source_stream = counter = CountingReader(source_stream)
+        with self._backup_object(lambda: counter.count if size is None else size):
+            return self._store_stream(
+                source_stream,
+                dest_bucket,
+                dest_obj,
+                debug=debug,
+                transfer_config=transfer_config,
+                name=name,
+                size=size,
+                segmented=segmented,
+                processes=processes,
             )
-            encrypt_thread.start()
 
-            dest_obj = dest_bucket.Object(dest_path)
+    def _backup_object(self, bytes_in: Callable[[], int]):
+        """count and time the object backed up in the block if we keep metrics"""
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.backup_object(bytes_in)
 
-            def callback(x):
-                eprint("uploaded " + str(x) + " bytes")
+    def _store_stream(
+        self,
+        source_stream,
+        dest_bucket,
+        dest_obj,
+        debug: bool,
+        transfer_config,
+        name: str,
+        size: Optional[int],
+        segmented: bool,
+        processes: Optional[int],
+    ) -> Optional[str]:
+        dest_path = dest_obj.key
+        try:
+            if segmented:
+                from backup_cloud.segment import backup_stream_segmented
 
-            try:
-                dest_obj.upload_fileobj(r_encrypt_file, Callback=callback)
-            except ClientError as e:
-                eprint(
-                    "Failed to store: ",
-                    src_file,
-                    " in: ",
-                    dest_bucket,
-                    "/",
-                    dest_path,
-                    " aborting.\n",
+                backup_stream_segmented(
+                    self, source_stream, dest_bucket, dest_path, processes=processes
                 )
-                raise e
+                return None
+            if self.pipeline_stats is not None:
+                source_stream = self.pipeline_stats.reader(source_stream, "source_read")
+            source_stream, metadata = self.prepare_stream(source_stream)
+            if size is not None and size < self.small_file_threshold and not debug:
+                return _put_encrypted(self, source_stream, dest_obj, metadata)
+            _upload_encrypted_stream(
+                self,
+                source_stream,
+                dest_obj,
+                debug=debug,
+                transfer_config=transfer_config,
+                metadata=metadata,
+            )
+        except ClientError as e:
+            eprint(
+                "Failed to store: ",
+                name,
+                " in: ",
+                dest_bucket,
+                "/",
+                dest_path,
+                " aborting.\n",
+            )
+            raise e
+        return None
@@ -0,0 +1,244 @@
+"""compression before encryption
+
+Encrypted data doesn't compress so anything worth compressing has to
+be compressed before it reaches gpg.  Database dumps and logs commonly
+shrink several times, which saves upload time as well as storage.
+
+The start of each stream is sampled and compression is skipped unless
+a quick compression of the sample saves at least MIN_SAVING of it, so
+media and data which is already compressed cost almost nothing.  The
+codec used is recorded in the user metadata of the backup object under
+CODEC_METADATA and restores choose the decoder from that.
+
+Both codecs use every core: zstd through its own worker threads and
+gzip by compressing blocks in parallel as separate gzip members, as
+pigz does.  zstd needs the zstandard package (pip install
+backup_cloud[zstd]); gzip is always available.
+"""
+
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from backup_cloud.base import NO_CODEC, PrefixedReader, read_exactly
+
+# bytes from the start of a stream used to decide whether to compress
+SAMPLE_SIZE = 256 * 1024
+# fraction of the sample a quick compression must save
+MIN_SAVING = 0.1
+# plaintext bytes compressed at a time
+BLOCK_SIZE = 1024 * 1024
+
+
+def _import_zstandard():
+    try:
+        import zstandard  # type: ignore
+    except ImportError:
+        raise Exception(
+            "zstd compression needs the zstandard package; install backup_cloud[zstd]"
+        )
+    return zstandard
+
+
+class _GzipMembersDecompressor:
+    """decompress concatenated gzip members as one stream"""
+
+    def __init__(self):
+        self._member = zlib.decompressobj(31)
+
+    @property
+    def eof(self) -> bool:
+        return self._member.eof
+
+    def decompress(self, data: bytes) -> bytes:
+        output = []
+        while data:
+            if self._member.eof:
+                self._member = zlib.decompressobj(31)
+            output.append(self._member.decompress(data))
+            data = self._member.unused_data
+        return b"".join(output)
+
+
+class GzipCodec:
+    """gzip written as one member per block so blocks compress in parallel
+
+    zlib releases the GIL while it works so the blocks are compressed
+    by a pool of threads.  Any gzip reader accepts the result.
+    """
+
+    name = "gzip"
+
+    def __init__(self, level: int = 6, threads: Optional[int] = None):
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+
+    def _compress_block(self, block: bytes) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+
+    def compress_stream(self, source_stream) -> Iterator[bytes]:
+        window: deque = deque()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            try:
+                for block in iter(lambda: read_exactly(source_stream, BLOCK_SIZE), b""):
+                    if len(window) >= self.threads * 2:
+                        yield window.popleft().result()
+                    window.append(executor.submit(self._compress_block, block))
+                while window:
+                    yield window.popleft().result()
+            finally:
+                for future in window:
+                    future.cancel()
+
+    def decompressor(self):
+        return _GzipMembersDecompressor()
+
+
+class ZstdCodec:
+    """zstd using its own pool of compression threads"""
+
+    name = "zstd"
+
+    def __init__(self, level: int = 3, threads: int = -1):
+        self.level = level
+        # -1 is one thread per core
+        self.threads = threads
+        _import_zstandard()
+
+    def compress_stream(self, source_stream) -> Iterator[bytes]:
+        zstandard = _import_zstandard()
+        compressor = zstandard.ZstdCompressor(
+            level=self.level, threads=self.threads
+        ).compressobj()
+        for block in iter(lambda: source_stream.read(BLOCK_SIZE), b""):
+            yield compressor.compress(block)
+        yield compressor.flush()
+
+    def decompressor(self):
+        return _import_zstandard().ZstdDecompressor().decompressobj()
+
+
+_CODECS: Dict[str, Callable] = {"gzip": GzipCodec, "zstd": ZstdCodec}
+
+
+def codec_names():
+    return sorted(_CODECS)
+
+
+def register_codec(name: str, factory: Callable) -> None:
+    """make another codec available by name
+
+    factory() returns an object with a name, a compress_stream(source)
+    generator of compressed bytes and a decompressor() whose
+    decompress(data) returns whatever output is ready.
+    """
+    _CODECS[name] = factory
+
+
+def get_codec(name: str):
+    try:
+        factory = _CODECS[name]
+    except KeyError:
+        raise Exception("unknown compression codec: " + name)
+    return factory()
+
+
+def is_compressible(sample: bytes, min_saving: float = MIN_SAVING) -> bool:
+    """true if a fast compression of sample saves at least min_saving of it"""
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - min_saving)
+
+
+class CompressingReader:
+    """a stream reading the output of a codec's compress_stream()"""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = chunks
+        self.buffer = b""
+        self.offset = 0
+
+    def read(self, amount=-1):
+        if amount is None or amount < 0:
+            start = self.offset
+            data = self.buffer[start:] + b"".join(self.chunks)
+            self.buffer = b""
+            self.offset = 0
+            return data
+        while self.offset >= len(self.buffer):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return b""
+            self.buffer = chunk
+            self.offset = 0
+        start = self.offset
+        end = start + amount
+        data = self.buffer[start:end]
+        self.offset = end
+        return data
+
+    def close(self):
+        self.chunks.close()
+
+
+def compression_stage(
+    source_stream,
+    codec_name: str,
+    sample_size: int = SAMPLE_SIZE,
+    min_saving: float = MIN_SAVING,
+) -> Tuple[object, Optional[str]]:
+    """compress source_stream with codec_name if its start compresses
+
+    Returns the stream to encrypt and the name of the codec used, or
+    None if the data looked incompressible and is passed on as it is.
+    """
+    codec = get_codec(codec_name)
+    sample = read_exactly(source_stream, sample_size)
+    source_stream = PrefixedReader(sample, source_stream)
+    if not is_compressible(sample, min_saving):
+        return source_stream, None
+    return CompressingReader(codec.compress_stream(source_stream)), codec.name
+
+
+class DecompressingWriter:
+    """a stream which decompresses what is written to it into sink_stream
+
+    codec_for() gives the name of the codec, or None or NO_CODEC if
+    the data wasn't compressed.  It is only called at the first write so that
+    it can depend on object metadata which arrives with the download.
+    """
+
+    _UNSET = object()
+
+    def __init__(self, sink_stream, codec_for: Callable[[], Optional[str]]):
+        self.sink_stream = sink_stream
+        self.codec_for = codec_for
+        self.decompressor = self._UNSET
+
+    def _choose(self):
+        if self.decompressor is self._UNSET:
+            codec_name = self.codec_for()
+            if codec_name in (None, NO_CODEC):
+                self.decompressor = None
+            else:
+                self.decompressor = get_codec(codec_name).decompressor()
+        return self.decompressor
+
+    def write(self, data) -> int:
+        decompressor = self._choose()
+        if decompressor is None:
+            self.sink_stream.write(data)
+        else:
+            self.sink_stream.write(decompressor.decompress(bytes(data)))
+        return len(data)
+
+    def flush(self):
+        self.sink_stream.flush()
+
+    def finish(self) -> None:
+        """check that the compressed data ended where it should"""
+        decompressor = self._choose()
+        if decompressor is not None and not getattr(decompressor, "eof", True):
+            raise Exception("compressed data is truncated")
@@ -0,0 +1,234 @@
+"""adaptive concurrency for uploads and downloads
+
+A fixed number of workers either leaves bandwidth unused or, on a
+busy prefix, provokes storms of S3 SlowDown (503) responses.
+AdaptiveConcurrency instead changes the number of jobs allowed to run
+at once the way TCP changes its window (AIMD): the limit goes up by one
+after each full window of jobs finishes while the job latency stays
+healthy, and is halved, at most once per round trip, whenever S3 asks
+us to slow down or a job fails with an error worth retrying.  Such
+jobs are tried again after a jittered, exponentially growing delay
+rather than failing the run.
+
+Latency counts as healthy while its moving average stays within
+LATENCY_FACTOR of the best average seen so far.  Every change of
+limit and every retry is logged so the settings can be tuned.
+"""
+
+import random
+import sys
+import time
+from contextlib import contextmanager
+from threading import Condition
+from typing import Iterator, Optional
+from botocore.exceptions import (  # type: ignore
+    ClientError,
+    ConnectionError,
+    HTTPClientError,
+)
+from backup_cloud.metrics import THROTTLE_CODES
+
+# by default the limit can grow to this many times the starting concurrency
+DEFAULT_MAX_FACTOR = 4
+# the limit is multiplied by this when we are throttled
+DECREASE_FACTOR = 0.5
+# latency is unhealthy once its average is this many times the best seen
+LATENCY_FACTOR = 3.0
+# weight of each new latency in the moving average
+LATENCY_WEIGHT = 0.2
+# jobs timed before latency is used to decide anything
+LATENCY_WARMUP = 5
+# times a job is tried before its error is given up to the caller
+MAX_ATTEMPTS = 5
+# seconds before the first retry, doubling for each later one
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 20.0
+# S3 error codes, besides throttling, which are worth trying again
+RETRYABLE_CODES = {
+    "InternalError",
+    "RequestTimeout",
+    "RequestTimeTooSkewed",
+    "ServiceUnavailable",
+    "500",
+    "502",
+    "504",
+}
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def _causes(e: BaseException) -> Iterator[BaseException]:
+    seen = set()
+    cause: Optional[BaseException] = e
+    while cause is not None and id(cause) not in seen:
+        seen.add(id(cause))
+        yield cause
+        cause = cause.__cause__ or cause.__context__
+
+
+def _error_code(e: BaseException) -> Optional[str]:
+    if isinstance(e, ClientError):
+        return e.response.get("Error", {}).get("Code")
+    return None
+
+
+def is_throttle(e: BaseException) -> bool:
+    """true if e, or an error it was raised from, asks us to slow down"""
+    return any(_error_code(cause) in THROTTLE_CODES for cause in _causes(e))
+
+
+def is_retryable(e: BaseException) -> bool:
+    """true if the job which raised e may well succeed if tried again"""
+    for cause in _causes(e):
+        if isinstance(cause, (ConnectionError, HTTPClientError)):
+            return True
+        code = _error_code(cause)
+        if code in THROTTLE_CODES or code in RETRYABLE_CODES:
+            return True
+    return False
+
+
+def _retry_delay(attempt: int) -> float:
+    # full jitter so that throttled workers don't all come back at once
+    return random.uniform(0, min(MAX_RETRY_DELAY, RETRY_DELAY * 2**attempt))
+
+
+class AdaptiveConcurrency:
+    """a limit on jobs running at once which adapts to how S3 copes
+
+    name is used in log messages.  The limit starts at initial and
+    stays between minimum and maximum; pools running the jobs need
+    maximum threads.  Thread safe.
+    """
+
+    def __init__(self, name: str, initial: int, maximum: int, minimum: int = 1):
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(self.maximum, max(self.minimum, initial))
+        self._active = 0
+        self._successes = 0
+        self._latency: Optional[float] = None
+        self._best_latency: Optional[float] = None
+        self._timed = 0
+        self._last_decrease = 0.0
+        self._condition = Condition()
+
+    def _set_limit(self, limit: int, reason: str) -> None:
+        # called holding the condition
+        eprint(
+            "adaptive concurrency for "
+            + self.name
+            + ": "
+            + str(self.limit)
+            + " -> "
+            + str(limit)
+            + " ("
+            + reason
+            + ")"
+        )
+        self.limit = limit
+        self._successes = 0
+        self._condition.notify_all()
+
+    def latency_healthy(self) -> bool:
+        if (
+            self._timed < LATENCY_WARMUP
+            or self._latency is None
+            or self._best_latency is None
+        ):
+            return True
+        return self._latency <= self._best_latency * LATENCY_FACTOR
+
+    def success(self, seconds: float) -> None:
+        """record a job which finished in seconds"""
+        with self._condition:
+            if self._latency is None:
+                self._latency = seconds
+            else:
+                self._latency += LATENCY_WEIGHT * (seconds - self._latency)
+            self._timed += 1
+            if self._timed >= LATENCY_WARMUP and (
+                self._best_latency is None or self._latency < self._best_latency
+            ):
+                self._best_latency = self._latency
+            self._successes += 1
+            if self._successes < self.limit or self.limit >= self.maximum:
+                return
+            if self.latency_healthy():
+                self._set_limit(self.limit + 1, "healthy")
+            else:
+                self._successes = 0
+
+    def backoff(self, reason: str) -> None:
+        """cut the limit because S3 is struggling
+
+        a burst of throttling responses all caused by the same load
+        only cuts the limit once: further cuts wait for about one job
+        latency (at least a second).
+        """
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < max(1.0, self._latency or 0.0):
+                return
+            self._last_decrease = now
+            limit = max(self.minimum, int(self.limit * DECREASE_FACTOR))
+            if limit != self.limit:
+                self._set_limit(limit, reason)
+            else:
+                self._successes = 0
+
+    def notice_response(self, response, **kwargs) -> None:
+        """botocore needs-retry handler backing off on throttling responses
+
+        it only looks; botocore's own retry handler still decides.
+        """
+        if response is None:
+            return
+        http_response, parsed = response
+        code = parsed.get("Error", {}).get("Code") if isinstance(parsed, dict) else None
+        if code in THROTTLE_CODES or http_response.status_code == 503:
+            self.backoff(code or "HTTP 503")
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """wait until there is room under the limit and run the block"""
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            if is_retryable(e):
+                self.backoff(_error_code(e) or type(e).__name__)
+            raise
+        else:
+            self.success(time.monotonic() - start)
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify()
+
+    def call(self, function, *args, **kwargs):
+        """run function under the limit, retrying errors worth retrying"""
+        attempt = 0
+        while True:
+            try:
+                with self.slot():
+                    return function(*args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                if attempt >= MAX_ATTEMPTS or not is_retryable(e):
+                    raise
+                delay = _retry_delay(attempt)
+                eprint(
+                    "retrying "
+                    + self.name
+                    + " in {:.1f}s after: ".format(delay)
+                    + repr(e)
+                )
+                time.sleep(delay)
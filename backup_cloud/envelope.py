@@ -0,0 +1,150 @@
+"""envelope encryption: one public key operation per run
+
+A random data key is made once per run, encrypted to all the
+recipients with GnuPG and stored as a key object under the backup
+location.  Every file is then encrypted with AES-256-GCM under a key
+derived from the data key and a random per-file salt.  Restoring
+unwraps each data key once, with the secret keys in the restore
+keyring, and can then decrypt any number of files quickly.
+
+An enveloped object is ENVELOPE_MAGIC, the 16 byte id of the data key,
+the 16 byte salt and then frames of a 4 byte big-endian length and
+the AES-GCM output for up to chunk_size bytes of plaintext.  Each
+frame's nonce is its number with a flag marking the last frame, so
+reordered, repeated or truncated frames fail to decrypt.
+
+This needs the cryptography package (pip install backup_cloud[envelope]).
+"""
+
+import os
+import struct
+from typing import Callable
+from backup_cloud.base import read_exactly
+
+# first bytes of an enveloped object; cannot start an OpenPGP message
+ENVELOPE_MAGIC = b"BCENV1\0"
+KEY_ID_BYTES = 16
+SALT_BYTES = 16
+# plaintext bytes in each authenticated frame
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# where key objects live, under s3_target_url()
+ENVELOPE_KEY_FOLDER = "/envelope-keys/"
+
+_LENGTH = struct.Struct(">I")
+
+
+def _aead_for_file(data_key: bytes, salt: bytes):
+    try:
+        from cryptography.hazmat.primitives import hashes  # type: ignore
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM  # type: ignore
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF  # type: ignore
+    except ImportError:
+        raise Exception(
+            "envelope encryption needs the cryptography package;"
+            " install backup_cloud[envelope]"
+        )
+    file_key = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        info=b"backup-cloud envelope file key",
+    ).derive(data_key)
+    return AESGCM(file_key)
+
+
+def _nonce(counter: int, final: bool) -> bytes:
+    return counter.to_bytes(11, "big") + (b"\x01" if final else b"\x00")
+
+
+class EnvelopeKey:
+    """a data key and the id its wrapped copy is stored under"""
+
+    def __init__(self, key_id: str, data_key: bytes):
+        self.key_id = key_id
+        self.data_key = data_key
+
+    @classmethod
+    def generate(cls) -> "EnvelopeKey":
+        return cls(os.urandom(KEY_ID_BYTES).hex(), os.urandom(32))
+
+
+def envelope_key_path(backup_context, key_id: str) -> str:
+    return backup_context.s3_target_url() + ENVELOPE_KEY_FOLDER + key_id + ".gpg"
+
+
+def store_envelope_key(backup_context, key: EnvelopeKey) -> None:
+    """encrypt the data key to all our recipients and upload it"""
+    wrapped, _result, _sign_result = backup_context.encrypt(key.data_key)
+    dest_obj = backup_context.s3_bucket().Object(
+        envelope_key_path(backup_context, key.key_id)
+    )
+    dest_obj.put(Body=wrapped, ContentLength=len(wrapped))
+
+
+def fetch_envelope_key(backup_context, key_id: str) -> bytes:
+    """download a key object and unwrap it with the restore keyring"""
+    response = backup_context.s3.get_object(
+        Bucket=backup_context.ssm_parameter("s3_bucket"),
+        Key=envelope_key_path(backup_context, key_id),
+    )
+    data_key, _result, _verify_result = backup_context.decrypt(response["Body"].read())
+    return data_key
+
+
+def envelope_encrypt_stream(
+    key: EnvelopeKey, source_stream, sink_stream, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> None:
+    """encrypt source_stream into sink_stream under key
+
+    Only two chunks are held in memory whatever the stream size.
+    """
+    salt = os.urandom(SALT_BYTES)
+    aead = _aead_for_file(key.data_key, salt)
+    sink_stream.write(ENVELOPE_MAGIC + bytes.fromhex(key.key_id) + salt)
+    counter = 0
+    chunk = read_exactly(source_stream, chunk_size)
+    while True:
+        # look ahead so the last frame can be marked
+        following = b""
+        if len(chunk) == chunk_size:
+            following = read_exactly(source_stream, chunk_size)
+        final = not following
+        ciphertext = aead.encrypt(_nonce(counter, final), chunk, None)
+        sink_stream.write(_LENGTH.pack(len(ciphertext)) + ciphertext)
+        if final:
+            return
+        chunk = following
+        counter += 1
+
+
+def envelope_decrypt_stream(
+    data_key_for: Callable[[str], bytes], source_stream, sink_stream
+) -> None:
+    """decrypt an enveloped stream whose ENVELOPE_MAGIC has been read
+
+    data_key_for(key_id) returns the unwrapped data key.  An
+    exception is raised if any frame has been altered, reordered or
+    cut off.
+    """
+    header = read_exactly(source_stream, KEY_ID_BYTES + SALT_BYTES)
+    if len(header) != KEY_ID_BYTES + SALT_BYTES:
+        raise Exception("enveloped object is truncated")
+    key_id = header[:KEY_ID_BYTES].hex()
+    salt = header[KEY_ID_BYTES:]
+    aead = _aead_for_file(data_key_for(key_id), salt)
+
+    counter = 0
+    length_bytes = read_exactly(source_stream, _LENGTH.size)
+    while True:
+        if len(length_bytes) != _LENGTH.size:
+            raise Exception("enveloped object is truncated")
+        (length,) = _LENGTH.unpack(length_bytes)
+        ciphertext = read_exactly(source_stream, length)
+        if len(ciphertext) != length:
+            raise Exception("enveloped object is truncated")
+        length_bytes = read_exactly(source_stream, _LENGTH.size)
+        final = not length_bytes
+        sink_stream.write(aead.decrypt(_nonce(counter, final), ciphertext, None))
+        if final:
+            return
+        counter += 1
@@ -0,0 +1,102 @@
+import hashlib
+import sqlite3
+from threading import Lock
+from typing import NamedTuple, Optional
+
+# index updates written in one transaction
+COMMIT_EVERY = 100
+
+
+class IndexEntry(NamedTuple):
+    dest_key: str
+    path: str
+    size: int
+    mtime_ns: int
+    sha256: str
+    etag: str
+
+
+class HashingReader:
+    """wrap a readable stream, hashing everything read through it
+
+    lets us record the content hash of a file while it is being
+    uploaded rather than reading it a second time.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+
+    def read(self, amount=-1):
+        data = self.stream.read(amount)
+        self.hash.update(data)
+        return data
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class FileIndex:
+    """local record of files already backed up by upload_path()
+
+    For each destination key we keep the source path, size, mtime and
+    content hash of the file as it was uploaded along with the ETag of
+    the object.  A file whose size and mtime still match can be
+    skipped without reading it.
+
+    The index is an SQLite database which may be shared between
+    threads; updates are committed in batches and on close().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = Lock()
+        self._uncommitted = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                   dest_key TEXT PRIMARY KEY,
+                   path TEXT NOT NULL,
+                   size INTEGER NOT NULL,
+                   mtime_ns INTEGER NOT NULL,
+                   sha256 TEXT NOT NULL,
+                   etag TEXT NOT NULL
+               )"""
+        )
+        self.db.commit()
+
+    def lookup(self, dest_key: str) -> Optional[IndexEntry]:
+        with self._lock:
+            row = self.db.execute(
+                "SELECT dest_key, path, size, mtime_ns, sha256, etag"
+                " FROM files WHERE dest_key = ?",
+                (dest_key,),
+            ).fetchone()
+        return IndexEntry(*row) if row else None
+
+    def record(self, entry: IndexEntry) -> None:
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files"
+                " (dest_key, path, size, mtime_ns, sha256, etag)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                tuple(entry),
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= COMMIT_EVERY:
+                self.db.commit()
+                self._uncommitted = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import sys
+from tempfile import NamedTemporaryFile
+from typing import Dict, Optional
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def default_key_cache_dir() -> str:
+    """return the standard location for the public key cache
+
+    $BACKUP_CLOUD_KEY_CACHE if set, otherwise under $XDG_CACHE_HOME
+    (normally ~/.cache).
+    """
+    if os.environ.get("BACKUP_CLOUD_KEY_CACHE"):
+        return os.environ["BACKUP_CLOUD_KEY_CACHE"]
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "backup-cloud", "keys")
+
+
+class KeyCache:
+    """on disk cache of the public key objects from one key folder
+
+    Each cached key is stored along with the ETag and LastModified
+    values S3 gave for the object so that, provided a listing of the
+    folder shows the same values, the key can be used without fetching
+    it again.
+
+    base_dir: directory holding caches for all buckets/folders
+    bucket, prefix: the S3 location of the key folder being cached
+
+    The cache directory is private to the user since anyone who could
+    write to it could add recipients to our backups.
+    """
+
+    def __init__(self, base_dir: str, bucket: str, prefix: str):
+        location = hashlib.sha256((bucket + "/" + prefix).encode("utf-8"))
+        self.directory = os.path.join(base_dir, location.hexdigest()[:32])
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        os.chmod(self.directory, 0o700)
+        self.index_path = os.path.join(self.directory, "index.json")
+        self.index: Dict[str, Dict[str, str]] = {}
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            eprint("ignoring corrupt key cache index: " + self.index_path)
+
+    def _key_file(self, key: str) -> str:
+        return os.path.join(
+            self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".key"
+        )
+
+    def etag(self, key: str) -> Optional[str]:
+        entry = self.index.get(key)
+        return entry["etag"] if entry else None
+
+    def lookup(self, key: str, etag: str, last_modified: str) -> Optional[bytes]:
+        """return the cached key if it still matches the S3 object"""
+        entry = self.index.get(key)
+        if (
+            entry is None
+            or entry["etag"] != etag
+            or entry["last_modified"] != last_modified
+        ):
+            return None
+        return self.read(key)
+
+    def read(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._key_file(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def store(self, key: str, etag: str, last_modified: str, data: bytes) -> None:
+        with open(self._key_file(key), "wb") as f:
+            f.write(data)
+        self.index[key] = dict(etag=etag, last_modified=last_modified)
+
+    def save(self, current_keys) -> None:
+        """write the index, dropping keys which are no longer in S3"""
+        for key in list(self.index):
+            if key not in current_keys:
+                del self.index[key]
+                try:
+                    os.unlink(self._key_file(key))
+                except FileNotFoundError:
+                    pass
+        with NamedTemporaryFile("w", dir=self.directory, delete=False) as f:
+            json.dump(self.index, f)
+        os.replace(f.name, self.index_path)
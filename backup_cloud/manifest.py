@@ -0,0 +1,226 @@
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Dict, Iterable, List, Optional
+from botocore.exceptions import ClientError  # type: ignore
+from backup_cloud.base import _upload_encrypted_stream
+
+MANIFEST_VERSION = 1
+
+# the manifest for a backup prefix is stored alongside it as PREFIX + this
+MANIFEST_SUFFIX = ".manifest.json.gpg"
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def default_manifest_state_dir() -> str:
+    """return the standard location for local copies of backup manifests
+
+    $BACKUP_CLOUD_MANIFEST_STATE if set, otherwise under
+    $XDG_CACHE_HOME (normally ~/.cache).
+    """
+    if os.environ.get("BACKUP_CLOUD_MANIFEST_STATE"):
+        return os.environ["BACKUP_CLOUD_MANIFEST_STATE"]
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "backup-cloud", "manifests")
+
+
+def manifest_key(dest_prefix: str) -> str:
+    return dest_prefix.rstrip("/") + MANIFEST_SUFFIX
+
+
+class BackupManifest:
+    """record of the source objects held in one prefix backup
+
+    objects maps each source key to the etag, size and version_id of
+    the object as it was backed up and the dest_key it was written to.
+    deleted holds the same information for keys which have since
+    disappeared from the source, along with when we noticed.
+
+    record() and forget() may be called from several threads.
+    """
+
+    def __init__(
+        self,
+        source_bucket: str,
+        source_prefix: str,
+        objects: Optional[Dict[str, Dict]] = None,
+        deleted: Optional[Dict[str, Dict]] = None,
+    ):
+        self.source_bucket = source_bucket
+        self.source_prefix = source_prefix
+        self.objects: Dict[str, Dict] = objects or {}
+        self.deleted: Dict[str, Dict] = deleted or {}
+        self._lock = Lock()
+
+    def changed(self, obj) -> bool:
+        """true if a listing entry is not backed up as it stands now"""
+        entry = self.objects.get(obj["Key"])
+        return (
+            entry is None
+            or entry["etag"] != obj["ETag"]
+            or entry["size"] != obj["Size"]
+        )
+
+    def record(self, key: str, source_info: Dict, dest_key: str) -> None:
+        with self._lock:
+            self.objects[key] = dict(
+                etag=source_info["etag"],
+                size=source_info["size"],
+                version_id=source_info.get("version_id"),
+                dest_key=dest_key,
+            )
+            self.deleted.pop(key, None)
+
+    def forget(self, key: str) -> None:
+        """drop an object whose backup failed so the next run retries it"""
+        with self._lock:
+            self.objects.pop(key, None)
+
+    def record_deletions(self, current_keys) -> List[str]:
+        """move objects no longer in the source to deleted
+
+        current_keys must cover a complete listing of the source.
+        """
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        with self._lock:
+            gone = [key for key in self.objects if key not in current_keys]
+            for key in gone:
+                entry = self.objects.pop(key)
+                entry["deleted"] = now
+                self.deleted[key] = entry
+        return gone
+
+    def to_json(self) -> str:
+        with self._lock:
+            return json.dumps(
+                dict(
+                    version=MANIFEST_VERSION,
+                    source_bucket=self.source_bucket,
+                    source_prefix=self.source_prefix,
+                    generated=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    objects=self.objects,
+                    deleted=self.deleted,
+                ),
+                sort_keys=True,
+            )
+
+    @classmethod
+    def from_json(cls, text: str) -> "BackupManifest":
+        data = json.loads(text)
+        if data.get("version") != MANIFEST_VERSION:
+            raise ValueError("unknown manifest version: " + repr(data.get("version")))
+        return cls(
+            data["source_bucket"],
+            data["source_prefix"],
+            objects=data["objects"],
+            deleted=data["deleted"],
+        )
+
+
+class ManifestState:
+    """local plaintext copy of a manifest we uploaded
+
+    The manifest in S3 is encrypted to the backup recipients and a
+    machine doing backups normally only has their public keys so it
+    cannot read it back.  Instead we keep our own copy along with the
+    ETag S3 gave the encrypted object; while that still matches the
+    copy is known to be what is in S3.
+
+    The directory is private to the user since the manifest lists the
+    names of everything backed up.
+    """
+
+    def __init__(self, base_dir: str, bucket: str, key: str):
+        os.makedirs(base_dir, mode=0o700, exist_ok=True)
+        os.chmod(base_dir, 0o700)
+        location = hashlib.sha256((bucket + "/" + key).encode("utf-8"))
+        self.path = os.path.join(base_dir, location.hexdigest()[:32] + ".json")
+
+    def load(self, remote_etag: str) -> Optional[BackupManifest]:
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            if state["etag"] != remote_etag:
+                eprint("backup manifest in S3 has changed; doing a full backup")
+                return None
+            return BackupManifest.from_json(state["manifest"])
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError):
+            eprint("ignoring corrupt backup manifest state: " + self.path)
+            return None
+
+    def save(self, manifest_json: str, remote_etag: str) -> None:
+        directory = os.path.dirname(self.path)
+        with NamedTemporaryFile("w", dir=directory, delete=False) as f:
+            json.dump(dict(etag=remote_etag, manifest=manifest_json), f)
+        os.replace(f.name, self.path)
+
+
+def load_manifest(
+    backup_context,
+    state: ManifestState,
+    dest_bucket: str,
+    key: str,
+    source_bucket: str,
+    source_prefix: str,
+) -> BackupManifest:
+    """return the manifest of the existing backup, or an empty one
+
+    An empty manifest, meaning everything is backed up again, is used
+    when there is no manifest in S3 or our local copy of it is missing
+    or out of date.
+    """
+    try:
+        head = backup_context.s3.head_object(Bucket=dest_bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+        head = None
+    manifest = state.load(head["ETag"]) if head else None
+    if manifest is not None and (
+        manifest.source_bucket != source_bucket
+        or manifest.source_prefix != source_prefix
+    ):
+        eprint("backup manifest is for a different source; doing a full backup")
+        manifest = None
+    if manifest is None:
+        manifest = BackupManifest(source_bucket, source_prefix)
+    return manifest
+
+
+def save_manifest(
+    backup_context,
+    state: ManifestState,
+    manifest: BackupManifest,
+    dest_bucket: str,
+    key: str,
+    current_keys: Optional[Iterable[str]] = None,
+) -> None:
+    """encrypt and upload the manifest, then update our local copy
+
+    Given the keys from a complete listing of the source, objects
+    which have gone are first recorded as deleted.
+    """
+    if current_keys is not None:
+        gone = manifest.record_deletions(current_keys)
+        if gone:
+            eprint(str(len(gone)) + " objects deleted from source since last backup")
+    manifest_json = manifest.to_json()
+    dest_obj = backup_context.s3_resource().Object(dest_bucket, key)
+    _upload_encrypted_stream(
+        backup_context,
+        io.BytesIO(manifest_json.encode("utf-8")),
+        dest_obj,
+        metadata=backup_context.format_metadata(),
+    )
+    head = backup_context.s3.head_object(Bucket=dest_bucket, Key=key)
+    state.save(manifest_json, head["ETag"])
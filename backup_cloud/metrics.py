@@ -0,0 +1,356 @@
+"""metrics for a backup run, written as a Prometheus textfile or JSON
+
+RunMetrics counts what a run did: plaintext bytes backed up, bytes
+uploaded, the objects backed up, skipped or failed and how long each
+took, and every call made to S3 and SSM with the retries and
+throttling responses behind them.  Give one to
+BackupContext(metrics=...) and write it out when the run finishes.
+
+write_textfile() writes the Prometheus text format for node-exporter's
+textfile collector, replacing the file atomically so a scrape never
+sees half a file.  write_json() writes the same figures as one JSON
+document.  backup_cloud_last_run_timestamp_seconds and
+backup_cloud_last_run_success make it easy to alert on backups which
+stop finishing or start failing.
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# upper bounds in seconds of the per-object latency histogram buckets
+OBJECT_SECONDS_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600]
+# error codes AWS uses to ask us to slow down
+THROTTLE_CODES = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "RequestThrottled",
+    "ProvisionedThroughputExceededException",
+    "503",
+}
+# S3 calls which upload object data
+UPLOAD_OPERATIONS = ["PutObject", "UploadPart"]
+
+# name: (prometheus type, help)
+METRICS = {
+    "backup_cloud_bytes_in_total": ("counter", "plaintext bytes backed up"),
+    "backup_cloud_bytes_out_total": ("counter", "bytes uploaded to S3"),
+    "backup_cloud_compression_ratio": (
+        "gauge",
+        "plaintext bytes backed up per byte uploaded",
+    ),
+    "backup_cloud_objects_total": ("counter", "objects processed by result"),
+    "backup_cloud_object_seconds": ("histogram", "time taken to back up each object"),
+    "backup_cloud_aws_calls_total": (
+        "counter",
+        "AWS API calls by service and operation",
+    ),
+    "backup_cloud_aws_retries_total": ("counter", "AWS API calls retried"),
+    "backup_cloud_aws_throttles_total": (
+        "counter",
+        "AWS responses asking us to slow down",
+    ),
+    "backup_cloud_run_seconds": ("gauge", "duration of the last run"),
+    "backup_cloud_last_run_timestamp_seconds": ("gauge", "time the last run ended"),
+    "backup_cloud_last_run_success": ("gauge", "1 if the last run succeeded"),
+}
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(**labels) -> _Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _error_code(parsed) -> Optional[str]:
+    if not isinstance(parsed, dict):
+        return None
+    return parsed.get("Error", {}).get("Code")
+
+
+def _format_labels(labels: _Labels) -> str:
+    if not labels:
+        return ""
+    escaped = [
+        k
+        + '="'
+        + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for (k, v) in labels
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class CountingReader:
+    """a stream counting the bytes read through it"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, amount=-1):
+        data = self.stream.read(amount)
+        self.count += len(data)
+        return data
+
+
+class _Histogram:
+    def __init__(self, bounds: List[float]):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class RunMetrics:
+    """counters and histograms for one run of a backup command
+
+    thread safe.  command is added as a label to every metric so that
+    several commands can write textfiles into the same directory.
+    """
+
+    def __init__(self, command: str = "backup-cloud"):
+        self.command = command
+        self._lock = Lock()
+        self._counters: Dict[Tuple[str, _Labels], float] = {}
+        self._histograms: Dict[Tuple[str, _Labels], _Histogram] = {}
+        self._start = time.monotonic()
+        self._seconds: Optional[float] = None
+        self._success: Optional[bool] = None
+
+    def count(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, _labels(**labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _labels(**labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(OBJECT_SECONDS_BUCKETS)
+            histogram.observe(value)
+
+    def total(self, name: str, **labels) -> float:
+        """the sum of counter name over every label set matching labels"""
+        wanted = set(labels.items())
+        with self._lock:
+            return sum(
+                value
+                for ((n, l), value) in self._counters.items()
+                if n == name and wanted <= set(l)
+            )
+
+    @contextmanager
+    def backup_object(self, bytes_in: Callable[[], int]) -> Iterator[None]:
+        """count the object backed up in the block and time it
+
+        bytes_in() gives the plaintext size once the block has finished.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.count("backup_cloud_objects_total", result="failed")
+            raise
+        finally:
+            self.observe("backup_cloud_object_seconds", time.monotonic() - start)
+        self.count("backup_cloud_objects_total", result="backed_up")
+        self.count("backup_cloud_bytes_in_total", bytes_in())
+
+    def _after_call(self, model, parsed, **kwargs) -> None:
+        service = model.service_model.service_name
+        self.count(
+            "backup_cloud_aws_calls_total", service=service, operation=model.name
+        )
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        if retries:
+            self.count("backup_cloud_aws_retries_total", retries, service=service)
+
+    def _needs_retry(self, response, operation, **kwargs) -> None:
+        # called after every attempt; we only look, the retry handler decides
+        if response is None:
+            return
+        http_response, parsed = response
+        code = _error_code(parsed)
+        if code in THROTTLE_CODES or http_response.status_code == 503:
+            service = operation.service_model.service_name
+            self.count("backup_cloud_aws_throttles_total", service=service)
+
+    def _upload_started(self, params, **kwargs) -> None:
+        body = params.get("Body")
+        try:
+            amount = len(body)
+        except TypeError:
+            return
+        self.count("backup_cloud_bytes_out_total", amount)
+
+    def watch_client(self, client) -> None:
+        """count the calls, retries and throttles of a botocore client"""
+        events = client.meta.events
+        service = client.meta.service_model.service_id.hyphenize()
+        unique = "backup-cloud-metrics-%d-" % id(self)
+        events.register(
+            "after-call." + service, self._after_call, unique_id=unique + "call"
+        )
+        events.register(
+            "needs-retry." + service, self._needs_retry, unique_id=unique + "retry"
+        )
+        if service == "s3":
+            for operation in UPLOAD_OPERATIONS:
+                events.register(
+                    "before-parameter-build.s3." + operation,
+                    self._upload_started,
+                    unique_id=unique + operation,
+                )
+
+    def finish(self, success: bool) -> None:
+        """record the end of the run"""
+        self._seconds = time.monotonic() - self._start
+        self._success = success
+
+    def _gauges(self) -> Dict[str, float]:
+        gauges = {}
+        bytes_out = self.total("backup_cloud_bytes_out_total")
+        if bytes_out:
+            gauges["backup_cloud_compression_ratio"] = (
+                self.total("backup_cloud_bytes_in_total") / bytes_out
+            )
+        if self._seconds is not None:
+            gauges["backup_cloud_run_seconds"] = self._seconds
+            gauges["backup_cloud_last_run_timestamp_seconds"] = time.time()
+            gauges["backup_cloud_last_run_success"] = 1 if self._success else 0
+        return gauges
+
+    def textfile(self) -> str:
+        """the metrics in the Prometheus text exposition format"""
+        command = ("command", self.command)
+        samples: Dict[str, List[str]] = {name: [] for name in METRICS}
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                samples[name].append(
+                    name
+                    + _format_labels((command,) + labels)
+                    + " "
+                    + _format_value(value)
+                )
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                cumulative = list(zip(histogram.bounds, histogram.counts))
+                cumulative.append((float("inf"), histogram.count))
+                for bound, count in cumulative:
+                    le = (("le", _format_value(float(bound))),)
+                    samples[name].append(
+                        name
+                        + "_bucket"
+                        + _format_labels((command,) + labels + le)
+                        + " "
+                        + str(count)
+                    )
+                for suffix, value in (
+                    ("_sum", histogram.sum),
+                    ("_count", histogram.count),
+                ):
+                    samples[name].append(
+                        name
+                        + suffix
+                        + _format_labels((command,) + labels)
+                        + " "
+                        + _format_value(value)
+                    )
+        for name, value in self._gauges().items():
+            samples[name].append(
+                name + _format_labels((command,)) + " " + _format_value(value)
+            )
+
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            if samples[name]:
+                lines.append("# HELP " + name + " " + help_text)
+                lines.append("# TYPE " + name + " " + metric_type)
+                lines.extend(samples[name])
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> Dict:
+        """the metrics as a dictionary ready for JSON"""
+        calls: Dict[str, Dict[str, float]] = {}
+        objects: Dict[str, float] = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                label = dict(labels)
+                if name == "backup_cloud_aws_calls_total":
+                    service = calls.setdefault(label["service"], {})
+                    service[label["operation"]] = value
+                elif name == "backup_cloud_objects_total":
+                    objects[label["result"]] = value
+            latency = self._histograms.get(("backup_cloud_object_seconds", ()))
+            object_seconds = None
+            if latency is not None:
+                object_seconds = {
+                    "count": latency.count,
+                    "sum": latency.sum,
+                    "buckets": dict(
+                        zip([str(b) for b in latency.bounds], latency.counts)
+                    ),
+                }
+        gauges = self._gauges()
+        return {
+            "command": self.command,
+            "success": self._success,
+            "run_seconds": gauges.get("backup_cloud_run_seconds"),
+            "bytes_in": self.total("backup_cloud_bytes_in_total"),
+            "bytes_out": self.total("backup_cloud_bytes_out_total"),
+            "compression_ratio": gauges.get("backup_cloud_compression_ratio"),
+            "objects": objects,
+            "object_seconds": object_seconds,
+            "aws_calls": calls,
+            "aws_retries": self._by_service("backup_cloud_aws_retries_total"),
+            "aws_throttles": self._by_service("backup_cloud_aws_throttles_total"),
+        }
+
+    def _by_service(self, name: str) -> Dict[str, float]:
+        with self._lock:
+            return {
+                dict(labels)["service"]: value
+                for ((n, labels), value) in self._counters.items()
+                if n == name
+            }
+
+    def write_textfile(self, path: str) -> None:
+        """write textfile() to path, atomically replacing what was there"""
+        _write_atomically(path, self.textfile())
+
+    def write_json(self, path: str) -> None:
+        _write_atomically(
+            path, json.dumps(self.summary(), indent=2, sort_keys=True) + "\n"
+        )
+
+
+def _write_atomically(path: str, text: str) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    with NamedTemporaryFile(
+        "w", dir=directory, prefix=".tmp-", suffix=".part", delete=False
+    ) as f:
+        f.write(text)
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
@@ -0,0 +1,415 @@
+import io
+import json
+import os
+import sys
+import tarfile
+from collections import defaultdict
+from tempfile import NamedTemporaryFile
+from threading import Thread
+from typing import Dict, List, Optional, Tuple
+from botocore.exceptions import ClientError  # type: ignore
+from backup_cloud.base import (
+    BackupContext,
+    _clean_s3_path,
+    _put_encrypted,
+    bounded_transfer_config,
+    read_exactly,
+    run_bounded,
+)
+from backup_cloud.restore import (
+    RESTORE_JOURNAL,
+    TEMP_PREFIX,
+    RestoreError,
+    RestoreJournal,
+    _remove_partial_restores,
+    _tree_path,
+    restore_object_to_file,
+)
+
+PACK_VERSION = 1
+# name of the encrypted index object in a packed backup
+PACK_INDEX = "index.json.gpg"
+# volumes are closed once they reach this size
+DEFAULT_VOLUME_SIZE = 256 * 1024 * 1024
+# files are grouped into chunks of about this much data which are each
+# encrypted on their own; the unit fetched to restore a single file.
+# Files this size or bigger are stored as objects of their own.
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+# most read at once while skipping over part of a volume
+SKIP_READ_SIZE = 1024 * 1024
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+class _VolumeUpload:
+    """stream data into one S3 object, keeping track of offsets
+
+    The upload runs in its own thread reading from a pipe so only the
+    pipe buffer and the boto3 part buffers are held in memory.
+    """
+
+    def __init__(self, dest_obj, transfer_config, metadata: Dict[str, str]):
+        r_volume, w_volume = os.pipe()
+        self._r_file = os.fdopen(r_volume, mode="rb")
+        self._w_file = os.fdopen(w_volume, mode="wb")
+        self.dest_obj = dest_obj
+        self.size = 0
+        self.errors: List[Exception] = []
+        self._thread = Thread(
+            target=self._upload, args=(transfer_config, metadata), daemon=True
+        )
+        self._thread.start()
+
+    def _upload(self, transfer_config, metadata):
+        try:
+            self.dest_obj.upload_fileobj(
+                self._r_file,
+                Config=transfer_config,
+                ExtraArgs={"Metadata": metadata},
+            )
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self._r_file.close()
+
+    def write(self, data: bytes) -> int:
+        """append data, returning the offset it was written at"""
+        offset = self.size
+        try:
+            self._w_file.write(data)
+        except BrokenPipeError:
+            self._thread.join()
+            if self.errors:
+                raise self.errors[0]
+            raise
+        self.size += len(data)
+        return offset
+
+    def close(self) -> None:
+        self._w_file.close()
+        self._thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def abort(self) -> None:
+        try:
+            self._w_file.close()
+        except BrokenPipeError:
+            pass
+        self._thread.join()
+        eprint("removing incomplete volume: " + self.dest_obj.key)
+        self.dest_obj.delete()
+
+
+def _encrypt_chunk(backup_context, members: List[Tuple[str, str]]) -> bytes:
+    """tar up (source file, name) members in memory and encrypt them"""
+    plaintext = io.BytesIO()
+    with tarfile.open(fileobj=plaintext, mode="w") as tar:
+        for src_name, name in members:
+            with open(src_name, "rb") as f:
+                st = os.fstat(f.fileno())
+                data = f.read()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(st.st_mtime)
+            info.mode = st.st_mode & 0o7777
+            tar.addfile(info, io.BytesIO(data))
+    plaintext.seek(0)
+    ciphertext = io.BytesIO()
+    backup_context.encrypt_stream(plaintext, ciphertext)
+    return ciphertext.getvalue()
+
+
+def _pack_jobs(src_directory: str):
+    """(source file, name in backup) pairs in the same layout as upload_path()"""
+    basepath = os.path.dirname(os.path.abspath(src_directory))
+    for subdir, _dirs, files in os.walk(src_directory):
+        for file in sorted(files):
+            src_name = os.path.join(subdir, file)
+            yield src_name, os.path.relpath(src_name, basepath).replace(os.sep, "/")
+
+
+def pack_path(
+    backup_context: BackupContext,
+    src_directory: str,
+    dest_prefix: str,
+    volume_size: int = DEFAULT_VOLUME_SIZE,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Dict:
+    """back up a directory as a few encrypted volumes instead of a file each
+
+    Small files are gathered into tar chunks of about chunk_size
+    bytes, each chunk is encrypted and the chunks are written one
+    after another into volume objects (volume-NNNNNN.gpg) of about
+    volume_size.  Files of chunk_size or more are encrypted as objects
+    of their own (file-NNNNNN.gpg).  Nothing in S3 reveals the names
+    of the files; they are only in the encrypted index object
+    (PACK_INDEX) which maps each name to its volume, and the offset
+    and length of its chunk there, so a single file can be restored
+    with one ranged GET.
+
+    Returns the index.
+    """
+    dest_prefix = _clean_s3_path(dest_prefix).rstrip("/")
+    bucket = backup_context.s3_bucket()
+    transfer_config = bounded_transfer_config()
+    metadata = backup_context.format_metadata()
+    index: Dict = dict(version=PACK_VERSION, volumes=[], objects=[], files={})
+    chunk: List[Tuple[str, str]] = []
+    chunk_bytes = 0
+    volume: Optional[_VolumeUpload] = None
+
+    def flush_chunk():
+        nonlocal volume, chunk, chunk_bytes
+        ciphertext = _encrypt_chunk(backup_context, chunk)
+        if volume is None:
+            key = "volume-{:06d}.gpg".format(len(index["volumes"]))
+            volume = _VolumeUpload(
+                bucket.Object(dest_prefix + "/" + key), transfer_config, metadata
+            )
+            index["volumes"].append(key)
+        offset = volume.write(ciphertext)
+        for _src_name, name in chunk:
+            index["files"][name] = dict(
+                volume=len(index["volumes"]) - 1, offset=offset, length=len(ciphertext)
+            )
+        chunk = []
+        chunk_bytes = 0
+        if volume.size >= volume_size:
+            volume.close()
+            volume = None
+
+    try:
+        for src_name, name in _pack_jobs(src_directory):
+            size = os.path.getsize(src_name)
+            if size >= chunk_size:
+                key = "file-{:06d}.gpg".format(len(index["objects"]))
+                backup_context.backup_file_to_s3(
+                    src_name,
+                    bucket,
+                    dest_prefix + "/" + key,
+                    transfer_config=transfer_config,
+                )
+                index["objects"].append(key)
+                index["files"][name] = dict(object=key)
+                continue
+            chunk.append((src_name, name))
+            chunk_bytes += size
+            if chunk_bytes >= chunk_size:
+                flush_chunk()
+        if chunk:
+            flush_chunk()
+        if volume is not None:
+            volume.close()
+            volume = None
+    except Exception:
+        if volume is not None:
+            volume.abort()
+            # the open volume is always the last and abort() removed it
+            index["volumes"].pop()
+        eprint("removing incomplete packed backup: " + dest_prefix)
+        for key in index["volumes"] + index["objects"]:
+            try:
+                bucket.Object(dest_prefix + "/" + key).delete()
+            except ClientError:
+                pass
+        raise
+
+    index_json = json.dumps(index, sort_keys=True).encode("utf-8")
+    _put_encrypted(
+        backup_context,
+        io.BytesIO(index_json),
+        bucket.Object(dest_prefix + "/" + PACK_INDEX),
+        metadata,
+    )
+    eprint(
+        "packed {} files into {} volumes and {} separate objects".format(
+            len(index["files"]), len(index["volumes"]), len(index["objects"])
+        )
+    )
+    return index
+
+
+def is_packed(backup_context: BackupContext, bucket: str, prefix: str) -> bool:
+    """true if prefix holds a backup written by pack_path()"""
+    try:
+        backup_context.s3.head_object(
+            Bucket=bucket, Key=prefix.rstrip("/") + "/" + PACK_INDEX
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+        return False
+    return True
+
+
+def _decrypt_bytes(backup_context, ciphertext: bytes) -> bytes:
+    plaintext = io.BytesIO()
+    backup_context.decrypt_stream(io.BytesIO(ciphertext), plaintext)
+    return plaintext.getvalue()
+
+
+def read_pack_index(backup_context: BackupContext, bucket: str, prefix: str) -> Dict:
+    response = backup_context.s3.get_object(
+        Bucket=bucket, Key=prefix.rstrip("/") + "/" + PACK_INDEX
+    )
+    index = json.loads(_decrypt_bytes(backup_context, response["Body"].read()))
+    if index.get("version") != PACK_VERSION:
+        raise Exception("unknown packed backup version: " + repr(index.get("version")))
+    return index
+
+
+def _extract(tar: tarfile.TarFile, member: tarfile.TarInfo, dest_file: str) -> None:
+    """write one member out to dest_file, only renaming it into place when done"""
+    directory = os.path.dirname(os.path.abspath(dest_file))
+    os.makedirs(directory, exist_ok=True)
+    source = tar.extractfile(member)
+    if source is None:
+        raise Exception("packed backup member is not a file: " + member.name)
+    with NamedTemporaryFile(
+        "wb", dir=directory, prefix=TEMP_PREFIX, delete=False
+    ) as temp_file:
+        for data in iter(lambda: source.read(1024 * 1024), b""):
+            temp_file.write(data)
+    os.chmod(temp_file.name, member.mode & 0o777)
+    os.utime(temp_file.name, (member.mtime, member.mtime))
+    os.replace(temp_file.name, dest_file)
+
+
+def _open_chunk(backup_context, ciphertext: bytes) -> tarfile.TarFile:
+    plaintext = _decrypt_bytes(backup_context, ciphertext)
+    return tarfile.open(fileobj=io.BytesIO(plaintext), mode="r:")
+
+
+def restore_packed_file(
+    backup_context: BackupContext,
+    bucket: str,
+    prefix: str,
+    name: str,
+    dest_file: str,
+    index: Optional[Dict] = None,
+) -> None:
+    """restore the single file name from a packed backup
+
+    Only the chunk holding the file is fetched, with a ranged GET.
+    """
+    prefix = prefix.rstrip("/")
+    if index is None:
+        index = read_pack_index(backup_context, bucket, prefix)
+    entry = index["files"].get(name)
+    if entry is None:
+        raise Exception("no file " + name + " in packed backup " + prefix)
+    if "object" in entry:
+        restore_object_to_file(
+            backup_context, bucket, prefix + "/" + entry["object"], dest_file
+        )
+        return
+    response = backup_context.s3.get_object(
+        Bucket=bucket,
+        Key=prefix + "/" + index["volumes"][entry["volume"]],
+        Range="bytes={}-{}".format(
+            entry["offset"], entry["offset"] + entry["length"] - 1
+        ),
+    )
+    with _open_chunk(backup_context, response["Body"].read()) as tar:
+        _extract(tar, tar.getmember(name), dest_file)
+
+
+def _skip(stream, amount: int) -> None:
+    """read and throw away amount bytes, SKIP_READ_SIZE at a time"""
+    while amount > 0:
+        amount -= len(read_exactly(stream, min(amount, SKIP_READ_SIZE), True))
+
+
+def restore_packed_tree(
+    backup_context: BackupContext,
+    bucket: str,
+    prefix: str,
+    dest_directory: str,
+    workers: int = 1,
+    journal_path: Optional[str] = None,
+    **kwargs
+) -> None:
+    """restore every file from a packed backup into dest_directory
+
+    Each volume is read with a single GET, decrypting its chunks in
+    turn; volumes and separately stored files are restored by workers
+    threads.  Other keyword arguments are passed on to
+    restore_object_to_file().
+
+    As with restore_tree(), finished volumes and objects are recorded
+    in a RestoreJournal (by default RESTORE_JOURNAL in dest_directory)
+    along with the ETag of the index, so running the restore again
+    only does what is left.  The journal is removed once everything
+    is restored.
+    """
+    prefix = prefix.rstrip("/")
+    # a new backup to the same prefix writes a new index
+    index_etag = backup_context.s3.head_object(
+        Bucket=bucket, Key=prefix + "/" + PACK_INDEX
+    )["ETag"]
+    index = read_pack_index(backup_context, bucket, prefix)
+    if journal_path is None:
+        journal_path = os.path.join(dest_directory, RESTORE_JOURNAL)
+    os.makedirs(dest_directory, exist_ok=True)
+    resuming = os.path.exists(journal_path)
+    journal = RestoreJournal(journal_path)
+    if resuming:
+        eprint("resuming restore recorded in " + journal_path)
+        _remove_partial_restores(dest_directory)
+    chunks: Dict[int, set] = defaultdict(set)
+    # (name for messages, separate object key, volume number) to restore
+    jobs: List[Tuple[str, Optional[str], Optional[int]]] = []
+    for name, entry in index["files"].items():
+        if "object" in entry:
+            jobs.append((name, entry["object"], None))
+        else:
+            chunks[entry["volume"]].add((entry["offset"], entry["length"]))
+    jobs.extend((index["volumes"][volume], None, volume) for volume in sorted(chunks))
+
+    def restore_volume(volume: int):
+        response = backup_context.s3.get_object(
+            Bucket=bucket, Key=prefix + "/" + index["volumes"][volume]
+        )
+        position = 0
+        for offset, length in sorted(chunks[volume]):
+            _skip(response["Body"], offset - position)
+            position = offset + length
+            ciphertext = read_exactly(response["Body"], length, required=True)
+            with _open_chunk(backup_context, ciphertext) as tar:
+                for member in tar.getmembers():
+                    _extract(tar, member, _tree_path(dest_directory, "", member.name))
+
+    def job_key(job) -> str:
+        name, key, volume = job
+        return prefix + "/" + (key if volume is None else index["volumes"][volume])
+
+    def restore_one(job):
+        name, key, volume = job
+        if volume is not None:
+            restore_volume(volume)
+        else:
+            restore_object_to_file(
+                backup_context,
+                bucket,
+                prefix + "/" + key,
+                _tree_path(dest_directory, "", name),
+                **kwargs
+            )
+        journal.record(job_key(job), index_etag)
+
+    remaining = [job for job in jobs if not journal.finished(job_key(job), index_etag)]
+    if len(remaining) < len(jobs):
+        eprint("{} volumes and objects already done".format(len(jobs) - len(remaining)))
+    try:
+        failures = run_bounded(
+            restore_one, remaining, workers, name=lambda job: job[0], what="restore"
+        )
+    finally:
+        journal.close()
+    if failures:
+        eprint("run the restore again to retry; finished volumes will be skipped")
+        raise RestoreError(failures)
+    os.unlink(journal_path)
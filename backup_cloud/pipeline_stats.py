@@ -0,0 +1,229 @@
+"""timings for each stage of the backup pipeline
+
+A streamed backup passes data through stages running in separate
+threads: reading the source (or downloading it with ranged GETs),
+encryption, which includes any compression, and the S3 part uploads.
+The stages are joined by OS pipes.  When a backup is slow the stage
+which limits it is busy most of the time while the stages next to it
+sit blocked on the pipes waiting for it.
+
+PipelineStats counts the bytes, calls and seconds of every stage.
+For the pipe stages (download_pipe_write, encrypt_pipe_read and so on)
+the seconds are time blocked on the pipe: a writer blocked means the
+stage after the pipe can't keep up, a reader blocked means it is
+starved by the stage before.  report() summarises this as a
+dictionary ready to be written as JSON.
+
+Turn it on with BackupContext(instrument=True).  The timed streams are
+Python objects, so gpgme can't use file descriptors directly while
+stats are collected, which costs a little throughput.
+"""
+
+import json
+import sys
+import time
+from contextlib import contextmanager
+from threading import Lock, local
+from typing import Dict, Iterator, List, Optional
+
+# stages which do work rather than waiting on a pipe
+WORK_STAGES = ["source_read", "download", "encrypt", "part_upload"]
+# pipe: (stage writing into it, stage reading from it)
+PIPES = {
+    "download_pipe": ("download", "encrypt"),
+    "encrypt_pipe": ("encrypt", "part_upload"),
+}
+# S3 calls timed as part_upload
+UPLOAD_OPERATIONS = ["PutObject", "UploadPart"]
+
+_CONTEXT_KEY = "backup_cloud_upload_start"
+
+
+def _body_size(body) -> int:
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+
+class _Work:
+    """the bytes handled inside one PipelineStats.work() block"""
+
+    def __init__(self):
+        self.amount = 0
+
+
+class _TimedReader:
+    def __init__(self, stats: "PipelineStats", stream, stage: str):
+        self.stats = stats
+        self.stream = stream
+        self.stage = stage
+        self.count = 0
+
+    def read(self, amount=-1):
+        start = time.perf_counter()
+        data = self.stream.read(amount)
+        self.count += len(data)
+        self.stats._wait(self.stage, time.perf_counter() - start, len(data))
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+class _TimedWriter:
+    def __init__(self, stats: "PipelineStats", stream, stage: str):
+        self.stats = stats
+        self.stream = stream
+        self.stage = stage
+        self.count = 0
+
+    def write(self, data):
+        start = time.perf_counter()
+        count = self.stream.write(data)
+        self.count += len(data)
+        self.stats._wait(self.stage, time.perf_counter() - start, len(data))
+        return count
+
+    def flush(self):
+        start = time.perf_counter()
+        self.stream.flush()
+        self.stats._wait(self.stage, time.perf_counter() - start, 0, calls=0)
+
+    def close(self):
+        self.stream.close()
+
+
+class PipelineStats:
+    """bytes, calls and seconds for every pipeline stage of a run
+
+    thread safe; any number of backups running at once may record
+    into the same stats, which then add up across them.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stages: Dict[str, List] = {}
+        self._local = local()
+        self._start = time.monotonic()
+
+    def add(self, stage: str, seconds: float, amount: int = 0, calls: int = 1) -> None:
+        with self._lock:
+            totals = self._stages.setdefault(stage, [0, 0.0, 0])
+            totals[0] += amount
+            totals[1] += seconds
+            totals[2] += calls
+
+    def _waited(self) -> float:
+        return getattr(self._local, "waited", 0.0)
+
+    def _wait(self, stage: str, seconds: float, amount: int, calls: int = 1) -> None:
+        # time in timed streams isn't work for any enclosing work() block
+        self._local.waited = self._waited() + seconds
+        self.add(stage, seconds, amount, calls)
+
+    @contextmanager
+    def work(self, stage: str) -> Iterator[_Work]:
+        """time the block as stage
+
+        time this thread spends in timed streams within the block is
+        left out.  Set amount on the object given to count bytes.
+        """
+        work = _Work()
+        waited = self._waited()
+        start = time.perf_counter()
+        try:
+            yield work
+        finally:
+            seconds = time.perf_counter() - start - (self._waited() - waited)
+            self.add(stage, seconds, work.amount)
+
+    def reader(self, stream, stage: str):
+        """wrap stream so the time spent in read() is counted as stage"""
+        return _TimedReader(self, stream, stage)
+
+    def writer(self, stream, stage: str):
+        """wrap stream so the time spent in write() is counted as stage"""
+        return _TimedWriter(self, stream, stage)
+
+    def _upload_started(self, params, context, **kwargs) -> None:
+        context[_CONTEXT_KEY] = (time.perf_counter(), _body_size(params.get("Body")))
+
+    def _upload_finished(self, context, **kwargs) -> None:
+        started = context.pop(_CONTEXT_KEY, None)
+        if started is not None:
+            start, amount = started
+            self.add("part_upload", time.perf_counter() - start, amount)
+
+    def watch_client(self, client) -> None:
+        """time the uploads made through a botocore S3 client as part_upload"""
+        events = client.meta.events
+        for operation in UPLOAD_OPERATIONS:
+            events.register(
+                "before-parameter-build.s3." + operation,
+                self._upload_started,
+                unique_id="backup-cloud-stats-start-%d-%s" % (id(self), operation),
+            )
+            events.register(
+                "after-call.s3." + operation,
+                self._upload_finished,
+                unique_id="backup-cloud-stats-finish-%d-%s" % (id(self), operation),
+            )
+
+    def report(self) -> Dict:
+        """summary of the run so far
+
+        stages gives the totals for each stage.  bottleneck is the
+        working stage which spent longest busy and pipes says for each
+        pipe which side of it held the other up.
+        """
+        elapsed = time.monotonic() - self._start
+        stages = {}
+        with self._lock:
+            for name, (amount, seconds, calls) in sorted(self._stages.items()):
+                stages[name] = {
+                    "bytes": amount,
+                    "calls": calls,
+                    "seconds": round(seconds, 3),
+                    "mb_per_s": (
+                        round(amount / seconds / 1024 / 1024, 2)
+                        if seconds > 0
+                        else None
+                    ),
+                }
+        busy = {name: stages[name]["seconds"] for name in WORK_STAGES if name in stages}
+        pipes = {}
+        for pipe, (producer, consumer) in PIPES.items():
+            write = stages.get(pipe + "_write")
+            read = stages.get(pipe + "_read")
+            if write is None and read is None:
+                continue
+            write_blocked = write["seconds"] if write else 0.0
+            read_blocked = read["seconds"] if read else 0.0
+            pipes[pipe] = {
+                "producer": producer,
+                "consumer": consumer,
+                "write_blocked_seconds": write_blocked,
+                "read_blocked_seconds": read_blocked,
+                # a blocked writer is held back by the consumer
+                "limited_by": consumer if write_blocked > read_blocked else producer,
+            }
+        bottleneck: Optional[str] = (
+            max(busy, key=lambda stage: busy[stage]) if busy else None
+        )
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "stages": stages,
+            "pipes": pipes,
+            "bottleneck": bottleneck,
+        }
+
+    def write_report(self, path: str) -> None:
+        """write report() as JSON to path, or to standard error for -"""
+        if path == "-":
+            json.dump(self.report(), sys.stderr, indent=2, sort_keys=True)
+            sys.stderr.write("\n")
+            return
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+            f.write("\n")
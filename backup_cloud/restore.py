@@ -0,0 +1,384 @@
+import json
+import os
+import sys
+import time
+from tempfile import NamedTemporaryFile
+from threading import Lock, Thread
+from typing import Dict, Iterable, List, Optional, Tuple
+from backup_cloud.base import (
+    CODEC_METADATA,
+    BackupContext,
+    bounded_transfer_config,
+    run_bounded,
+)
+from backup_cloud.compress import DecompressingWriter
+from backup_cloud.s3 import (
+    DEFAULT_DOWNLOAD_WORKERS,
+    DEFAULT_PART_SIZE,
+    DEFAULT_PROGRESS_INTERVAL,
+    DEFAULT_READ_AHEAD,
+    _download_worker,
+    list_objects_parallel,
+)
+from backup_cloud.segment import (
+    SEGMENT_DIR_SUFFIX,
+    SEGMENT_MANIFEST_SUFFIX,
+    restore_segmented_to_stream,
+)
+
+# name of the record of finished objects kept in a directory being restored
+RESTORE_JOURNAL = ".backup-cloud-restore"
+# prefix of the temporary files objects are restored into
+TEMP_PREFIX = ".restore-"
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+class RestoreError(Exception):
+    """one or more objects failed to restore
+
+    failures: list of (object key, exception) pairs
+    """
+
+    def __init__(self, failures: List[Tuple[str, Exception]]):
+        self.failures = failures
+        super().__init__(
+            str(len(failures))
+            + " object(s) failed to restore: "
+            + ", ".join([name for name, _e in failures[:10]])
+        )
+
+
+def restore_object_to_stream(
+    backup_context: BackupContext,
+    bucket: str,
+    key: str,
+    sink_stream,
+    part_size: int = DEFAULT_PART_SIZE,
+    download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    read_ahead: int = DEFAULT_READ_AHEAD,
+    progress_interval: float = DEFAULT_PROGRESS_INTERVAL,
+    segmented: bool = False,
+) -> None:
+    """download and decrypt one backup object into a stream
+
+    The object is fetched in a separate thread as parts of part_size
+    bytes with up to download_workers ranged GETs at once (see
+    backup_cloud.s3.backup_s3_to_s3()) and piped through gpgme into
+    sink_stream, so memory use does not depend on the size of the
+    object.  Backups which were compressed before encryption are
+    decompressed with the codec named in the object's metadata.
+
+    segmented restores a backup written in segments instead, fetching
+    download_workers segments at a time and decrypting them on all
+    cores (see backup_cloud.segment.restore_segmented_to_stream()).
+    """
+    if segmented:
+        restore_segmented_to_stream(
+            backup_context, bucket, key, sink_stream, transfer_workers=download_workers
+        )
+        return
+
+    r_download, w_download = os.pipe()
+    r_download_file = os.fdopen(r_download, mode="rb")
+    w_download_file = os.fdopen(w_download, mode="wb")
+
+    download_errors: List[Exception] = []
+    source_info: Dict = {}
+    download_thread = Thread(
+        target=_download_worker,
+        args=(backup_context, bucket, key, w_download_file, download_errors),
+        kwargs=dict(
+            part_size=part_size,
+            workers=download_workers,
+            read_ahead=read_ahead,
+            progress_interval=progress_interval,
+            source_info=source_info,
+        ),
+        daemon=True,
+    )
+    download_thread.start()
+
+    # the download records the metadata before any data reaches us
+    plaintext_stream = DecompressingWriter(
+        sink_stream, lambda: source_info.get("metadata", {}).get(CODEC_METADATA)
+    )
+    decrypt_error: Optional[Exception] = None
+    try:
+        backup_context.decrypt_stream(r_download_file, plaintext_stream)
+        plaintext_stream.finish()
+    except Exception as e:
+        decrypt_error = e
+    finally:
+        # unblock the download if decryption stopped reading early
+        r_download_file.close()
+        download_thread.join()
+
+    # each failure causes the other; report the one which came first
+    if download_errors and not isinstance(download_errors[0], BrokenPipeError):
+        raise download_errors[0]
+    if decrypt_error is not None:
+        raise decrypt_error
+    if download_errors:
+        raise download_errors[0]
+
+
+def restore_object_to_file(
+    backup_context: BackupContext, bucket: str, key: str, dest_file: str, **kwargs
+) -> None:
+    """download and decrypt one backup object into a local file
+
+    The data is written to a temporary file next to dest_file which
+    is only renamed into place once it is complete, so dest_file never
+    holds a partial restore.
+    """
+    directory = os.path.dirname(os.path.abspath(dest_file))
+    os.makedirs(directory, exist_ok=True)
+    with NamedTemporaryFile(
+        "wb", dir=directory, prefix=TEMP_PREFIX, delete=False
+    ) as temp_file:
+        try:
+            restore_object_to_stream(backup_context, bucket, key, temp_file, **kwargs)
+        except Exception:
+            os.unlink(temp_file.name)
+            raise
+    os.replace(temp_file.name, dest_file)
+
+
+def _restore_worker(backup_context, bucket, key, plaintext_stream, errors, kwargs):
+    try:
+        restore_object_to_stream(
+            backup_context, bucket, key, plaintext_stream, **kwargs
+        )
+    except Exception as e:
+        eprint("restore of s3://" + bucket + "/" + key + " failed: " + repr(e))
+        errors.append(e)
+    finally:
+        try:
+            plaintext_stream.close()
+        except BrokenPipeError:
+            pass
+
+
+def restore_object_to_s3(
+    backup_context: BackupContext,
+    bucket: str,
+    key: str,
+    dest_bucket: str,
+    dest_key: str,
+    transfer_config=None,
+    **kwargs
+) -> None:
+    """download and decrypt one backup object into another S3 object
+
+    The decrypted data is piped straight into a multipart upload; if
+    the restore fails the incomplete object is deleted.
+    """
+    r_plain, w_plain = os.pipe()
+    r_plain_file = os.fdopen(r_plain, mode="rb")
+    w_plain_file = os.fdopen(w_plain, mode="wb")
+
+    errors: List[Exception] = []
+    restore_thread = Thread(
+        target=_restore_worker,
+        args=(backup_context, bucket, key, w_plain_file, errors, kwargs),
+        daemon=True,
+    )
+    restore_thread.start()
+
+    if transfer_config is None:
+        transfer_config = bounded_transfer_config()
+    dest_obj = backup_context.s3_resource().Object(dest_bucket, dest_key)
+    try:
+        dest_obj.upload_fileobj(r_plain_file, Config=transfer_config)
+    finally:
+        r_plain_file.close()
+        restore_thread.join()
+
+    if errors:
+        eprint("removing incomplete restored object: " + dest_key)
+        dest_obj.delete()
+        raise errors[0]
+
+
+def _tree_path(dest_directory: str, prefix: str, key: str) -> str:
+    """local path for key, relative to prefix, under dest_directory"""
+    relative = key.replace(prefix, "", 1)
+    parts = [part for part in relative.split("/") if part]
+    if not parts or any(part in (".", "..") for part in parts):
+        raise Exception("refusing to restore unsafe object name: " + key)
+    return os.path.join(dest_directory, *parts)
+
+
+class RestoreJournal:
+    """record of the objects already restored into a directory
+
+    One JSON line with the key and ETag is appended as each object
+    finishes so that after an interruption restore_tree() can skip
+    them.  A torn last line from a crash is ignored.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Dict[str, str] = {}
+        self._lock = Lock()
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.done[entry["key"]] = entry["etag"]
+        except FileNotFoundError:
+            pass
+        self._file = open(path, "a")
+
+    def finished(self, key: str, etag: str) -> bool:
+        return key in self.done and self.done[key] == etag
+
+    def record(self, key: str, etag: str) -> None:
+        with self._lock:
+            self._file.write(json.dumps(dict(key=key, etag=etag)) + "\n")
+            self._file.flush()
+            self.done[key] = etag
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def _logical_objects(listing: Iterable[Dict]) -> List[Dict]:
+    """turn a listing into the backups it holds
+
+    A segmented backup is listed as its manifest along with either its
+    numbered segment objects or, for resumable uploads, one object of
+    concatenated segments.  Each becomes a single entry marked
+    segmented, with the manifest's ETag and the total size.
+    """
+    listed = list(listing)
+    manifests = {}
+    for obj in listed:
+        if obj["Key"].endswith(SEGMENT_MANIFEST_SUFFIX):
+            key = obj["Key"][: -len(SEGMENT_MANIFEST_SUFFIX)]
+            manifests[key] = dict(Key=key, Size=0, ETag=obj.get("ETag"), segmented=True)
+    objects = list(manifests.values())
+    for obj in listed:
+        key = obj["Key"]
+        if key.endswith(SEGMENT_MANIFEST_SUFFIX):
+            continue
+        base = key.split(SEGMENT_DIR_SUFFIX)[0]
+        if key in manifests or (SEGMENT_DIR_SUFFIX in key and base in manifests):
+            manifests[base]["Size"] += obj["Size"]
+            continue
+        objects.append(obj)
+    return objects
+
+
+def _remove_partial_restores(dest_directory: str) -> None:
+    """delete temporary files left by an interrupted restore"""
+    for subdir, _dirs, files in os.walk(dest_directory):
+        for file in files:
+            if file.startswith(TEMP_PREFIX):
+                os.unlink(os.path.join(subdir, file))
+
+
+def restore_tree(
+    backup_context: BackupContext,
+    bucket: str,
+    prefix: str,
+    dest_directory: str,
+    workers: int = 1,
+    list_workers: int = 8,
+    journal_path: Optional[str] = None,
+    layout: Optional[Dict[str, str]] = None,
+    **kwargs
+) -> None:
+    """restore every object under prefix into dest_directory
+
+    This reverses upload_path(): each object is decrypted into the
+    file at its path relative to prefix.  The whole prefix is listed
+    first and the largest objects are started first so that one big
+    file doesn't hold up the end of the restore.  workers objects are
+    restored at a time; failures don't stop the others and are raised
+    together as a RestoreError at the end.  Other keyword arguments
+    are passed to restore_object_to_file().  Segmented and resumable
+    backups are each restored as the one file they were made from.
+
+    Finished objects are recorded in a RestoreJournal (by default
+    RESTORE_JOURNAL in dest_directory) so that running the same
+    restore again after an interruption or failures only does what
+    is left.  The journal is removed once everything is restored.
+
+    layout, for sharded uploads, maps each object key to its path in
+    the tree instead; objects not in it are left alone.
+    """
+    prefix = prefix.rstrip("/") + "/"
+    if journal_path is None:
+        journal_path = os.path.join(dest_directory, RESTORE_JOURNAL)
+    os.makedirs(dest_directory, exist_ok=True)
+    resuming = os.path.exists(journal_path)
+    journal = RestoreJournal(journal_path)
+    if resuming:
+        eprint("resuming restore recorded in " + journal_path)
+        _remove_partial_restores(dest_directory)
+
+    start = time.monotonic()
+    listing = list_objects_parallel(
+        backup_context.s3, bucket, prefix, workers=list_workers
+    )
+    objects = []
+    skipped = 0
+    for obj in _logical_objects(listing):
+        if layout is not None and obj["Key"] not in layout:
+            continue
+        if journal.finished(obj["Key"], obj.get("ETag", "")):
+            skipped += 1
+        else:
+            objects.append(obj)
+    objects.sort(key=lambda obj: obj["Size"], reverse=True)
+    restored_bytes = 0
+    bytes_lock = Lock()
+
+    def restore_one(obj):
+        nonlocal restored_bytes
+        if layout is not None:
+            dest_file = _tree_path(dest_directory, "", layout[obj["Key"]])
+        else:
+            dest_file = _tree_path(dest_directory, prefix, obj["Key"])
+        restore_object_to_file(
+            backup_context,
+            bucket,
+            obj["Key"],
+            dest_file,
+            segmented=obj.get("segmented", False),
+            **kwargs
+        )
+        journal.record(obj["Key"], obj.get("ETag", ""))
+        with bytes_lock:
+            restored_bytes += obj["Size"]
+
+    try:
+        failures = run_bounded(
+            restore_one, objects, workers, name=lambda obj: obj["Key"], what="restore"
+        )
+    finally:
+        journal.close()
+
+    elapsed = time.monotonic() - start
+    eprint(
+        "restored {} objects, {} encrypted bytes in {:.1f}s ({:.1f} MB/s)"
+        ", {} already done, {} failed".format(
+            len(objects) - len(failures),
+            restored_bytes,
+            elapsed,
+            restored_bytes / elapsed / 1024 / 1024 if elapsed else 0.0,
+            skipped,
+            len(failures),
+        )
+    )
+    if failures:
+        eprint("run the restore again to retry; finished objects will be skipped")
+        raise RestoreError(failures)
+    os.unlink(journal_path)
@@ -0,0 +1,404 @@
+"""multipart uploads which can carry on after a crash
+
+A normal streamed upload is one OpenPGP message, which can't be
+continued part way through, so an interrupted upload of a huge object
+has to start again from nothing.  Resumable uploads are encrypted as
+independent segments (see backup_cloud.segment) gathered into the
+parts of an S3 multipart upload.  Every part ends on a segment
+boundary, so after each part is uploaded a local checkpoint records
+the upload id, the ETags of the finished parts and how far into the
+source they reach.  Run again with the same source and destination,
+the upload is picked up from the checkpoint and only the data after
+the last finished part is read and encrypted again.
+
+The object is a series of OpenPGP messages; its segment manifest
+(DEST + SEGMENT_MANIFEST_SUFFIX) lists their offsets and sizes and
+the restore_*() methods decrypt it like any other segmented backup.
+
+abort_abandoned_uploads() removes the multipart uploads of runs which
+never came back, which otherwise go on being charged for.
+"""
+
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from tempfile import NamedTemporaryFile
+from typing import Callable, Dict, List, Optional
+from botocore.exceptions import ClientError  # type: ignore
+from backup_cloud.base import BackupContext, _clean_s3_path, read_exactly
+from backup_cloud.segment import (
+    DEFAULT_SEGMENT_SIZE,
+    SEGMENT_MANIFEST_SUFFIX,
+    SEGMENT_VERSION,
+    segment_metadata,
+)
+
+CHECKPOINT_VERSION = 1
+# S3 refuses parts smaller than this except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+# encrypted bytes gathered into each part
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+# multipart uploads started longer ago than this are presumed abandoned
+ABANDONED_UPLOAD_AGE = 7 * 24 * 3600.0
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def default_resume_state_dir() -> str:
+    """return the standard location for upload checkpoints
+
+    $BACKUP_CLOUD_RESUME_STATE if set, otherwise under
+    $XDG_CACHE_HOME (normally ~/.cache).
+    """
+    if os.environ.get("BACKUP_CLOUD_RESUME_STATE"):
+        return os.environ["BACKUP_CLOUD_RESUME_STATE"]
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "backup-cloud", "uploads")
+
+
+class UploadCheckpoint:
+    """local record of a resumable upload to one S3 object
+
+    The state is rewritten atomically after every part so a crash
+    leaves either the old or the new record, never a torn one.
+    """
+
+    def __init__(self, base_dir: str, bucket: str, key: str):
+        os.makedirs(base_dir, mode=0o700, exist_ok=True)
+        location = hashlib.sha256((bucket + "/" + key).encode("utf-8"))
+        self.path = os.path.join(base_dir, location.hexdigest()[:32] + ".json")
+
+    def load(self) -> Optional[Dict]:
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            eprint("ignoring corrupt upload checkpoint: " + self.path)
+            return None
+        if state.get("version") != CHECKPOINT_VERSION:
+            eprint("ignoring upload checkpoint of unknown version: " + self.path)
+            return None
+        return state
+
+    def save(self, state: Dict) -> None:
+        directory = os.path.dirname(self.path)
+        with NamedTemporaryFile("w", dir=directory, delete=False) as f:
+            json.dump(state, f)
+        os.replace(f.name, self.path)
+
+    def remove(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _FullReads:
+    """a stream whose reads only come up short at the end
+
+    so that every segment but the last is exactly segment_size and
+    source offsets can be worked out from segment counts.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, amount: int) -> bytes:
+        return read_exactly(self.stream, amount)
+
+
+def _checkpointed_upload_ids(state_dir: str) -> List[str]:
+    upload_ids = []
+    try:
+        names = os.listdir(state_dir)
+    except FileNotFoundError:
+        return []
+    for name in names:
+        try:
+            with open(os.path.join(state_dir, name)) as f:
+                upload_ids.append(json.load(f)["upload_id"])
+        except (OSError, ValueError, KeyError):
+            continue
+    return upload_ids
+
+
+def _can_resume(client, state: Dict, source_id: str, segment_size: int) -> bool:
+    """true if state is for this source and S3 still has all its parts"""
+    if state["source_id"] != source_id or state["segment_size"] != segment_size:
+        eprint("upload checkpoint is for a different source; starting again")
+        return False
+    uploaded = {}
+    try:
+        paginator = client.get_paginator("list_parts")
+        for page in paginator.paginate(
+            Bucket=state["bucket"], Key=state["key"], UploadId=state["upload_id"]
+        ):
+            for part in page.get("Parts", []):
+                uploaded[part["PartNumber"]] = part["ETag"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchUpload"):
+            raise
+        eprint("checkpointed upload of " + state["key"] + " has gone; starting again")
+        return False
+    if any(uploaded.get(p["part_number"]) != p["etag"] for p in state["parts"]):
+        eprint("parts of " + state["key"] + " are missing in S3; starting again")
+        return False
+    return True
+
+
+def backup_stream_resumable(
+    backup_context: BackupContext,
+    open_source: Callable[[int], object],
+    source_id: str,
+    dest_bucket: str,
+    dest_key: str,
+    state_dir: Optional[str] = None,
+    segment_size: int = DEFAULT_SEGMENT_SIZE,
+    part_size: int = DEFAULT_PART_SIZE,
+    processes: Optional[int] = None,
+) -> Dict:
+    """upload a source as a multipart upload which survives being interrupted
+
+    open_source(offset) returns a stream of the source starting offset
+    bytes in and source_id identifies the source's content (e.g. its
+    path, size and modification time) so that a checkpoint is never
+    applied to different data.  Segments of segment_size are
+    encrypted on all cores and gathered into parts of at least
+    part_size encrypted bytes.  The checkpoint is kept in state_dir
+    and removed once the object is complete.  Returns the segment
+    manifest.
+    """
+    if part_size < MIN_PART_SIZE:
+        raise Exception("part_size must be at least " + str(MIN_PART_SIZE))
+    metadata = segment_metadata(backup_context)
+    client = backup_context.s3
+    dest_key = _clean_s3_path(dest_key)
+    checkpoint = UploadCheckpoint(
+        state_dir or default_resume_state_dir(), dest_bucket, dest_key
+    )
+    state = checkpoint.load()
+    if state is not None and not _can_resume(client, state, source_id, segment_size):
+        try:
+            client.abort_multipart_upload(
+                Bucket=dest_bucket, Key=dest_key, UploadId=state["upload_id"]
+            )
+        except ClientError:
+            pass
+        state = None
+    if state is None:
+        response = client.create_multipart_upload(
+            Bucket=dest_bucket, Key=dest_key, Metadata=metadata
+        )
+        state = dict(
+            version=CHECKPOINT_VERSION,
+            bucket=dest_bucket,
+            key=dest_key,
+            source_id=source_id,
+            segment_size=segment_size,
+            upload_id=response["UploadId"],
+            parts=[],
+        )
+        checkpoint.save(state)
+    elif state["parts"]:
+        eprint(
+            "resuming upload of {} after part {}".format(
+                dest_key, state["parts"][-1]["part_number"]
+            )
+        )
+
+    offset = state["parts"][-1]["source_end"] if state["parts"] else 0
+
+    def upload_part(ciphertexts: List[bytes]) -> None:
+        nonlocal offset
+        body = b"".join(ciphertexts)
+        number = len(state["parts"]) + 1
+        response = client.upload_part(
+            Bucket=dest_bucket,
+            Key=dest_key,
+            UploadId=state["upload_id"],
+            PartNumber=number,
+            Body=body,
+            ContentLength=len(body),
+        )
+        # every segment but the last of the source is full
+        offset += len(ciphertexts) * segment_size
+        state["parts"].append(
+            dict(
+                part_number=number,
+                etag=response["ETag"],
+                source_end=offset,
+                segments=[len(c) for c in ciphertexts],
+            )
+        )
+        checkpoint.save(state)
+
+    source = open_source(offset)
+    encrypted = backup_context.encrypt_segments(
+        _FullReads(source), segment_size, processes
+    )
+    pending: List[bytes] = []
+    pending_bytes = 0
+    try:
+        for ciphertext in encrypted:
+            pending.append(ciphertext)
+            pending_bytes += len(ciphertext)
+            if pending_bytes >= part_size:
+                upload_part(pending)
+                pending = []
+                pending_bytes = 0
+        if pending or not state["parts"]:
+            upload_part(pending)
+    except Exception:
+        eprint("upload of " + dest_key + " interrupted; run again to resume it")
+        raise
+    finally:
+        encrypted.close()
+        close = getattr(source, "close", None)
+        if close is not None:
+            close()
+
+    client.complete_multipart_upload(
+        Bucket=dest_bucket,
+        Key=dest_key,
+        UploadId=state["upload_id"],
+        MultipartUpload={
+            "Parts": [
+                {"PartNumber": p["part_number"], "ETag": p["etag"]}
+                for p in state["parts"]
+            ]
+        },
+    )
+    segments = []
+    position = 0
+    for part in state["parts"]:
+        for size in part["segments"]:
+            segments.append(dict(key=dest_key, offset=position, size=size))
+            position += size
+    manifest = dict(
+        version=SEGMENT_VERSION, segment_size=segment_size, segments=segments
+    )
+    body = json.dumps(manifest, sort_keys=True).encode("utf-8")
+    client.put_object(
+        Bucket=dest_bucket,
+        Key=dest_key + SEGMENT_MANIFEST_SUFFIX,
+        Body=body,
+        ContentLength=len(body),
+    )
+    checkpoint.remove()
+    eprint(
+        "uploaded {} in {} parts of {} segments".format(
+            dest_key, len(state["parts"]), len(segments)
+        )
+    )
+    return manifest
+
+
+def backup_file_resumable(
+    backup_context: BackupContext,
+    src_file: str,
+    dest_bucket: str,
+    dest_key: str,
+    **kwargs
+) -> Dict:
+    """backup a local file with backup_stream_resumable()
+
+    the file is identified by its path, size and modification time.
+    """
+    st = os.stat(src_file)
+    source_id = "file:{}:{}:{}".format(
+        os.path.realpath(src_file), st.st_size, st.st_mtime_ns
+    )
+
+    def open_source(offset: int):
+        f = open(src_file, "rb")
+        f.seek(offset)
+        return f
+
+    return backup_stream_resumable(
+        backup_context, open_source, source_id, dest_bucket, dest_key, **kwargs
+    )
+
+
+def backup_s3_resumable(
+    backup_context: BackupContext,
+    src_bucket: str,
+    src_key: str,
+    dest_bucket: str,
+    dest_key: str,
+    **kwargs
+) -> Dict:
+    """backup an S3 object with backup_stream_resumable()
+
+    The source is identified by its ETag and version and is read from
+    the resume point with a single ranged GET.  Returns the etag,
+    size, version_id and user metadata of the source, like
+    backup_cloud.s3.backup_s3_to_s3().
+    """
+    client = backup_context.s3
+    head = client.head_object(Bucket=src_bucket, Key=src_key)
+    options = dict(Bucket=src_bucket, Key=src_key, IfMatch=head["ETag"])
+    if head.get("VersionId"):
+        options["VersionId"] = head["VersionId"]
+    source_id = "s3://{}/{} {} {}".format(
+        src_bucket, src_key, head["ETag"], head.get("VersionId")
+    )
+
+    def open_source(offset: int):
+        if offset >= head["ContentLength"]:
+            return io.BytesIO()
+        response = client.get_object(Range="bytes={}-".format(offset), **options)
+        return response["Body"]
+
+    backup_stream_resumable(
+        backup_context, open_source, source_id, dest_bucket, dest_key, **kwargs
+    )
+    return dict(
+        etag=head["ETag"],
+        size=head["ContentLength"],
+        version_id=head.get("VersionId"),
+        metadata=head.get("Metadata", {}),
+    )
+
+
+def abort_abandoned_uploads(
+    backup_context: BackupContext,
+    bucket: str,
+    prefix: str,
+    max_age: float = ABANDONED_UPLOAD_AGE,
+    state_dir: Optional[str] = None,
+) -> int:
+    """abort multipart uploads under prefix started over max_age seconds ago
+
+    S3 keeps, and charges for, the parts of a multipart upload until
+    it is completed or aborted.  Uploads with a checkpoint in
+    state_dir are left alone since they can still be resumed from
+    here.  Returns the number of uploads aborted.
+    """
+    client = backup_context.s3
+    keep = set(_checkpointed_upload_ids(state_dir or default_resume_state_dir()))
+    now = time.time()
+    aborted = 0
+    paginator = client.get_paginator("list_multipart_uploads")
+    for page in paginator.paginate(Bucket=bucket, Prefix=_clean_s3_path(prefix)):
+        for upload in page.get("Uploads", []):
+            if upload["UploadId"] in keep:
+                continue
+            if now - upload["Initiated"].timestamp() < max_age:
+                continue
+            eprint(
+                "aborting abandoned upload of {} started {}".format(
+                    upload["Key"], upload["Initiated"]
+                )
+            )
+            client.abort_multipart_upload(
+                Bucket=bucket, Key=upload["Key"], UploadId=upload["UploadId"]
+            )
+            aborted += 1
+    return aborted
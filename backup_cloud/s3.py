@@ -1,45 +1,216 @@
-from backup_cloud.base import BackupContext, _encrypt_worker, _encrypt_worker_debug
-import boto3
+from backup_cloud.base import (
+    BackupContext,
+    ProgressLog,
+    UploadError,
+    _upload_encrypted_stream,
+    bounded_transfer_config,
+    run_bounded,
+)
+from backup_cloud.concurrency import DEFAULT_MAX_FACTOR, AdaptiveConcurrency
+from backup_cloud.manifest import (
+    ManifestState,
+    default_manifest_state_dir,
+    load_manifest,
+    manifest_key,
+    save_manifest,
+)
+from backup_cloud.pipeline_stats import PipelineStats
 from botocore.exceptions import ClientError  # type: ignore
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+import itertools
+import queue
+import re
 import sys
-from threading import Thread
+import time
+from threading import Thread, Event, Lock
 import os
+from typing import Callable, ContextManager, Dict, Iterator, List, Optional, Set
+
+# size of each ranged GET when downloading a source object
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+# ranged GETs running at the same time
+DEFAULT_DOWNLOAD_WORKERS = 4
+# parts downloaded ahead of the encryption stage; this times part_size
+# is roughly the most memory one download will use.
+DEFAULT_READ_AHEAD = 8
+# seconds between progress messages
+DEFAULT_PROGRESS_INTERVAL = 30.0
+# pages of listing results waiting for backup workers
+LISTING_QUEUE_PAGES = 16
 
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def _download_worker(backup_context, bucket: str, path: str, dest_stream):
-    # don't share resource with main thread for safety
-    s3 = boto3.resource("s3")
-    obj = s3.Object(bucket, path)
-    src_stream = obj.get()["Body"]
-    _streampush_worker(src_stream, dest_stream)
+def _read_into(stream, view: memoryview) -> int:
+    """fill view from stream, returning the bytes read; fewer only at the end
+
+    Streams with readinto(), such as files and S3 bodies, write
+    straight into view without making a new bytes object per read.
+    """
+    filled = 0
+    readinto = getattr(stream, "readinto", None)
+    while filled < len(view):
+        if readinto is not None:
+            count = readinto(view[filled:])
+        else:
+            chunk = stream.read(len(view) - filled)
+            count = len(chunk)
+            end = filled + count
+            view[filled:end] = chunk
+        if not count:
+            break
+        filled += count
+    return filled
+
 
+def _ranged_download(
+    client,
+    bucket: str,
+    path: str,
+    dest_stream,
+    part_size: int,
+    workers: int,
+    read_ahead: int,
+    progress: Optional[ProgressLog] = None,
+    on_head: Optional[Callable[[Dict], None]] = None,
+    stats: Optional[PipelineStats] = None,
+    limit: Optional[AdaptiveConcurrency] = None,
+) -> Dict:
+    """download an object with concurrent ranged GETs, writing it in order
 
-def _streampush_worker(src_stream, dest_stream):
-    """push from one streamlike object to another
+    At most read_ahead parts are in flight or waiting to be written so
+    memory use is bounded by read_ahead * part_size whatever the size
+    of the object.  Parts are read into buffers allocated once and
+    reused for later parts.  Every part is fetched with IfMatch on the ETag we
+    started with (and from the same version in versioned buckets) so a
+    change to the object part way through is an error rather than a
+    corrupt backup.
 
-    This is designed to run in a separate thread and push from one
-    streamlike object (only need to have a read() function) to
-    another.
+    Returns the HeadObject response for the object downloaded, which
+    is also passed to on_head before any data is written.  The time
+    taken by each ranged GET is counted in stats as download.
 
-    This allows us to convert a streaming object from S3 into a pipe.
+    With limit the number of ranged GETs running adapts between its
+    minimum and maximum (still no more than read_ahead) and parts
+    which fail with throttling or other temporary errors are fetched
+    again.
     """
+    head = client.head_object(Bucket=bucket, Key=path)
+    if on_head is not None:
+        on_head(head)
+    size = head["ContentLength"]
+    options = dict(Bucket=bucket, Key=path, IfMatch=head["ETag"])
+    if head.get("VersionId"):
+        options["VersionId"] = head["VersionId"]
+
+    # runs in the worker threads; the client is thread safe, unlike
+    # resources, so they can all share it
+    def get_range(start: int, buffer: bytearray) -> memoryview:
+        started = time.perf_counter()
+        length = min(part_size, size - start)
+        response = client.get_object(
+            Range="bytes={}-{}".format(start, start + length - 1), **options
+        )
+        view = memoryview(buffer)[:length]
+        if _read_into(response["Body"], view) != length:
+            raise Exception("short read of s3://" + bucket + "/" + path)
+        if stats is not None:
+            stats.add("download", time.perf_counter() - started, length)
+        return view
+
+    fetch = get_range
+    if limit is not None:
+        workers = limit.maximum
+        fetch = partial(limit.call, get_range)
+
+    # buffers whose data has been written and which can be reused
+    free_buffers: List[bytearray] = []
+    offsets = iter(range(0, size, part_size))
+    window: deque = deque()
+
+    def submit(start: int) -> None:
+        buffer = free_buffers.pop() if free_buffers else bytearray(part_size)
+        window.append((buffer, executor.submit(fetch, start, buffer)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for start in itertools.islice(offsets, max(read_ahead, 1)):
+                submit(start)
+            while window:
+                buffer, future = window.popleft()
+                data = future.result()
+                for start in itertools.islice(offsets, 1):
+                    submit(start)
+                dest_stream.write(data)
+                if progress is not None:
+                    progress.add(len(data))
+                data.release()
+                free_buffers.append(buffer)
+        finally:
+            for _buffer, future in window:
+                future.cancel()
+    return head
+
+
+def _download_worker(
+    backup_context,
+    bucket: str,
+    path: str,
+    dest_stream,
+    errors=None,
+    part_size: int = DEFAULT_PART_SIZE,
+    workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    read_ahead: int = DEFAULT_READ_AHEAD,
+    progress_interval: float = DEFAULT_PROGRESS_INTERVAL,
+    source_info: Optional[Dict] = None,
+    limit: Optional[AdaptiveConcurrency] = None,
+):
+    progress = ProgressLog(
+        "downloaded s3://" + bucket + "/" + path, interval=progress_interval
+    )
+
+    def record_head(head: Dict) -> None:
+        # before the data so that readers of the pipe can rely on it
+        if source_info is not None:
+            source_info.update(
+                etag=head["ETag"],
+                size=head["ContentLength"],
+                version_id=head.get("VersionId"),
+                metadata=head.get("Metadata", {}),
+            )
 
-    read_so_far: int = 0
-    chunk: bytes
-    for chunk in iter(lambda: src_stream.read(4096), b""):
-        read_so_far += len(chunk)
-        eprint("read " + str(read_so_far) + " bytes so far\n")
-        dest_stream.write(chunk)
     try:
+        _ranged_download(
+            backup_context.s3,
+            bucket,
+            path,
+            dest_stream,
+            part_size,
+            workers,
+            read_ahead,
+            progress,
+            on_head=record_head,
+            stats=backup_context.pipeline_stats,
+            limit=limit,
+        )
         dest_stream.flush()
-    except BrokenPipeError as e:
-        eprint("BrokenPipeError at end of plaintext stream; probably okay; ignoring")
-        raise e
-    dest_stream.close()
+        dest_stream.close()
+        progress.report(final=True)
+    except Exception as e:
+        eprint("download of s3://" + bucket + "/" + path + " failed: " + repr(e))
+        # closing lets the encryption stage see the end of the stream
+        try:
+            dest_stream.close()
+        except BrokenPipeError:
+            pass
+        if errors is None:
+            raise e
+        errors.append(e)
 
 
 def backup_s3_to_s3(
@@ -48,47 +219,127 @@ def backup_s3_to_s3(
     src_path: str,
     dest_bucket: str,
     dest_path: str,
-):
+    debug: bool = False,
+    part_size: int = DEFAULT_PART_SIZE,
+    download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    read_ahead: int = DEFAULT_READ_AHEAD,
+    progress_interval: float = DEFAULT_PROGRESS_INTERVAL,
+    transfer_config=None,
+    resumable: bool = False,
+    resume_state_dir: Optional[str] = None,
+    download_limit: Optional[AdaptiveConcurrency] = None,
+) -> Dict:
     """backup a single S3 object
 
     Take a single S3 object, download it, encrypt it and reupload it
-    into another S3 object.
+    into another S3 object.  The object is streamed all the way
+    through so memory use does not depend on the object size.  debug
+    reads the whole object into memory before encrypting.
+
+    The source is downloaded as parts of part_size bytes with up to
+    download_workers ranged GETs at once and at most read_ahead parts
+    held waiting for encryption.  Progress is logged every
+    progress_interval seconds.  download_limit, which can be shared
+    between objects, adapts the number of ranged GETs instead (see
+    backup_cloud.concurrency).
+
+    If the context compresses backups the object is compressed before
+    encryption when it looks worthwhile.  Returns the etag, size,
+    version_id and user metadata of the source object which was
+    backed up.
+
+    resumable copies the object in checkpointed parts instead so that
+    an interrupted backup carries on where it stopped when run again
+    (see backup_cloud.resumable.backup_s3_resumable()).
     """
+    if resumable:
+        from backup_cloud.resumable import backup_s3_resumable
 
+        return backup_s3_resumable(
+            backup_context,
+            src_bucket,
+            src_path,
+            dest_bucket,
+            dest_path,
+            state_dir=resume_state_dir,
+        )
+
+    source_info: Dict = {}
+    with backup_context._backup_object(lambda: source_info.get("size", 0)):
+        _backup_s3_object(
+            backup_context,
+            src_bucket,
+            src_path,
+            dest_bucket,
+            dest_path,
+            source_info,
+            debug=debug,
+            part_size=part_size,
+            download_workers=download_workers,
+            read_ahead=read_ahead,
+            progress_interval=progress_interval,
+            transfer_config=transfer_config,
+            download_limit=download_limit,
+        )
+    return source_info
+
+
+def _backup_s3_object(
+    backup_context: BackupContext,
+    src_bucket: str,
+    src_path: str,
+    dest_bucket: str,
+    dest_path: str,
+    source_info: Dict,
+    debug: bool,
+    part_size: int,
+    download_workers: int,
+    read_ahead: int,
+    progress_interval: float,
+    transfer_config,
+    download_limit: Optional[AdaptiveConcurrency],
+) -> None:
+    """the streamed copy behind backup_s3_to_s3(), filling in source_info"""
     (r_download, w_download) = os.pipe()
-    (r_encrypt, w_encrypt) = os.pipe()
 
-    r_download_file = os.fdopen(r_download, mode="rb")
+    # unbuffered so that gpgme can read the pipe itself
+    r_download_file = os.fdopen(r_download, mode="rb", buffering=0)
     w_download_file = os.fdopen(w_download, mode="wb")
-    r_encrypt_file = os.fdopen(r_encrypt, mode="rb")
-    w_encrypt_file = os.fdopen(w_encrypt, mode="wb")
+    download_sink = w_download_file
+    encrypt_source = r_download_file
+    stats = backup_context.pipeline_stats
+    if stats is not None:
+        download_sink = stats.writer(w_download_file, "download_pipe_write")
+        encrypt_source = stats.reader(r_download_file, "download_pipe_read")
 
+    download_errors: List[Exception] = []
     t1 = Thread(
         target=_download_worker,
-        args=(backup_context, src_bucket, src_path, w_download_file),
+        args=(backup_context, src_bucket, src_path, download_sink, download_errors),
+        kwargs=dict(
+            part_size=part_size,
+            workers=download_workers,
+            read_ahead=read_ahead,
+            progress_interval=progress_interval,
+            source_info=source_info,
+            limit=download_limit,
+        ),
         daemon=True,
     )
     t1.start()
-    debug = True
-    if debug:
-        target = _encrypt_worker_debug
-    else:
-        target = _encrypt_worker
-    t2 = Thread(
-        args=(backup_context, r_download_file, w_encrypt_file),
-        target=target,
-        daemon=True,
-    )
-    t2.start()
-
-    s3 = boto3.resource("s3")
-    dest_obj = s3.Object(dest_bucket, dest_path)
 
-    def callback(x):
-        eprint("uploaded " + str(x) + " bytes")
+    dest_obj = backup_context.s3_resource().Object(dest_bucket, dest_path)
 
     try:
-        dest_obj.upload_fileobj(r_encrypt_file, Callback=callback)
+        source_stream, metadata = backup_context.prepare_stream(encrypt_source)
+        _upload_encrypted_stream(
+            backup_context,
+            source_stream,
+            dest_obj,
+            debug=debug,
+            transfer_config=transfer_config,
+            metadata=metadata,
+        )
     except ClientError as e:
         eprint(
             "Failed to store: ",
@@ -102,3 +353,241 @@ def backup_s3_to_s3(
             " aborting.\n",
         )
         raise e
+    finally:
+        r_download_file.close()
+        t1.join()
+
+    if download_errors:
+        eprint("removing incomplete backup object: " + dest_obj.key)
+        dest_obj.delete()
+        raise download_errors[0]
+
+
+def list_objects_parallel(
+    client, bucket: str, prefix: str, workers: int = 8
+) -> Iterator[Dict]:
+    """list every object under prefix, spreading the listing over threads
+
+    The level directly below prefix is listed with a "/" delimiter and
+    each sub-prefix found is then listed in full by its own thread.
+    Objects are yielded as the ListObjectsV2 entries (Key, Size, ETag
+    ...) in no particular order.  Only a few pages are buffered so a
+    slow consumer holds the listing back rather than using memory.
+    """
+    sub_prefixes = []
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        for obj in page.get("Contents", []):
+            yield obj
+        for common in page.get("CommonPrefixes", []):
+            sub_prefixes.append(common["Prefix"])
+    if not sub_prefixes:
+        return
+
+    pages: queue.Queue = queue.Queue(maxsize=LISTING_QUEUE_PAGES)
+    stop = Event()
+
+    def list_sub_prefix(sub_prefix):
+        try:
+            sub_paginator = client.get_paginator("list_objects_v2")
+            for page in sub_paginator.paginate(Bucket=bucket, Prefix=sub_prefix):
+                if stop.is_set():
+                    break
+                pages.put(page.get("Contents", []))
+        finally:
+            pages.put(None)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(list_sub_prefix, x) for x in sub_prefixes]
+        try:
+            remaining = len(futures)
+            while remaining:
+                contents = pages.get()
+                if contents is None:
+                    remaining -= 1
+                    continue
+                for obj in contents:
+                    yield obj
+            for future in futures:
+                future.result()
+        finally:
+            # if we are abandoned, unblock listing threads so they can finish
+            stop.set()
+            while not all(future.done() for future in futures):
+                try:
+                    pages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+
+class PrefixBackupResult:
+    """counts and failures from backup_s3_prefix_to_s3"""
+
+    def __init__(self):
+        self.objects = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.failures: List = []
+        self.start = time.monotonic()
+        self.elapsed = 0.0
+        self._lock = Lock()
+
+    def add(self, size: int) -> None:
+        with self._lock:
+            self.objects += 1
+            self.bytes += size
+
+    def summary(self) -> str:
+        rate = self.bytes / self.elapsed / 1024 / 1024 if self.elapsed else 0.0
+        summary = (
+            "backed up {} objects, {} bytes in {:.1f}s ({:.1f} MB/s, {:.1f} objects/s)"
+            ", {} failed"
+        ).format(
+            self.objects,
+            self.bytes,
+            self.elapsed,
+            rate,
+            self.objects / self.elapsed if self.elapsed else 0.0,
+            len(self.failures),
+        )
+        if self.skipped:
+            summary += ", {} unchanged".format(self.skipped)
+        return summary
+
+
+def prefix_key_mapper(src_prefix: str, dest_prefix: str) -> Callable[[str], str]:
+    """map keys under src_prefix to the same relative keys under dest_prefix"""
+
+    def mapper(src_key: str) -> str:
+        relative = src_key
+        if src_key.startswith(src_prefix):
+            relative = src_key.replace(src_prefix, "", 1)
+        return re.sub("/{2,}", "/", dest_prefix + "/" + relative)
+
+    return mapper
+
+
+def backup_s3_prefix_to_s3(
+    backup_context: BackupContext,
+    src_bucket: str,
+    src_prefix: str,
+    dest_bucket: str,
+    dest_prefix: str,
+    workers: int = 4,
+    list_workers: int = 8,
+    key_mapper: Optional[Callable[[str], str]] = None,
+    incremental: bool = False,
+    state_dir: Optional[str] = None,
+    adaptive: bool = False,
+    max_workers: Optional[int] = None,
+    **kwargs
+) -> PrefixBackupResult:
+    """backup every object under an S3 prefix
+
+    Objects are listed in parallel (see list_objects_parallel()) and
+    fed to a pool of workers each running backup_s3_to_s3().  By
+    default each source key keeps its path relative to src_prefix
+    under dest_prefix; key_mapper can be given to choose destination
+    keys differently.  Other keyword arguments are passed on to
+    backup_s3_to_s3().
+
+    With incremental an encrypted manifest of the source key, ETag,
+    size and version of every object backed up is kept next to the
+    backup (see backup_cloud.manifest) and only objects which are new
+    or have changed since it was written are backed up.  Keys which
+    have gone from the source are recorded as deleted.  state_dir is
+    where the local copy of the manifest is kept.
+
+    adaptive starts with workers objects at once and adjusts that
+    between one and max_workers (by default four times workers), and
+    likewise the ranged GETs shared by all the objects, backing off
+    when S3 throttles us (see backup_cloud.concurrency).  Objects which
+    fail with temporary errors are tried again.
+
+    A summary is printed at the end.  If any object fails UploadError
+    is raised after all the others have been tried.
+    """
+    if key_mapper is None:
+        key_mapper = prefix_key_mapper(src_prefix, dest_prefix)
+    kwargs.setdefault("transfer_config", bounded_transfer_config())
+    result = PrefixBackupResult()
+
+    manifest = None
+    if incremental:
+        manifest_path = manifest_key(dest_prefix)
+        state = ManifestState(
+            state_dir or default_manifest_state_dir(), dest_bucket, manifest_path
+        )
+        manifest = load_manifest(
+            backup_context, state, dest_bucket, manifest_path, src_bucket, src_prefix
+        )
+
+    def backup_one(obj):
+        dest_key = key_mapper(obj["Key"])
+        try:
+            source_info = backup_s3_to_s3(
+                backup_context, src_bucket, obj["Key"], dest_bucket, dest_key, **kwargs
+            )
+        except Exception:
+            if manifest is not None:
+                manifest.forget(obj["Key"])
+            raise
+        if manifest is not None:
+            manifest.record(obj["Key"], source_info, dest_key)
+        result.add(obj["Size"])
+
+    listing = list_objects_parallel(
+        backup_context.s3, src_bucket, src_prefix, workers=list_workers
+    )
+    current_keys: Set[str] = set()
+    listing_complete = False
+
+    def changed_objects():
+        nonlocal listing_complete
+        for obj in listing:
+            current_keys.add(obj["Key"])
+            if manifest.changed(obj):
+                yield obj
+            else:
+                result.skipped += 1
+                backup_context._count_skipped()
+        listing_complete = True
+
+    limit = None
+    adapting: ContextManager = nullcontext()
+    if adaptive:
+        limit = AdaptiveConcurrency(
+            "backup", workers, max_workers or workers * DEFAULT_MAX_FACTOR
+        )
+        downloads = workers * kwargs.get("download_workers", DEFAULT_DOWNLOAD_WORKERS)
+        kwargs["download_limit"] = AdaptiveConcurrency(
+            "download", downloads, downloads * DEFAULT_MAX_FACTOR
+        )
+        adapting = backup_context.adapting(limit, kwargs["download_limit"])
+
+    try:
+        with adapting:
+            result.failures = run_bounded(
+                backup_one,
+                changed_objects() if manifest is not None else listing,
+                workers,
+                name=lambda obj: obj["Key"],
+                what="back up",
+                limit=limit,
+            )
+    finally:
+        # save what we did even if the listing failed part way through
+        if manifest is not None:
+            save_manifest(
+                backup_context,
+                state,
+                manifest,
+                dest_bucket,
+                manifest_path,
+                current_keys if listing_complete else None,
+            )
+    result.elapsed = time.monotonic() - result.start
+    eprint(result.summary())
+    if result.failures:
+        raise UploadError(result.failures)
+    return result
@@ -0,0 +1,255 @@
+import json
+import multiprocessing
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Generator, List, Optional
+import gpg  # type: ignore
+from botocore.exceptions import ClientError  # type: ignore
+from backup_cloud.base import BackupContext, _clean_s3_path
+
+SEGMENT_VERSION = 1
+# plaintext bytes in each independently encrypted segment
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+# the segments of DEST are stored as DEST + this + NNNNNN.gpg
+SEGMENT_DIR_SUFFIX = ".segments/"
+# and listed, in order, in DEST + this
+SEGMENT_MANIFEST_SUFFIX = ".segments.json"
+# segment uploads or downloads running at the same time
+DEFAULT_TRANSFER_WORKERS = 8
+
+# gpg state for the current pool process; set up by the initializers
+_worker_context = None
+_worker_keys: List = []
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def _init_encrypt_worker(home_dir: str, recipients: List[str], armor: bool) -> None:
+    global _worker_context, _worker_keys
+    _worker_context = gpg.Context(armor=armor)
+    _worker_context.home_dir = home_dir
+    _worker_keys = [_worker_context.get_key(r) for r in recipients]
+
+
+def _init_decrypt_worker(home_dir: Optional[str]) -> None:
+    global _worker_context
+    _worker_context = gpg.Context()
+    if home_dir is not None:
+        _worker_context.home_dir = home_dir
+
+
+def _encrypt_segment(plaintext: bytes) -> bytes:
+    assert _worker_context is not None, "pool process was not initialised"
+    ciphertext, _result, _sign_result = _worker_context.encrypt(
+        plaintext, recipients=_worker_keys, sign=False, always_trust=True
+    )
+    return ciphertext
+
+
+def _decrypt_segment(ciphertext: bytes) -> bytes:
+    assert _worker_context is not None, "pool process was not initialised"
+    plaintext, _result, _verify_result = _worker_context.decrypt(
+        ciphertext, verify=False
+    )
+    return plaintext
+
+
+def _segment_pool(processes: Optional[int], initializer, initargs):
+    # forking a process which is running upload and agent threads can
+    # copy a lock some other thread holds, so start clean interpreters
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=initializer,
+        initargs=initargs,
+    )
+
+
+def segment_metadata(backup_context: BackupContext) -> Dict[str, str]:
+    """format_metadata() for segmented objects
+
+    segments are always encrypted by gpg, so envelope encryption
+    can't be used.
+    """
+    if backup_context.envelope:
+        raise Exception(
+            "segmented and resumable backups cannot use envelope encryption"
+        )
+    encoding = "openpgp-armor" if backup_context.armor else "openpgp"
+    return backup_context.format_metadata(encoding=encoding)
+
+
+def segment_key(dest_path: str, number: int) -> str:
+    return dest_path + SEGMENT_DIR_SUFFIX + "{:06d}.gpg".format(number)
+
+
+def encrypt_segments(
+    backup_context: BackupContext,
+    source_stream,
+    segment_size: int = DEFAULT_SEGMENT_SIZE,
+    processes: Optional[int] = None,
+) -> Generator[bytes, None, None]:
+    """encrypt a stream as independent segments using every core
+
+    source_stream is read segment_size bytes at a time and each
+    segment is encrypted to our recipients as a separate OpenPGP
+    message in a pool of processes (one per core by default).  The
+    encrypted segments are yielded in order; only about two segments
+    per process are held in memory.
+    """
+    if backup_context.envelope:
+        raise Exception(
+            "segmented and resumable backups cannot use envelope encryption"
+        )
+    processes = processes or os.cpu_count() or 1
+    pool = _segment_pool(
+        processes,
+        _init_encrypt_worker,
+        (
+            backup_context.dirname,
+            backup_context.get_recipients(),
+            backup_context.armor,
+        ),
+    )
+    window: deque = deque()
+    with pool:
+        try:
+            for segment in iter(lambda: source_stream.read(segment_size), b""):
+                if len(window) >= processes * 2:
+                    yield window.popleft().result()
+                window.append(pool.submit(_encrypt_segment, segment))
+            while window:
+                yield window.popleft().result()
+        finally:
+            for future in window:
+                future.cancel()
+
+
+def backup_stream_segmented(
+    backup_context: BackupContext,
+    source_stream,
+    dest_bucket,
+    dest_path: str,
+    segment_size: int = DEFAULT_SEGMENT_SIZE,
+    processes: Optional[int] = None,
+    transfer_workers: int = DEFAULT_TRANSFER_WORKERS,
+) -> Dict:
+    """backup a stream to S3 in segments encrypted in parallel
+
+    For very large objects where a single gpg stream can't keep up
+    with the network.  The segments from encrypt_segments() are
+    uploaded as numbered objects, transfer_workers at a time, and
+    listed with their sizes in a manifest at dest_path +
+    SEGMENT_MANIFEST_SUFFIX which is written last.  If anything fails
+    the segments already uploaded are deleted.  Returns the manifest.
+    """
+    dest_path = _clean_s3_path(dest_path)
+    manifest: Dict = dict(version=SEGMENT_VERSION, segment_size=segment_size)
+    segments: List[Dict] = []
+    window: deque = deque()
+    metadata = segment_metadata(backup_context)
+
+    def upload_segment(key: str, ciphertext: bytes):
+        dest_bucket.Object(key).put(
+            Body=ciphertext, ContentLength=len(ciphertext), Metadata=metadata
+        )
+
+    try:
+        encrypted = encrypt_segments(
+            backup_context, source_stream, segment_size, processes
+        )
+        with ThreadPoolExecutor(max_workers=transfer_workers) as uploads:
+            try:
+                for number, ciphertext in enumerate(encrypted):
+                    if len(window) >= transfer_workers * 2:
+                        window.popleft().result()
+                    key = segment_key(dest_path, number)
+                    segments.append(dict(key=key, size=len(ciphertext)))
+                    window.append(uploads.submit(upload_segment, key, ciphertext))
+                while window:
+                    window.popleft().result()
+            finally:
+                for future in window:
+                    future.cancel()
+                # stops the encryption pool if we are giving up early
+                encrypted.close()
+        manifest["segments"] = segments
+        body = json.dumps(manifest, sort_keys=True).encode("utf-8")
+        dest_bucket.Object(dest_path + SEGMENT_MANIFEST_SUFFIX).put(
+            Body=body, ContentLength=len(body)
+        )
+    except Exception:
+        eprint("removing incomplete segmented backup: " + dest_path)
+        for segment in segments:
+            try:
+                dest_bucket.Object(segment["key"]).delete()
+            except ClientError:
+                pass
+        raise
+    eprint("uploaded " + dest_path + " as " + str(len(segments)) + " segments")
+    return manifest
+
+
+def is_segmented(backup_context: BackupContext, bucket: str, key: str) -> bool:
+    """true if key was written by backup_stream_segmented()"""
+    try:
+        backup_context.s3.head_object(Bucket=bucket, Key=key + SEGMENT_MANIFEST_SUFFIX)
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+        return False
+    return True
+
+
+def restore_segmented_to_stream(
+    backup_context: BackupContext,
+    bucket: str,
+    key: str,
+    sink_stream,
+    processes: Optional[int] = None,
+    transfer_workers: int = DEFAULT_TRANSFER_WORKERS,
+) -> None:
+    """download and decrypt a segmented backup into a stream
+
+    Segments are fetched transfer_workers at a time and decrypted in
+    a pool of processes, then written to sink_stream in order.  At
+    most about two segments per transfer worker are held in memory.
+    """
+    response = backup_context.s3.get_object(
+        Bucket=bucket, Key=key + SEGMENT_MANIFEST_SUFFIX
+    )
+    manifest = json.loads(response["Body"].read())
+    if manifest.get("version") != SEGMENT_VERSION:
+        raise Exception("unknown segmented backup version: " + repr(manifest))
+
+    pool = _segment_pool(processes, _init_decrypt_worker, (backup_context.gnupg_home,))
+
+    def fetch_and_decrypt(segment: Dict) -> bytes:
+        options = dict(Bucket=bucket, Key=segment["key"])
+        if "offset" in segment:
+            # segments of a resumable upload share one object
+            end = segment["offset"] + segment["size"] - 1
+            options["Range"] = "bytes={}-{}".format(segment["offset"], end)
+        response = backup_context.s3.get_object(**options)
+        ciphertext = response["Body"].read()
+        if len(ciphertext) != segment["size"]:
+            raise Exception("segment " + segment["key"] + " has the wrong size")
+        return pool.submit(_decrypt_segment, ciphertext).result()
+
+    window: deque = deque()
+    with pool, ThreadPoolExecutor(max_workers=transfer_workers) as downloads:
+        try:
+            for segment in manifest["segments"]:
+                if len(window) >= transfer_workers * 2:
+                    sink_stream.write(window.popleft().result())
+                window.append(downloads.submit(fetch_and_decrypt, segment))
+            while window:
+                sink_stream.write(window.popleft().result())
+        finally:
+            for future in window:
+                future.cancel()
+    sink_stream.flush()
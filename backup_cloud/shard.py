@@ -0,0 +1,176 @@
+"""hashed sub-prefixes spreading an upload over many S3 partitions
+
+S3 limits the request rate of each key prefix, so a large upload
+written under one prefix is throttled however many workers it has.
+A sharded upload_path() puts each file under a sub-prefix made from
+the first few hex digits of the hash of its name instead:
+
+    PREFIX/3f/mydir/x/y    rather than    PREFIX/mydir/x/y
+
+so the load is spread evenly over 16 ** digits prefixes which S3 can
+serve from separate partitions.  The names and keys are listed in a
+manifest, PREFIX/SHARD_MANIFEST, so that the files can still be
+listed and restored by their path.  The manifest is plain JSON since
+the names already appear in the keys.
+"""
+
+import hashlib
+import json
+import os
+import posixpath
+import sys
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from botocore.exceptions import ClientError  # type: ignore
+from backup_cloud.base import BackupContext, _clean_s3_path
+
+SHARD_VERSION = 1
+# the layout of a sharded upload is recorded in PREFIX/ + this
+SHARD_MANIFEST = "shards.json"
+# hex digits of the name hash used as the sub-prefix; 256 shards
+DEFAULT_SHARD_DIGITS = 2
+MAX_SHARD_DIGITS = 8
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def shard_key(name: str, digits: int = DEFAULT_SHARD_DIGITS) -> str:
+    """the key, relative to the upload prefix, where name is stored"""
+    digest = hashlib.sha256(name.encode("utf-8")).hexdigest()
+    return digest[:digits] + "/" + name
+
+
+class ShardManifest:
+    """the files in a sharded upload
+
+    files maps the name of each file, relative to the upload prefix,
+    to its key relative to the prefix and its plaintext size.  Keys
+    use digits hex digits of the name hash.  Thread safe.
+    """
+
+    def __init__(self, digits: int, files: Optional[Dict[str, Dict]] = None):
+        if not 1 <= digits <= MAX_SHARD_DIGITS:
+            raise Exception(
+                "shard digits must be between 1 and " + str(MAX_SHARD_DIGITS)
+            )
+        self.digits = digits
+        self.files: Dict[str, Dict] = files or {}
+        # full key: (name, entry) of files being uploaded
+        self._pending: Dict[str, Tuple[str, Dict]] = {}
+        self._lock = Lock()
+
+    def expect(self, prefix: str, name: str, size: int) -> str:
+        """return the full key for name, which is added once finished()"""
+        key = shard_key(name, self.digits)
+        dest_key = prefix.rstrip("/") + "/" + key
+        with self._lock:
+            self._pending[dest_key] = (name, dict(key=key, size=size))
+        return dest_key
+
+    def finished(self, dest_key: str) -> None:
+        """record the file uploaded (or found unchanged) at dest_key"""
+        with self._lock:
+            name, entry = self._pending.pop(dest_key)
+            self.files[name] = entry
+
+    def names(self, under: str = "") -> List[str]:
+        """the names of the files in directory under, or of every file"""
+        under = under.strip("/")
+        if not under:
+            return sorted(self.files)
+        return sorted(
+            name for name in self.files if name == under or name.startswith(under + "/")
+        )
+
+    def layout(self, prefix: str) -> Dict[str, str]:
+        """map the full key of each file under prefix to its name"""
+        prefix = prefix.rstrip("/")
+        return {prefix + "/" + entry["key"]: name for name, entry in self.files.items()}
+
+    def to_json(self) -> str:
+        with self._lock:
+            return json.dumps(
+                dict(version=SHARD_VERSION, digits=self.digits, files=self.files),
+                sort_keys=True,
+            )
+
+    @classmethod
+    def from_json(cls, text: str) -> "ShardManifest":
+        data = json.loads(text)
+        if data.get("version") != SHARD_VERSION:
+            raise Exception(
+                "unknown sharded upload version: " + repr(data.get("version"))
+            )
+        return cls(data["digits"], files=data["files"])
+
+
+def shard_jobs(
+    jobs: Iterable[Tuple[str, str]], prefix: str, manifest: ShardManifest
+) -> Iterator[Tuple[str, str]]:
+    """rewrite upload_path() jobs to their sharded keys
+
+    jobs are (source file, destination key) pairs with keys under
+    prefix.  Each file is expected by manifest, which only lists it
+    once manifest.finished() is called with the new key.
+    """
+    prefix = _clean_s3_path(prefix).rstrip("/")
+    for src_name, dest_name in jobs:
+        name = _clean_s3_path(dest_name).replace(prefix + "/", "", 1)
+        name = posixpath.normpath(name)
+        yield src_name, manifest.expect(prefix, name, os.path.getsize(src_name))
+
+
+def open_shard_manifest(
+    backup_context: BackupContext, bucket: str, prefix: str, digits: Optional[int]
+) -> ShardManifest:
+    """a manifest for a new upload to prefix holding what is there already
+
+    An upload to an existing sharded prefix keeps its digits, since
+    other digits would put every file under a new key and leave the
+    old objects behind; asking for different digits is an error.
+    digits None means those of the existing upload, or the default.
+    """
+    existing = read_shard_manifest(backup_context, bucket, prefix)
+    if existing is None:
+        return ShardManifest(digits or DEFAULT_SHARD_DIGITS)
+    if digits is not None and digits != existing.digits:
+        raise Exception(
+            "s3://{}/{} is sharded with {} digits, not {}".format(
+                bucket, prefix, existing.digits, digits
+            )
+        )
+    return ShardManifest(existing.digits, files=dict(existing.files))
+
+
+def write_shard_manifest(
+    backup_context: BackupContext, bucket: str, prefix: str, manifest: ShardManifest
+) -> None:
+    body = manifest.to_json().encode("utf-8")
+    backup_context.s3.put_object(
+        Bucket=bucket,
+        Key=prefix.rstrip("/") + "/" + SHARD_MANIFEST,
+        Body=body,
+        ContentLength=len(body),
+    )
+    eprint(
+        "recorded {} files over {} shards".format(
+            len(manifest.files), 16**manifest.digits
+        )
+    )
+
+
+def read_shard_manifest(
+    backup_context: BackupContext, bucket: str, prefix: str
+) -> Optional[ShardManifest]:
+    """the manifest of the sharded upload at prefix, or None if it isn't one"""
+    try:
+        response = backup_context.s3.get_object(
+            Bucket=bucket, Key=prefix.rstrip("/") + "/" + SHARD_MANIFEST
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+        return None
+    return ShardManifest.from_json(response["Body"].read().decode("utf-8"))
@@ -1,43 +1,461 @@
 import argparse
 import sys
+from typing import Optional
 from backup_cloud import BackupContext
+from backup_cloud.agent import start_agent
+from backup_cloud.base import SMALL_FILE_THRESHOLD, UploadError
+from backup_cloud.compress import codec_names
+from backup_cloud.keycache import default_key_cache_dir
+from backup_cloud.metrics import RunMetrics
+from backup_cloud.restore import RestoreError
+from backup_cloud.resumable import abort_abandoned_uploads
+from backup_cloud.s3 import (
+    DEFAULT_DOWNLOAD_WORKERS,
+    DEFAULT_PART_SIZE,
+    backup_s3_prefix_to_s3,
+)
 
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+def add_context_arguments(parser):
+    parser.add_argument("ssm_path", help="path for finding backup configuration in ssm")
+    parser.add_argument(
+        "--key-cache-dir",
+        default=default_key_cache_dir(),
+        help="directory to keep public keys between runs; empty to disable",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        metavar="FILE",
+        help="when the run ends write its metrics to FILE in the Prometheus "
+        "text format, e.g. for node-exporter's textfile collector",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        metavar="FILE",
+        help="when the run ends write its metrics to FILE as JSON",
+    )
+
+
+def run_metrics(args, command: str) -> Optional[RunMetrics]:
+    if args.metrics_textfile is None and args.metrics_json is None:
+        return None
+    return RunMetrics(command)
+
+
+def write_metrics(metrics: Optional[RunMetrics], args, success: bool) -> None:
+    if metrics is None:
+        return
+    metrics.finish(success)
+    if args.metrics_textfile is not None:
+        metrics.write_textfile(args.metrics_textfile)
+    if args.metrics_json is not None:
+        metrics.write_json(args.metrics_json)
+
+
+def add_compression_argument(parser):
+    parser.add_argument(
+        "--compress",
+        choices=codec_names(),
+        help="compress data before encrypting it unless it looks incompressible"
+        " (zstd needs the zstandard package)",
+    )
+
+
+def add_stats_argument(parser):
+    parser.add_argument(
+        "--stats-report",
+        metavar="FILE",
+        help="when the run ends write the time and bytes of each pipeline stage "
+        "as JSON to FILE (- for standard error)",
+    )
+
+
+def add_adaptive_arguments(parser):
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="start with --workers at once and adjust that to how S3 copes, "
+        "backing off when throttled and retrying temporary errors",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        help="most workers --adaptive may use (default four times --workers)",
+    )
+
+
+def finish_run(bc, args, success: bool) -> None:
+    if args.stats_report is not None:
+        bc.pipeline_stats.write_report(args.stats_report)
+    write_metrics(bc.metrics, args, success)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Preparation and definitions for encrypted backups."
     )
-    parser.add_argument("ssm_path", help="path for finding backup configuration in ssm")
+    add_context_arguments(parser)
+    parser.add_argument(
+        "--agent",
+        action="store_true",
+        help="start a background agent which the generated commands hand their work to",
+    )
+    parser.add_argument(
+        "--agent-idle-timeout",
+        type=float,
+        default=3600,
+        help="seconds without requests before the agent stops",
+    )
 
     args = parser.parse_args()
 
-    bc = BackupContext(ssm_path=args.ssm_path, clean=False)
-    (encrypt_script, upload_script) = bc.setup_commands()
+    metrics = run_metrics(args, "start-backup-context")
+    success = False
+    try:
+        bc = BackupContext(
+            ssm_path=args.ssm_path,
+            clean=False,
+            key_cache_dir=args.key_cache_dir,
+            metrics=metrics,
+        )
+        agent_socket = None
+        if args.agent:
+            agent_socket = start_agent(bc, idle_timeout=args.agent_idle_timeout)
+        (encrypt_script, upload_script) = bc.setup_commands(agent_socket=agent_socket)
+        success = True
+    finally:
+        write_metrics(metrics, args, success)
 
-    set_shell_vars(encrypt_script, upload_script, bc.s3_target_url())
+    set_shell_vars(encrypt_script, upload_script, bc.s3_target_url(), agent_socket)
 
 
-def upload_main():
+def upload_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Upload files to S3 bucket.")
-    parser.add_argument("ssm_path", help="path for finding backup configuration in ssm")
-    parser.add_argument("source_dir", help="file or directory to upload")
-    parser.add_argument("dest_s3_path", help="s3 path to upload to")
+    add_context_arguments(parser)
+    parser.add_argument(
+        "source_dir", help="directory to upload or - to upload standard input"
+    )
+    parser.add_argument(
+        "dest_s3_path",
+        help="s3 path to upload to; the object name when reading standard input",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of files to encrypt and upload concurrently",
+    )
+    parser.add_argument(
+        "--index",
+        help="local database of uploaded files; unchanged files are skipped",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="upload every file even if the index shows it is unchanged",
+    )
+    parser.add_argument(
+        "--small-file-threshold",
+        type=int,
+        default=SMALL_FILE_THRESHOLD,
+        help="files smaller than this many bytes are sent with a single PUT",
+    )
+    parser.add_argument(
+        "--envelope",
+        action="store_true",
+        help="encrypt files under one data key wrapped to the recipients "
+        "rather than to each recipient (needs the cryptography package)",
+    )
+    parser.add_argument(
+        "--segmented",
+        action="store_true",
+        help="when reading standard input, encrypt it in segments on every "
+        "core and upload them in parallel; for very large streams",
+    )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="pack files into a few encrypted volumes with an encrypted index",
+    )
+    parser.add_argument(
+        "--volume-size", type=int, help="target size in bytes of packed volumes"
+    )
+    parser.add_argument(
+        "--shard",
+        action="store_true",
+        help="spread files over hashed sub-prefixes, listed in a manifest, "
+        "so S3's request rate limit per prefix doesn't throttle large uploads",
+    )
+    parser.add_argument(
+        "--shard-digits",
+        type=int,
+        help="hex digits of the hashed sub-prefixes (default 2: 256 shards, "
+        "or those of an existing sharded upload)",
+    )
+    add_compression_argument(parser)
+    add_adaptive_arguments(parser)
+    add_stats_argument(parser)
+    return parser
 
+
+def upload_main():
+    parser = upload_parser()
     args = parser.parse_args()
 
-    bc = BackupContext(ssm_path=args.ssm_path, clean=False)
+    bc = BackupContext(
+        ssm_path=args.ssm_path,
+        clean=False,
+        key_cache_dir=args.key_cache_dir,
+        small_file_threshold=args.small_file_threshold,
+        envelope=args.envelope,
+        compression=args.compress,
+        instrument=args.stats_report is not None,
+        metrics=run_metrics(args, "backup-cloud-upload"),
+    )
     (encrypt_script, upload_script) = bc.setup_commands()
 
     eprint("starting upload of " + args.source_dir + " to " + args.dest_s3_path + "\n")
 
-    bc.upload_path(args.source_dir, args.dest_s3_path)
+    if args.segmented and args.source_dir != "-":
+        parser.error("--segmented is only for standard input")
+    if args.segmented and args.envelope:
+        parser.error("--segmented cannot be used with --envelope")
+
+    success = False
+    try:
+        if args.source_dir == "-":
+            bc.upload_stream(
+                sys.stdin.buffer, args.dest_s3_path, segmented=args.segmented
+            )
+        else:
+            bc.upload_path(
+                args.source_dir,
+                args.dest_s3_path,
+                workers=args.workers,
+                index_path=args.index,
+                force=args.force,
+                pack=args.pack,
+                volume_size=args.volume_size,
+                adaptive=args.adaptive,
+                max_workers=args.max_workers,
+                sharded=args.shard,
+                shard_digits=args.shard_digits,
+            )
+        success = True
+    except UploadError as e:
+        for name, error in e.failures:
+            eprint("failed: " + name + ": " + repr(error))
+        sys.exit(1)
+    finally:
+        finish_run(bc, args, success)
+
+
+def s3_backup_main():
+    parser = argparse.ArgumentParser(
+        description="Encrypt and back up every object under an S3 prefix."
+    )
+    add_context_arguments(parser)
+    parser.add_argument("src_bucket", help="bucket to back up from")
+    parser.add_argument("src_prefix", help="prefix of the objects to back up")
+    parser.add_argument(
+        "dest_s3_path",
+        help="path under the backup location to write to (or the full "
+        "prefix if --dest-bucket is given)",
+    )
+    parser.add_argument("--dest-bucket", help="bucket to write backups to")
+    parser.add_argument(
+        "--workers", type=int, default=4, help="objects backed up concurrently"
+    )
+    parser.add_argument(
+        "--list-workers", type=int, default=8, help="sub-prefixes listed concurrently"
+    )
+    parser.add_argument(
+        "--part-size",
+        type=int,
+        default=DEFAULT_PART_SIZE,
+        help="bytes fetched by each ranged GET",
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=DEFAULT_DOWNLOAD_WORKERS,
+        help="ranged GETs running at once for each object",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only back up objects new or changed since the last backup, "
+        "tracked in a manifest stored next to the backup",
+    )
+    parser.add_argument(
+        "--state-dir", help="directory for the local copy of the backup manifest"
+    )
+    add_compression_argument(parser)
+    parser.add_argument(
+        "--resumable",
+        action="store_true",
+        help="copy objects in checkpointed parts so an interrupted run carries "
+        "on where it stopped when run again",
+    )
+    parser.add_argument(
+        "--abort-abandoned-uploads",
+        action="store_true",
+        help="first abort multipart uploads under the destination started "
+        "over a week ago which can't be resumed from here",
+    )
+    add_adaptive_arguments(parser)
+    add_stats_argument(parser)
+
+    args = parser.parse_args()
+
+    bc = BackupContext(
+        ssm_path=args.ssm_path,
+        clean=False,
+        key_cache_dir=args.key_cache_dir,
+        compression=args.compress,
+        instrument=args.stats_report is not None,
+        metrics=run_metrics(args, "backup-cloud-s3"),
+    )
+    if args.dest_bucket is None:
+        dest_bucket = bc.s3_bucket().name
+        dest_prefix = bc.s3_target_url() + "/" + args.dest_s3_path
+    else:
+        dest_bucket = args.dest_bucket
+        dest_prefix = args.dest_s3_path
+    success = False
+    try:
+        if args.abort_abandoned_uploads:
+            abort_abandoned_uploads(bc, dest_bucket, dest_prefix)
+        backup_s3_prefix_to_s3(
+            bc,
+            args.src_bucket,
+            args.src_prefix,
+            dest_bucket,
+            dest_prefix,
+            workers=args.workers,
+            list_workers=args.list_workers,
+            part_size=args.part_size,
+            download_workers=args.download_workers,
+            incremental=args.incremental,
+            state_dir=args.state_dir,
+            resumable=args.resumable,
+            adaptive=args.adaptive,
+            max_workers=args.max_workers,
+        )
+        success = True
+    except UploadError as e:
+        for name, error in e.failures:
+            eprint("failed: " + name + ": " + repr(error))
+        sys.exit(1)
+    finally:
+        finish_run(bc, args, success)
+
+
+def restore_main():
+    parser = argparse.ArgumentParser(description="Restore and decrypt backups.")
+    add_context_arguments(parser)
+    parser.add_argument(
+        "backup_path", help="path of the backup under the backup location"
+    )
+    parser.add_argument(
+        "dest",
+        nargs="?",
+        help="file to restore to, - for standard output, s3://BUCKET/KEY for "
+        "an S3 object or, with --tree, the directory to restore into",
+    )
+    parser.add_argument(
+        "--tree",
+        action="store_true",
+        help="restore the whole directory tree written by backup-cloud-upload",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="objects restored concurrently"
+    )
+    parser.add_argument(
+        "--gnupg-home", help="gpg home directory holding the secret keys"
+    )
+    parser.add_argument(
+        "--member",
+        help="restore just this file (e.g. dumps/db.sql) from a directory "
+        "written by backup-cloud-upload",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="print the paths of the files in a directory written by "
+        "backup-cloud-upload instead of restoring",
+    )
+    parser.add_argument(
+        "--journal",
+        help="with --tree, file recording finished objects so an interrupted "
+        "restore can be resumed (default: in the destination directory)",
+    )
+    parser.add_argument(
+        "--part-size",
+        type=int,
+        default=DEFAULT_PART_SIZE,
+        help="bytes fetched by each ranged GET",
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=DEFAULT_DOWNLOAD_WORKERS,
+        help="ranged GETs running at once for each object",
+    )
+
+    args = parser.parse_args()
+    if args.dest is None and not args.list:
+        parser.error("dest is needed unless --list is given")
+
+    bc = BackupContext(
+        ssm_path=args.ssm_path,
+        key_cache_dir=args.key_cache_dir,
+        gnupg_home=args.gnupg_home,
+        metrics=run_metrics(args, "backup-cloud-restore"),
+    )
+    download_options = dict(
+        part_size=args.part_size, download_workers=args.download_workers
+    )
+
+    success = False
+    try:
+        if args.list:
+            for name in bc.list_path(args.backup_path):
+                print(name)
+        elif args.member:
+            bc.restore_member(args.backup_path, args.member, args.dest)
+        elif args.tree:
+            bc.restore_path(
+                args.backup_path,
+                args.dest,
+                workers=args.workers,
+                journal_path=args.journal,
+                **download_options
+            )
+        elif args.dest == "-":
+            bc.restore_stream(args.backup_path, sys.stdout.buffer, **download_options)
+        elif args.dest.startswith("s3://"):
+            dest_url = args.dest.replace("s3://", "", 1)
+            dest_bucket, _slash, dest_key = dest_url.partition("/")
+            bc.restore_to_s3(
+                args.backup_path, dest_bucket, dest_key, **download_options
+            )
+        else:
+            bc.restore_file(args.backup_path, args.dest, **download_options)
+        success = True
+    except RestoreError as e:
+        for name, error in e.failures:
+            eprint("failed: " + name + ": " + repr(error))
+        sys.exit(1)
+    finally:
+        write_metrics(bc.metrics, args, success)
 
 
-def set_shell_vars(encrypt_script, upload_script, target_url):
+def set_shell_vars(encrypt_script, upload_script, target_url, agent_socket=None):
     """output commands that shell can use to set variables
 
     this should be used something like
@@ -79,4 +497,6 @@ def set_shell_vars(encrypt_script, upload_script, target_url):
     print("export BACKUP_CONTEXT_ENCRYPT_COMMAND=" + encrypt_script + ";\n")
     print("export BACKUP_CONTEXT_UPLOAD_COMMAND=" + upload_script + ";\n")
     print("export BACKUP_CONTEXT_S3_TARGET=" + target_url + ";\n")
+    if agent_socket is not None:
+        print("export BACKUP_CONTEXT_AGENT_SOCKET=" + agent_socket + ";\n")
     print("echo configured backup context;\n")
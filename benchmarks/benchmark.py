@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""offline benchmarks for the backup hot paths
+
+Each case runs in its own process against moto's in-memory S3 and SSM
+with a freshly generated gpg key, so nothing here touches AWS and
+peak RSS is measured per case.  For every case the run reports MB/s,
+files/s, peak RSS and the latency of each call to the function being
+measured.
+
+Results are compared with a baseline file.  Throughput more than
+--tolerance below the baseline, or peak RSS or p95 latency more than
+--tolerance above it, is a regression and the run exits non-zero so
+that the build fails.  Baselines depend on the machine, so record them
+on the build machine with --update-baseline (make benchmark-baseline).
+A missing baseline fails the run rather than passing unchecked.
+
+    python3 benchmarks/benchmark.py --scale 0.05 --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import binascii
+import gc
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, List
+
+MB = 1024 * 1024
+BUCKET = "backup-cloud-benchmark"
+SSM_PATH = "/backup-cloud-benchmark"
+S3_PATH = "benchmark"
+DEFAULT_TOLERANCE = 0.25
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def _offline_aws_environment() -> None:
+    # moto accepts any credentials; set some so a real profile is never used
+    os.environ["AWS_ACCESS_KEY_ID"] = "benchmark"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "benchmark"
+    os.environ.pop("AWS_SESSION_TOKEN", None)
+    os.environ.pop("AWS_PROFILE", None)
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+
+
+def make_data(size: int) -> bytes:
+    """data which compresses about as well as a typical dump"""
+    return binascii.hexlify(os.urandom((size + 1) // 2))[:size]
+
+
+def write_file(path: str, size: int) -> None:
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            block = make_data(min(remaining, 4 * MB))
+            f.write(block)
+            remaining -= len(block)
+
+
+def setup_backup_context(workdir: str):
+    """a context using a new key in moto's S3 and SSM"""
+    import boto3
+    import gpg
+    from backup_cloud.base import BackupContext
+    from backup_cloud.test_support import ensure_s3_paths_in_ssm, make_new_keypair
+
+    boto3.client("s3").create_bucket(Bucket=BUCKET)
+    ensure_s3_paths_in_ssm(SSM_PATH, BUCKET, S3_PATH)
+    keyring = os.path.join(workdir, "keyring")
+    os.makedirs(keyring)
+    gpg_context = gpg.Context()
+    gpg_context.home_dir = keyring
+    userid, public_key, _private_key = make_new_keypair(gpg_context)
+    boto3.client("s3").put_object(
+        Bucket=BUCKET,
+        Key=S3_PATH + "/config/public-keys/" + userid + ".pub",
+        Body=public_key,
+    )
+    return BackupContext(ssm_path=SSM_PATH, bindir=os.path.join(workdir, "bin"))
+
+
+class Case:
+    """one benchmark: prepare() is untimed, run() is measured
+
+    run() returns the bytes and files it handled and the time taken
+    by each call.
+    """
+
+    def __init__(self, name: str, prepare: Callable, run: Callable):
+        self.name = name
+        self.prepare = prepare
+        self.run = run
+
+
+def _timed(function, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def _prepare_encrypt(bc, workdir, scale):
+    return [make_data(MB) for _ in range(max(1, int(32 * scale)))]
+
+
+def _run_encrypt(bc, workdir, payloads):
+    latencies = [_timed(bc.encrypt, payload) for payload in payloads]
+    return sum(len(p) for p in payloads), len(payloads), latencies
+
+
+def _prepare_big_file(bc, workdir, scale):
+    path = os.path.join(workdir, "big.dump")
+    write_file(path, max(MB, int(256 * MB * scale)))
+    return path
+
+
+def _run_backup_file(bc, workdir, path):
+    latency = _timed(bc.backup_file_to_s3, path, bc.s3_bucket(), "bench/big.dump")
+    return os.path.getsize(path), 1, [latency]
+
+
+def _prepare_tree(directory: str, count: int, size: int) -> str:
+    for i in range(count):
+        subdir = os.path.join(directory, "d%03d" % (i // 100))
+        os.makedirs(subdir, exist_ok=True)
+        write_file(os.path.join(subdir, "f%05d" % i), size)
+    return directory
+
+
+def _prepare_small_files(bc, workdir, scale):
+    count = max(10, int(2000 * scale))
+    return _prepare_tree(os.path.join(workdir, "small"), count, 4096)
+
+
+def _prepare_huge_files(bc, workdir, scale):
+    size = max(MB, int(128 * MB * scale))
+    return _prepare_tree(os.path.join(workdir, "huge"), 3, size)
+
+
+def _run_upload_path(bc, workdir, directory, workers=8):
+    sizes = [
+        os.path.getsize(os.path.join(dirpath, name))
+        for (dirpath, _dirs, names) in os.walk(directory)
+        for name in names
+    ]
+    latency = _timed(
+        bc.upload_path, directory, os.path.basename(directory), workers=workers
+    )
+    return sum(sizes), len(sizes), [latency]
+
+
+def _prepare_s3_object(bc, workdir, scale):
+    path = _prepare_big_file(bc, workdir, scale)
+    with open(path, "rb") as f:
+        bc.s3.upload_fileobj(f, BUCKET, "source/big.dump")
+    size = os.path.getsize(path)
+    os.unlink(path)
+    return size
+
+
+def _run_backup_s3(bc, workdir, size):
+    from backup_cloud.s3 import backup_s3_to_s3
+
+    latency = _timed(
+        backup_s3_to_s3,
+        bc,
+        BUCKET,
+        "source/big.dump",
+        BUCKET,
+        bc.s3_target_url() + "/bench/s3-copy.dump",
+    )
+    return size, 1, [latency]
+
+
+CASES = [
+    Case("encrypt", _prepare_encrypt, _run_encrypt),
+    Case("backup_file_to_s3", _prepare_big_file, _run_backup_file),
+    Case("upload_path_small_files", _prepare_small_files, _run_upload_path),
+    Case(
+        "upload_path_huge_files",
+        _prepare_huge_files,
+        lambda bc, workdir, directory: _run_upload_path(bc, workdir, directory, 3),
+    ),
+    Case("backup_s3_to_s3", _prepare_s3_object, _run_backup_s3),
+]
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarise(
+    total_bytes: int, files: int, latencies: List[float], rss_kb: int
+) -> Dict:
+    elapsed = sum(latencies)
+    return {
+        "seconds": round(elapsed, 3),
+        "mb_per_s": round(total_bytes / MB / elapsed, 2),
+        "files_per_s": round(files / elapsed, 2),
+        "peak_rss_mb": round(rss_kb / 1024, 1),
+        "latency_p50_ms": round(_percentile(latencies, 0.5) * 1000, 2),
+        "latency_p95_ms": round(_percentile(latencies, 0.95) * 1000, 2),
+        "calls": len(latencies),
+    }
+
+
+def _run_case(case: Case, scale: float, results) -> None:
+    """child process body; the result dict is sent back over results"""
+    from moto import mock_aws
+
+    _offline_aws_environment()
+    try:
+        with TemporaryDirectory() as workdir, mock_aws():
+            bc = setup_backup_context(workdir)
+            prepared = case.prepare(bc, workdir, scale)
+            gc.collect()
+            total_bytes, files, latencies = case.run(bc, workdir, prepared)
+            # the maximum over the life of this process; kilobytes on Linux
+            rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            results.send(summarise(total_bytes, files, latencies, rss_kb))
+    except BaseException as e:
+        results.send({"error": repr(e)})
+        raise
+
+
+def run_cases(cases: List[Case], scale: float) -> Dict[str, Dict]:
+    # fork so that each case starts from a small parent, not a sibling's heap
+    mp = multiprocessing.get_context("fork")
+    results = {}
+    for case in cases:
+        eprint("benchmark: " + case.name)
+        receive, send = mp.Pipe(duplex=False)
+        process = mp.Process(target=_run_case, args=(case, scale, send))
+        process.start()
+        send.close()
+        try:
+            result = receive.recv()
+        except EOFError:
+            result = {"error": "benchmark process died"}
+        process.join()
+        if "error" in result:
+            raise Exception("benchmark " + case.name + " failed: " + result["error"])
+        results[case.name] = result
+    return results
+
+
+def find_regressions(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """describe every metric worse than the baseline by more than tolerance"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            eprint("benchmark: no baseline for " + name)
+            continue
+        for metric in ("mb_per_s", "files_per_s"):
+            if result[metric] < base[metric] * (1 - tolerance):
+                regressions.append(
+                    "%s %s %s is below baseline %s"
+                    % (name, metric, result[metric], base[metric])
+                )
+        for metric in ("peak_rss_mb", "latency_p95_ms"):
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    "%s %s %s is above baseline %s"
+                    % (name, metric, result[metric], base[metric])
+                )
+    return regressions
+
+
+def print_table(results: Dict) -> None:
+    columns = [
+        "mb_per_s",
+        "files_per_s",
+        "peak_rss_mb",
+        "latency_p50_ms",
+        "latency_p95_ms",
+    ]
+    print("%-26s" % "case" + "".join("%16s" % c for c in columns))
+    for name, result in results.items():
+        print("%-26s" % name + "".join("%16s" % result[c] for c in columns))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="benchmark backup_cloud offline against moto"
+    )
+    parser.add_argument(
+        "--case",
+        action="append",
+        choices=[case.name for case in CASES],
+        help="run only this case; may be repeated",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="multiply data sizes and file counts; baselines only match the same scale",
+    )
+    parser.add_argument("--baseline", help="JSON file of results to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="fraction a metric may be worse than its baseline",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="write these results to the baseline file instead of comparing",
+    )
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    cases = [case for case in CASES if not args.case or case.name in args.case]
+    results = run_cases(cases, args.scale)
+    print_table(results)
+    report = {"scale": args.scale, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if not args.baseline:
+        return 0
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+        eprint("benchmark: baseline written to " + args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        eprint(
+            "benchmark: no baseline at "
+            + args.baseline
+            + "; run make benchmark-baseline"
+        )
+        return 2
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("scale") != args.scale:
+        eprint(
+            "benchmark: baseline was recorded at scale " + str(baseline.get("scale"))
+        )
+        return 2
+    regressions = find_regressions(results, baseline["results"], args.tolerance)
+    for regression in regressions:
+        eprint("REGRESSION: " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -23,10 +23,15 @@ setup(
         "console_scripts": [
             "start-backup-context = backup_cloud.shell_start:main",
             "backup-cloud-upload = backup_cloud.shell_start:upload_main",
+            "backup-cloud-s3 = backup_cloud.shell_start:s3_backup_main",
+            "backup-cloud-restore = backup_cloud.shell_start:restore_main",
         ]
     },
     # python gpgme (the official library distributed by the GPG team)
     # has to be installed by the operating system so we don't include
     # it here so that PIP does not attempt to install it!
     install_requires=["boto3"],
+    # envelope encryption (backup_cloud.envelope) and zstd compression
+    # (backup_cloud.compress) are optional
+    extras_require={"envelope": ["cryptography"], "zstd": ["zstandard"]},
 )
@@ -0,0 +1,143 @@
+from backup_cloud.agent import AgentServer
+from backup_cloud.agent_client import (
+    CONTEXT_OPTIONS,
+    add_upload_arguments,
+    main as client_main,
+    request,
+)
+from backup_cloud.base import UploadError
+from backup_cloud.shell_start import upload_parser
+from unittest.mock import Mock
+from threading import Thread
+import argparse
+import os
+import pytest
+
+
+def _start_server(tmp_path, backup_context):
+    socket_path = str(tmp_path / "agent.sock")
+    server = AgentServer(socket_path, backup_context, idle_timeout=60)
+    thread = Thread(target=server.serve_until_idle, args=(0.05,), daemon=True)
+    thread.start()
+    return socket_path, thread
+
+
+def test_agent_should_encrypt_files_with_its_context(tmp_path):
+    bc = Mock()
+    bc.encrypt_stream.side_effect = lambda src, sink: sink.write(
+        b"encrypted:" + src.read()
+    )
+    socket_path, thread = _start_server(tmp_path, bc)
+    plain = tmp_path / "dump.sql"
+    plain.write_bytes(b"select 1;")
+
+    assert client_main([socket_path, "encrypt", str(plain)]) == 0
+    assert (tmp_path / "dump.sql.gpg").read_bytes() == b"encrypted:select 1;"
+
+    assert client_main([socket_path, "stop"]) == 0
+    thread.join(5)
+    assert not os.path.exists(socket_path)
+
+
+def test_agent_should_report_upload_failures(tmp_path):
+    bc = Mock()
+    bc.upload_path.side_effect = UploadError([("/data/a", Exception("denied"))])
+    socket_path, thread = _start_server(tmp_path, bc)
+
+    reply = request(socket_path, dict(op="upload", src="/data", dest="data", workers=4))
+    bc.upload_path.assert_called_with(
+        "/data",
+        "data",
+        workers=4,
+        index_path=None,
+        force=False,
+        pack=False,
+        volume_size=None,
+        sharded=False,
+        shard_digits=None,
+        adaptive=False,
+        max_workers=None,
+    )
+    assert reply["status"] == "error"
+    assert reply["failures"] == ["/data/a: Exception('denied')"]
+
+    request(socket_path, dict(op="stop"))
+    thread.join(5)
+
+
+def test_agent_should_encrypt_passed_stdin_to_stdout(tmp_path):
+    bc = Mock()
+    bc.encrypt_stream.side_effect = lambda src, sink: sink.write(
+        b"encrypted:" + src.read()
+    )
+    socket_path, thread = _start_server(tmp_path, bc)
+
+    r_in, w_in = os.pipe()
+    os.write(w_in, b"pg_dump output")
+    os.close(w_in)
+    out_path = str(tmp_path / "out")
+    with open(out_path, "wb") as out:
+        reply = request(socket_path, dict(op="encrypt", src="-"), [r_in, out.fileno()])
+    os.close(r_in)
+
+    assert reply["status"] == "ok"
+    with open(out_path, "rb") as f:
+        assert f.read() == b"encrypted:pg_dump output"
+
+    request(socket_path, dict(op="stop"))
+    thread.join(5)
+
+
+def _options(parser):
+    return {
+        option
+        for action in parser._actions
+        for option in action.option_strings
+        if option not in ("-h", "--help")
+    }
+
+
+def test_agent_client_should_accept_every_upload_option():
+    agent_parser = argparse.ArgumentParser()
+    add_upload_arguments(agent_parser)
+
+    assert _options(agent_parser) == _options(upload_parser())
+
+
+def test_agent_should_forward_upload_options(tmp_path):
+    bc = Mock()
+    socket_path, thread = _start_server(tmp_path, bc)
+    source = tmp_path / "data"
+    source.mkdir()
+
+    args = [socket_path, "upload", str(source), "data", "--workers", "4"]
+    args += ["--adaptive", "--max-workers", "32", "--shard", "--shard-digits", "3"]
+    assert client_main(args) == 0
+    bc.upload_path.assert_called_with(
+        str(source),
+        "data",
+        workers=4,
+        index_path=None,
+        force=False,
+        pack=False,
+        volume_size=None,
+        sharded=True,
+        shard_digits=3,
+        adaptive=True,
+        max_workers=32,
+    )
+
+    request(socket_path, dict(op="stop"))
+    thread.join(5)
+
+
+@pytest.mark.parametrize("option", [option for option, _action in CONTEXT_OPTIONS])
+def test_agent_client_should_refuse_context_options(option, capsys):
+    args = ["sock", "upload", "/data", "data", option]
+    if option != "--envelope":
+        args.append("value")
+
+    with pytest.raises(SystemExit):
+        client_main(args)
+
+    assert "not supported via the backup agent" in capsys.readouterr().err
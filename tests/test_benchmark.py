@@ -0,0 +1,32 @@
+import importlib.util
+import os
+
+_path = os.path.join(os.path.dirname(__file__), "..", "benchmarks", "benchmark.py")
+_spec = importlib.util.spec_from_file_location("benchmark", _path)
+benchmark = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(benchmark)
+
+
+def _result(mb_per_s=100.0, peak_rss_mb=50.0, latency_p95_ms=10.0):
+    return {
+        "mb_per_s": mb_per_s,
+        "files_per_s": 1.0,
+        "peak_rss_mb": peak_rss_mb,
+        "latency_p95_ms": latency_p95_ms,
+    }
+
+
+def test_regressions_should_only_be_reported_beyond_tolerance():
+    baseline = {"encrypt": _result()}
+    assert (
+        benchmark.find_regressions({"encrypt": _result(mb_per_s=80.0)}, baseline, 0.25)
+        == []
+    )
+    assert benchmark.find_regressions({"new_case": _result()}, baseline, 0.25) == []
+
+    slower = benchmark.find_regressions(
+        {"encrypt": _result(mb_per_s=70.0, peak_rss_mb=70.0)}, baseline, 0.25
+    )
+    assert len(slower) == 2
+    assert slower[0].startswith("encrypt mb_per_s")
+    assert slower[1].startswith("encrypt peak_rss_mb")
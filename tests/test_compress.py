@@ -0,0 +1,41 @@
+import backup_cloud.compress as compress
+import io
+import os
+import pytest
+
+
+def _round_trip(data, codec_name="gzip"):
+    stream, codec = compress.compression_stage(io.BytesIO(data), codec_name)
+    compressed = stream.read(-1)
+    out = io.BytesIO()
+    writer = compress.DecompressingWriter(out, lambda: codec)
+    for start in range(0, len(compressed), 1000):
+        writer.write(compressed[start : start + 1000])  # noqa: E203
+    writer.finish()
+    return codec, compressed, out.getvalue()
+
+
+def test_compressible_data_should_round_trip_through_gzip_members():
+    # several blocks so they are compressed in parallel as separate members
+    data = b"INSERT INTO t VALUES (1, 'some row');\n" * 100000
+    codec, compressed, restored = _round_trip(data)
+    assert codec == "gzip"
+    assert len(compressed) < len(data) / 10
+    assert restored == data
+
+
+def test_incompressible_data_should_be_passed_on_unchanged():
+    data = os.urandom(compress.SAMPLE_SIZE + 1000)
+    codec, stored, restored = _round_trip(data)
+    assert codec is None
+    assert stored == data
+    assert restored == data
+
+
+def test_truncated_compressed_data_should_be_an_error():
+    stream, codec = compress.compression_stage(io.BytesIO(b"abc" * 10000), "gzip")
+    compressed = stream.read(-1)
+    writer = compress.DecompressingWriter(io.BytesIO(), lambda: codec)
+    writer.write(compressed[:-10])
+    with pytest.raises(Exception, match="truncated"):
+        writer.finish()
@@ -0,0 +1,98 @@
+from backup_cloud import concurrency
+from backup_cloud.base import run_bounded
+from backup_cloud.concurrency import AdaptiveConcurrency, is_retryable, is_throttle
+from botocore.exceptions import ClientError, EndpointConnectionError
+from unittest.mock import Mock
+import pytest
+
+
+def _client_error(code: str) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": code}}, "PutObject")
+
+
+def test_limit_should_grow_after_each_healthy_window_and_halve_when_throttled():
+    limit = AdaptiveConcurrency("test", 4, 16)
+    for _ in range(4):
+        limit.success(0.1)
+    assert limit.limit == 5
+
+    limit.backoff("SlowDown")
+    assert limit.limit == 2
+    # a burst of throttling from the same load only cuts once
+    limit.backoff("SlowDown")
+    assert limit.limit == 2
+
+
+def test_limit_should_stay_between_minimum_and_maximum():
+    limit = AdaptiveConcurrency("test", 2, 3)
+    for _ in range(20):
+        limit.success(0.1)
+    assert limit.limit == 3
+
+    limit = AdaptiveConcurrency("test", 1, 3)
+    limit.backoff("SlowDown")
+    assert limit.limit == 1
+
+
+def test_limit_should_not_grow_while_latency_is_unhealthy():
+    limit = AdaptiveConcurrency("test", 2, 16)
+    for _ in range(10):
+        limit.success(0.1)
+    grown = limit.limit
+    for _ in range(50):
+        limit.success(10.0)
+    assert not limit.latency_healthy()
+    assert limit.limit == grown
+
+
+def test_call_should_retry_throttled_jobs_and_back_off(monkeypatch):
+    monkeypatch.setattr(concurrency, "_retry_delay", lambda attempt: 0)
+    limit = AdaptiveConcurrency("test", 8, 8)
+    job = Mock(side_effect=[_client_error("SlowDown"), "done"])
+
+    assert limit.call(job, "a") == "done"
+    assert job.call_count == 2
+    assert limit.limit == 4
+
+
+def test_call_should_not_retry_permanent_errors(monkeypatch):
+    monkeypatch.setattr(concurrency, "_retry_delay", lambda attempt: 0)
+    limit = AdaptiveConcurrency("test", 8, 8)
+    job = Mock(side_effect=_client_error("AccessDenied"))
+
+    with pytest.raises(ClientError):
+        limit.call(job)
+    assert job.call_count == 1
+    assert limit.limit == 8
+
+
+def test_run_bounded_should_retry_through_limit(monkeypatch):
+    monkeypatch.setattr(concurrency, "_retry_delay", lambda attempt: 0)
+    limit = AdaptiveConcurrency("test", 2, 4)
+    attempts = {}
+
+    def job(n):
+        attempts[n] = attempts.get(n, 0) + 1
+        if n == 3 and attempts[n] == 1:
+            raise _client_error("SlowDown")
+
+    assert run_bounded(job, range(10), 2, limit=limit) == []
+    assert attempts[3] == 2
+    assert sum(attempts.values()) == 11
+
+
+def test_errors_should_be_classified_through_their_causes():
+    try:
+        try:
+            raise _client_error("SlowDown")
+        except ClientError as e:
+            raise Exception("upload failed") from e
+    except Exception as e:
+        wrapped = e
+    assert is_throttle(wrapped)
+    assert is_retryable(wrapped)
+    assert is_retryable(_client_error("InternalError"))
+    assert not is_throttle(_client_error("InternalError"))
+    assert is_retryable(EndpointConnectionError(endpoint_url="https://s3"))
+    assert not is_retryable(_client_error("NoSuchKey"))
+    assert not is_retryable(ValueError("bad"))
@@ -1,5 +1,9 @@
-from backup_cloud.base import BackupContext
+import backup_cloud.base
+from backup_cloud.base import BackupContext, UploadError
+import io
+import os
 from unittest.mock import patch
+import pytest
 
 
 def test_should_clean_up_double_slashes_from_target_url():
@@ -44,7 +48,161 @@ def test_upload_should_clean_slashes_in_paths_of_target_objects():
                 c, "s3_path", return_value="/unit/test/fake/s3/path/without/slash"
             ):
                 with patch.object(c, "s3_bucket") as mockbucket:
-                    c.backup_file_to_s3(
-                        "/etc/hosts", mockbucket, "/this//that/theother"
-                    )
+                    with patch.object(c, "encrypt_stream"):
+                        c.backup_file_to_s3(
+                            "/etc/hosts", mockbucket, "/this//that/theother"
+                        )
                     mockbucket.Object.assert_called_with("this/that/theother")
+
+
+def test_concurrent_upload_should_report_failures_per_file(tmp_path):
+    src = tmp_path / "dumps"
+    src.mkdir()
+    for name in ["a", "b", "c", "d"]:
+        (src / name).write_bytes(b"data " + name.encode())
+
+    def fake_backup(src_file, dest_bucket, dest_path, **kwargs):
+        if src_file.endswith("/c"):
+            raise Exception("upload refused")
+
+    with patch("backup_cloud.base.boto3"):
+        with patch.object(BackupContext, "get_gpg_keys"):
+            c = BackupContext(ssm_path="/unit/test/fake")
+            with patch.object(c, "s3_path", return_value="unit/test/fake"):
+                with patch.object(c, "s3_bucket"), patch.object(
+                    c, "backup_file_to_s3", side_effect=fake_backup
+                ) as mockbackup:
+                    with pytest.raises(UploadError) as excinfo:
+                        c.upload_path(str(src), "dumps", workers=3)
+
+    assert mockbackup.call_count == 4
+    dest_paths = sorted(x[0][2] for x in mockbackup.call_args_list)
+    assert dest_paths[0] == "unit/test/fake/backup/dumps/dumps/a"
+    assert [name for name, _e in excinfo.value.failures] == [str(src / "c")]
+
+
+def _ssm_pages(ssm_path):
+    return [
+        {
+            "Parameters": [
+                {"Name": ssm_path + "/s3_bucket", "Value": "fake-bucket"},
+                {"Name": ssm_path + "/s3_path", "Value": "/fake/path"},
+            ]
+        }
+    ]
+
+
+def test_configuration_should_be_read_from_ssm_once():
+    with patch("backup_cloud.base.boto3"):
+        with patch.object(BackupContext, "get_gpg_keys"):
+            c = BackupContext(ssm_path="/unit/test/fakessm")
+            paginate = c.ssm.get_paginator.return_value.paginate
+            paginate.return_value = _ssm_pages("/unit/test/fakessm")
+            for _i in range(10):
+                assert c.s3_path() == "fake/path"
+                c.s3_bucket()
+                c.s3_target_url()
+
+    paginate.assert_called_once_with(Path="/unit/test/fakessm")
+    c.ssm.get_parameter.assert_not_called()
+    c.s3_resource().Bucket.assert_called_with("fake-bucket")
+
+
+def test_configuration_should_be_reread_after_ttl():
+    with patch("backup_cloud.base.boto3"):
+        with patch.object(BackupContext, "get_gpg_keys"):
+            c = BackupContext(ssm_path="/unit/test/fakessm", config_ttl=60)
+            paginate = c.ssm.get_paginator.return_value.paginate
+            paginate.return_value = _ssm_pages("/unit/test/fakessm")
+            with patch("backup_cloud.base.time.monotonic", return_value=1000.0):
+                c.s3_path()
+                c.s3_path()
+            with patch("backup_cloud.base.time.monotonic", return_value=1061.0):
+                c.s3_path()
+
+    assert paginate.call_count == 2
+
+
+def test_small_files_should_be_sent_with_a_single_put(tmp_path):
+    small = tmp_path / "small"
+    small.write_bytes(b"x" * 100)
+    large = tmp_path / "large"
+    large.write_bytes(b"x" * 1000)
+
+    def fake_encrypt(source, sink):
+        sink.write(b"encrypted " + source.read())
+
+    with patch("backup_cloud.base.boto3"):
+        with patch.object(BackupContext, "get_gpg_keys"):
+            c = BackupContext(ssm_path="/unit/test/fake", small_file_threshold=500)
+            with patch.object(c, "s3_bucket") as mockbucket, patch.object(
+                c, "encrypt_stream", side_effect=fake_encrypt
+            ), patch("backup_cloud.base._upload_encrypted_stream") as mockstream:
+                c.backup_file_to_s3(str(small), mockbucket, "small")
+                mockbucket.Object().put.assert_called_once_with(
+                    Body=b"encrypted " + b"x" * 100,
+                    ContentLength=110,
+                    Metadata={
+                        "backup-cloud-format": "1",
+                        "backup-cloud-encoding": "openpgp",
+                        "backup-cloud-codec": "none",
+                        "backup-cloud-recipients": "",
+                    },
+                )
+                mockstream.assert_not_called()
+
+                c.backup_file_to_s3(str(large), mockbucket, "large")
+                assert mockstream.call_count == 1
+                assert mockbucket.Object().put.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "data", [b"compressible " * 10000, os.urandom(100000)], ids=["zip", "random"]
+)
+def test_gpg_should_not_compress_streams_we_compress(data):
+    with patch("backup_cloud.base.boto3"):
+        with patch.object(BackupContext, "get_gpg_keys"):
+            c = BackupContext(ssm_path="/unit/test/fake", compression="gzip")
+            with patch.object(c, "encrypt") as encrypt:
+                stream, _metadata = c.prepare_stream(io.BytesIO(data))
+                c.encrypt_stream(stream, io.BytesIO())
+                assert encrypt.call_args[1]["compress"] is False
+
+                c.compression = None
+                stream, _metadata = c.prepare_stream(io.BytesIO(data))
+                c.encrypt_stream(stream, io.BytesIO())
+                assert "compress" not in encrypt.call_args[1]
+
+
+def test_format_metadata_should_record_encoding_and_recipient_key_ids():
+    with patch("backup_cloud.base.boto3"):
+        with patch.object(BackupContext, "get_gpg_keys"):
+            c = BackupContext(
+                ssm_path="/unit/test/fake", recipients=["a@example.com"], armor=True
+            )
+            with patch.object(c, "_thread_gpg_context") as context:
+                context().get_key.return_value.fpr = "0123456789ABCDEF" * 2 + "FEED"
+                metadata = c.format_metadata()
+    assert metadata == {
+        "backup-cloud-format": "1",
+        "backup-cloud-encoding": "openpgp-armor",
+        "backup-cloud-codec": "none",
+        "backup-cloud-recipients": "456789ABCDEFFEED",
+    }
+
+
+def test_gpgme_should_only_be_given_descriptors_python_is_not_buffering(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b"x" * 100000)
+    with open(str(source), "rb") as f:
+        assert backup_cloud.base._gpgme_can_use_fd(f)
+        f.read(10)
+        # the rest of the file is now in Python's buffer, not at the descriptor
+        assert not backup_cloud.base._gpgme_can_use_fd(f)
+    r, w = os.pipe()
+    with os.fdopen(r, "rb") as r_file, os.fdopen(w, "wb") as w_file:
+        assert not backup_cloud.base._gpgme_can_use_fd(r_file)
+        w_file.write(b"buffered")
+        assert backup_cloud.base._gpgme_can_use_fd(w_file)
+        assert os.read(r, 100) == b"buffered"
+    assert not backup_cloud.base._gpgme_can_use_fd(io.BytesIO())
@@ -0,0 +1,60 @@
+from backup_cloud.base import BackupContext
+from backup_cloud.test_support import make_new_keypair
+from unittest.mock import patch
+import os
+import tracemalloc
+
+STREAM_SIZE = 64 * 1024 * 1024
+# python level allocations allowed while streaming; gpgme's own
+# buffers are fixed size and live outside the python heap.
+PEAK_LIMIT = 4 * 1024 * 1024
+
+
+class _GeneratedStream:
+    """readable stream producing size bytes without holding them"""
+
+    def __init__(self, size):
+        self.remaining = size
+        self.block = os.urandom(1024 * 1024)
+
+    def read(self, amount=-1):
+        if amount < 0:
+            raise AssertionError("streaming encryption tried to read everything")
+        amount = min(amount, self.remaining, len(self.block))
+        self.remaining -= amount
+        return self.block[:amount]
+
+
+class _CountingSink:
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
+
+def _context_with_key():
+    with patch("backup_cloud.base.boto3"):
+        with patch.object(BackupContext, "get_gpg_keys"):
+            c = BackupContext(ssm_path="/unit/test/fakessm")
+    userid, _public, _private = make_new_keypair(c.gpg_context)
+    c.recipients = [userid]
+    return c
+
+
+def test_encrypt_stream_should_use_bounded_memory():
+    c = _context_with_key()
+    source = _GeneratedStream(STREAM_SIZE)
+    sink = _CountingSink()
+
+    tracemalloc.start()
+    try:
+        c.encrypt_stream(source, sink)
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert source.remaining == 0
+    assert sink.written > STREAM_SIZE
+    assert peak < PEAK_LIMIT, "peak python memory " + str(peak) + " bytes"
@@ -0,0 +1,49 @@
+import backup_cloud.envelope as envelope
+import io
+import pytest
+
+pytest.importorskip("cryptography")
+
+
+def _encrypt(key, data, chunk_size=1000):
+    out = io.BytesIO()
+    envelope.envelope_encrypt_stream(key, io.BytesIO(data), out, chunk_size=chunk_size)
+    return out.getvalue()
+
+
+def _decrypt(key, ciphertext):
+    source = io.BytesIO(ciphertext)
+    assert source.read(len(envelope.ENVELOPE_MAGIC)) == envelope.ENVELOPE_MAGIC
+    out = io.BytesIO()
+    lookups = []
+
+    def data_key_for(key_id):
+        lookups.append(key_id)
+        return key.data_key
+
+    envelope.envelope_decrypt_stream(data_key_for, source, out)
+    assert lookups == [key.key_id]
+    return out.getvalue()
+
+
+def test_envelope_should_round_trip_with_fresh_salt_per_file():
+    key = envelope.EnvelopeKey.generate()
+    for data in [b"", b"x" * 1000, bytes(range(256)) * 37]:
+        first = _encrypt(key, data)
+        assert _encrypt(key, data) != first
+        assert _decrypt(key, first) == data
+
+
+def test_envelope_should_detect_truncation_and_tampering():
+    key = envelope.EnvelopeKey.generate()
+    ciphertext = _encrypt(key, b"y" * 5000)
+
+    # dropping the last frame leaves a valid earlier frame not marked final
+    last_frame = 4 + 5000 - 4000 + 16
+    with pytest.raises(Exception):
+        _decrypt(key, ciphertext[:-last_frame])
+
+    tampered = bytearray(ciphertext)
+    tampered[100] ^= 1
+    with pytest.raises(Exception):
+        _decrypt(key, bytes(tampered))
@@ -0,0 +1,39 @@
+from backup_cloud.base import BackupContext
+from unittest.mock import patch
+import os
+
+
+def _consume(stream, dest_bucket, dest_path, **kwargs):
+    stream.read()
+
+
+def _upload(c, src, index_path, force=False):
+    with patch.object(c, "backup_stream_to_s3", side_effect=_consume) as upload:
+        c.upload_path(str(src), "dumps", index_path=index_path, force=force)
+    return sorted(os.path.basename(x[1]["name"]) for x in upload.call_args_list)
+
+
+def test_incremental_upload_should_skip_unchanged_files(tmp_path):
+    src = tmp_path / "dumps"
+    src.mkdir()
+    for name in ["a", "b", "c"]:
+        (src / name).write_bytes(b"contents of " + name.encode())
+    index_path = str(tmp_path / "index.sqlite")
+
+    with patch("backup_cloud.base.boto3"):
+        with patch.object(BackupContext, "get_gpg_keys"):
+            c = BackupContext(ssm_path="/unit/test/fake")
+            with patch.object(c, "s3_path", return_value="unit/test/fake"):
+                with patch.object(c, "s3_bucket") as bucket:
+                    bucket().Object().e_tag = '"fake-etag"'
+                    assert _upload(c, src, index_path) == ["a", "b", "c"]
+                    assert _upload(c, src, index_path) == []
+
+                    # touched but unchanged content is not uploaded again
+                    st = os.stat(str(src / "a"))
+                    os.utime(str(src / "a"), ns=(st.st_atime_ns, st.st_mtime_ns + 10))
+                    (src / "b").write_bytes(b"new contents of b")
+                    assert _upload(c, src, index_path) == ["b"]
+                    assert _upload(c, src, index_path) == []
+
+                    assert _upload(c, src, index_path, force=True) == ["a", "b", "c"]
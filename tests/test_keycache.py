@@ -0,0 +1,85 @@
+from backup_cloud.base import BackupContext
+from backup_cloud.keycache import KeyCache
+from botocore.exceptions import ClientError
+from unittest.mock import patch, MagicMock
+import io
+import os
+
+KEY_DATA = b"-----BEGIN PGP PUBLIC KEY BLOCK-----" + b"x" * 100
+
+
+def _key_object(key, etag):
+    obj = MagicMock()
+    obj.key = key
+    obj.bucket_name = "fake-bucket"
+    obj.e_tag = etag
+    obj.last_modified = "2019-06-01 10:00:00+00:00"
+    return obj
+
+
+def _get_object(Bucket, Key, **kwargs):
+    return {
+        "Body": io.BytesIO(KEY_DATA + Key.encode()),
+        "ETag": '"etag-' + Key + '"',
+        "LastModified": "2019-06-01 10:00:00+00:00",
+    }
+
+
+def test_warm_start_should_not_download_unchanged_keys(tmp_path):
+    folder = "fake/path/config/public-keys/"
+    listing = [
+        _key_object(folder + "a.pub", '"etag-' + folder + 'a.pub"'),
+        _key_object(folder + "b.pub", '"etag-' + folder + 'b.pub"'),
+    ]
+    with patch("backup_cloud.base.boto3"):
+        with patch.object(BackupContext, "get_gpg_keys"):
+            c = BackupContext(ssm_path="/unit/test/fake", key_cache_dir=str(tmp_path))
+            c.s3.get_object.side_effect = _get_object
+            with patch.object(c, "s3_path", return_value="fake/path"):
+                with patch.object(c, "s3_bucket") as mockbucket:
+                    mockbucket().name = "fake-bucket"
+                    mockbucket().objects.filter.return_value = listing
+
+                    cold = list(c.download_gpg_keys())
+                    assert c.s3.get_object.call_count == 2
+
+                    warm = list(c.download_gpg_keys())
+                    assert c.s3.get_object.call_count == 2
+                    assert warm == cold
+
+                    listing[1].e_tag = '"changed"'
+                    list(c.download_gpg_keys())
+                    assert c.s3.get_object.call_count == 3
+                    c.s3.get_object.assert_called_with(
+                        Bucket="fake-bucket",
+                        Key=folder + "b.pub",
+                        IfNoneMatch='"etag-' + folder + 'b.pub"',
+                    )
+
+
+def test_missing_cached_key_file_should_be_fetched_again(tmp_path):
+    folder = "fake/path/config/public-keys/"
+    listing = [_key_object(folder + "a.pub", '"etag-' + folder + 'a.pub"')]
+
+    def get_object(Bucket, Key, **kwargs):
+        if "IfNoneMatch" in kwargs:
+            raise ClientError({"Error": {"Code": "304"}}, "GetObject")
+        return _get_object(Bucket, Key)
+
+    with patch("backup_cloud.base.boto3"):
+        with patch.object(BackupContext, "get_gpg_keys"):
+            c = BackupContext(ssm_path="/unit/test/fake", key_cache_dir=str(tmp_path))
+            c.s3.get_object.side_effect = get_object
+            with patch.object(c, "s3_path", return_value="fake/path"):
+                with patch.object(c, "s3_bucket") as mockbucket:
+                    mockbucket().name = "fake-bucket"
+                    mockbucket().objects.filter.return_value = listing
+
+                    cold = list(c.download_gpg_keys())
+                    directory = KeyCache(str(tmp_path), "fake-bucket", folder).directory
+                    for name in os.listdir(directory):
+                        if name.endswith(".key"):
+                            os.unlink(os.path.join(directory, name))
+
+                    assert list(c.download_gpg_keys()) == cold
+                    assert list(c.download_gpg_keys()) == cold
@@ -0,0 +1,76 @@
+import backup_cloud.s3
+import json
+from unittest.mock import Mock, patch
+
+
+def _source_client(objects, uploads):
+    """fake client listing objects (key -> etag) from one flat prefix
+
+    HeadObject on the manifest gives an ETag which changes each time it
+    is uploaded.
+    """
+
+    def paginate(Bucket, Prefix, Delimiter=None):
+        return [
+            {
+                "Contents": [
+                    {"Key": key, "ETag": etag, "Size": 10}
+                    for key, etag in sorted(objects.items())
+                ]
+            }
+        ]
+
+    def head_object(Bucket, Key):
+        assert Key == "base/backup/data.manifest.json.gpg"
+        if not uploads:
+            raise backup_cloud.s3.ClientError(
+                {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+            )
+        return {"ETag": '"manifest-' + str(len(uploads)) + '"'}
+
+    client = Mock()
+    client.get_paginator.return_value.paginate.side_effect = paginate
+    client.head_object.side_effect = head_object
+    return client
+
+
+def test_incremental_backup_should_only_copy_new_and_changed_objects(tmp_path):
+    objects = {"data/a.csv": '"1"', "data/b.csv": '"2"', "data/c.csv": '"3"'}
+    uploads = []
+    bc = Mock()
+    bc.s3 = _source_client(objects, uploads)
+
+    def backup(bc, src_bucket, src_path, dest_bucket, dest_path, **kwargs):
+        return dict(etag=objects[src_path], size=10, version_id="v-" + src_path)
+
+    def upload(bc, stream, dest_obj, metadata):
+        uploads.append(json.loads(stream.read().decode("utf-8")))
+
+    def run():
+        with patch("backup_cloud.s3.backup_s3_to_s3", side_effect=backup) as mock:
+            backup_cloud.s3.backup_s3_prefix_to_s3(
+                bc,
+                "src",
+                "data/",
+                "dest",
+                "base/backup/data",
+                incremental=True,
+                state_dir=str(tmp_path),
+            )
+        return sorted(x[0][2] for x in mock.call_args_list)
+
+    with patch("backup_cloud.manifest._upload_encrypted_stream", side_effect=upload):
+        assert run() == ["data/a.csv", "data/b.csv", "data/c.csv"]
+        assert run() == []
+
+        objects["data/b.csv"] = '"2a"'
+        objects["data/d.csv"] = '"4"'
+        del objects["data/c.csv"]
+        assert run() == ["data/b.csv", "data/d.csv"]
+
+    manifest = uploads[-1]
+    assert sorted(manifest["objects"]) == ["data/a.csv", "data/b.csv", "data/d.csv"]
+    assert manifest["objects"]["data/b.csv"]["etag"] == '"2a"'
+    assert manifest["objects"]["data/d.csv"]["version_id"] == "v-data/d.csv"
+    assert manifest["objects"]["data/d.csv"]["dest_key"] == "base/backup/data/d.csv"
+    assert list(manifest["deleted"]) == ["data/c.csv"]
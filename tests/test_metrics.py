@@ -0,0 +1,74 @@
+from backup_cloud.metrics import RunMetrics
+from botocore.stub import Stubber
+from unittest.mock import Mock
+import boto3
+import json
+import pytest
+
+
+def _s3_client():
+    return boto3.client(
+        "s3",
+        region_name="us-east-1",
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+    )
+
+
+def test_metrics_should_count_objects_and_aws_calls(tmp_path):
+    metrics = RunMetrics("backup-cloud-upload")
+    client = _s3_client()
+    metrics.watch_client(client)
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "put_object", {"ETag": '"abc"', "ResponseMetadata": {"RetryAttempts": 2}}
+        )
+        with metrics.backup_object(lambda: 30):
+            client.put_object(Bucket="b", Key="k", Body=b"x" * 10)
+    with pytest.raises(Exception):
+        with metrics.backup_object(lambda: 30):
+            raise Exception("upload failed")
+    metrics.finish(success=False)
+
+    summary = metrics.summary()
+    assert summary["bytes_in"] == 30
+    assert summary["bytes_out"] == 10
+    assert summary["compression_ratio"] == 3.0
+    assert summary["objects"] == {"backed_up": 1, "failed": 1}
+    assert summary["aws_calls"] == {"s3": {"PutObject": 1}}
+    assert summary["aws_retries"] == {"s3": 2}
+    assert summary["object_seconds"]["count"] == 2
+
+    text = metrics.textfile()
+    assert "# TYPE backup_cloud_object_seconds histogram" in text
+    assert (
+        'backup_cloud_object_seconds_bucket{command="backup-cloud-upload",le="+Inf"} 2'
+        in text
+    )
+    assert (
+        'backup_cloud_aws_calls_total{command="backup-cloud-upload",'
+        'operation="PutObject",service="s3"} 1'
+    ) in text
+    assert 'backup_cloud_last_run_success{command="backup-cloud-upload"} 0' in text
+
+    metrics.write_json(str(tmp_path / "run.json"))
+    metrics.write_textfile(str(tmp_path / "run.prom"))
+    assert json.loads((tmp_path / "run.json").read_text())["success"] is False
+    assert [p.name for p in tmp_path.iterdir()] in (
+        ["run.json", "run.prom"],
+        ["run.prom", "run.json"],
+    )
+
+
+def test_metrics_should_count_throttling_responses():
+    metrics = RunMetrics()
+    operation = Mock()
+    operation.service_model.service_name = "s3"
+    slow_down = (Mock(status_code=503), {"Error": {"Code": "SlowDown"}})
+
+    metrics._needs_retry(response=slow_down, operation=operation)
+    metrics._needs_retry(response=(Mock(status_code=200), {}), operation=operation)
+    metrics._needs_retry(response=None, operation=operation)
+
+    assert metrics.summary()["aws_throttles"] == {"s3": 1}
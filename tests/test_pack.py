@@ -0,0 +1,185 @@
+import backup_cloud.pack
+import io
+import os
+import pytest
+from unittest.mock import Mock
+
+
+class _FakeObject:
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+
+    def upload_fileobj(self, stream, Config=None, ExtraArgs=None):
+        self.store[self.key] = stream.read()
+
+    def put(self, Body, ContentLength, Metadata=None):
+        assert len(Body) == ContentLength
+        self.store[self.key] = Body
+        return {"ETag": '"fake"'}
+
+    def delete(self):
+        del self.store[self.key]
+
+
+def _fake_backup_context(store):
+    """a context with an in memory bucket where "encryption" reverses data"""
+
+    def encrypt_stream(source, sink):
+        sink.write(b"ENC" + source.read()[::-1])
+
+    def decrypt_stream(source, sink):
+        data = source.read()
+        assert data.startswith(b"ENC")
+        sink.write(data[3:][::-1])
+
+    def head_object(Bucket, Key):
+        return {"ContentLength": len(store[Key]), "ETag": '"fake"'}
+
+    def get_object(Bucket, Key, Range=None, IfMatch=None):
+        data = store[Key]
+        if Range is not None:
+            start, end = [int(x) for x in Range.split("=")[1].split("-")]
+            data = data[start : end + 1]  # noqa: E203
+        return {"Body": io.BytesIO(data)}
+
+    def backup_file_to_s3(src_file, bucket, dest_path, **kwargs):
+        with open(src_file, "rb") as f:
+            _FakeObject(store, dest_path).put(
+                Body=b"ENC" + f.read()[::-1],
+                ContentLength=os.path.getsize(src_file) + 3,
+            )
+
+    bc = Mock()
+    bc.pipeline_stats = None
+    bc.s3_bucket().Object.side_effect = lambda key: _FakeObject(store, key)
+    bc.s3.head_object.side_effect = head_object
+    bc.s3.get_object.side_effect = get_object
+    bc.encrypt_stream.side_effect = encrypt_stream
+    bc.decrypt_stream.side_effect = decrypt_stream
+    bc.backup_file_to_s3.side_effect = backup_file_to_s3
+    return bc
+
+
+def _make_tree(tmp_path):
+    src = tmp_path / "configs"
+    (src / "etc").mkdir(parents=True)
+    files = {}
+    for i in range(30):
+        files["configs/etc/file" + str(i)] = ("contents of " + str(i)).encode() * 10
+    files["configs/big.img"] = b"B" * 5000
+    for name, data in files.items():
+        (tmp_path / name).write_bytes(data)
+    return src, files
+
+
+def test_pack_should_hide_names_and_restore_single_files(tmp_path):
+    src, files = _make_tree(tmp_path)
+    store = {}
+    bc = _fake_backup_context(store)
+
+    index = backup_cloud.pack.pack_path(
+        bc, str(src), "base/backup/cfg", volume_size=1000, chunk_size=400
+    )
+
+    assert sorted(index["files"]) == sorted(files)
+    assert len(index["volumes"]) > 1
+    assert index["files"]["configs/big.img"] == {"object": "file-000000.gpg"}
+    assert not any(b"file1" in data or b"configs" in data for data in store.values())
+
+    bc.s3.get_object.reset_mock()
+    dest = str(tmp_path / "restored-file")
+    backup_cloud.pack.restore_packed_file(
+        bc, "bucket", "base/backup/cfg", "configs/etc/file17", dest, index=index
+    )
+    with open(dest, "rb") as f:
+        assert f.read() == files["configs/etc/file17"]
+    assert "Range" in bc.s3.get_object.call_args[1]
+
+
+def test_packed_tree_should_restore_every_file(tmp_path):
+    src, files = _make_tree(tmp_path)
+    store = {}
+    bc = _fake_backup_context(store)
+    backup_cloud.pack.pack_path(
+        bc, str(src), "base/backup/cfg", volume_size=1000, chunk_size=400
+    )
+
+    restore_dir = tmp_path / "restore"
+    backup_cloud.pack.restore_packed_tree(
+        bc, "bucket", "base/backup/cfg", str(restore_dir), workers=3
+    )
+
+    for name, data in files.items():
+        assert (restore_dir / name).read_bytes() == data
+
+
+def test_failed_pack_should_remove_what_it_uploaded(tmp_path):
+    src, files = _make_tree(tmp_path)
+    store = {}
+    bc = _fake_backup_context(store)
+    encrypt_stream = bc.encrypt_stream.side_effect
+    calls = []
+
+    def failing_encrypt_stream(source, sink):
+        calls.append(source)
+        if len(calls) == 5:
+            raise Exception("encryption failed")
+        encrypt_stream(source, sink)
+
+    bc.encrypt_stream.side_effect = failing_encrypt_stream
+
+    with pytest.raises(Exception, match="encryption failed"):
+        backup_cloud.pack.pack_path(
+            bc, str(src), "base/backup/cfg", volume_size=1000, chunk_size=400
+        )
+    assert len(calls) == 5
+    assert store == {}
+
+
+def test_skip_should_read_gaps_in_bounded_pieces(monkeypatch):
+    monkeypatch.setattr(backup_cloud.pack, "SKIP_READ_SIZE", 10)
+    stream = Mock(wraps=io.BytesIO(bytes(range(50))))
+
+    backup_cloud.pack._skip(stream, 35)
+
+    assert max(call[0][0] for call in stream.read.call_args_list) <= 10
+    assert stream.read(1) == bytes([35])
+    with pytest.raises(Exception, match="ended after 4 of 5 bytes"):
+        backup_cloud.pack._skip(stream, 15)
+
+
+def test_interrupted_packed_restore_should_resume(tmp_path):
+    src, files = _make_tree(tmp_path)
+    store = {}
+    bc = _fake_backup_context(store)
+    index = backup_cloud.pack.pack_path(
+        bc, str(src), "base/backup/cfg", volume_size=1000, chunk_size=400
+    )
+    get_object = bc.s3.get_object.side_effect
+    broken = "base/backup/cfg/" + index["volumes"][1]
+    fetched = []
+    failures = [Exception("connection reset")]
+
+    def failing_get_object(Bucket, Key, **kwargs):
+        fetched.append(Key)
+        if Key == broken and failures:
+            raise failures.pop()
+        return get_object(Bucket, Key, **kwargs)
+
+    bc.s3.get_object.side_effect = failing_get_object
+    restore_dir = tmp_path / "restore"
+    with pytest.raises(backup_cloud.pack.RestoreError):
+        backup_cloud.pack.restore_packed_tree(
+            bc, "bucket", "base/backup/cfg", str(restore_dir), workers=2
+        )
+    assert (restore_dir / backup_cloud.pack.RESTORE_JOURNAL).exists()
+
+    del fetched[:]
+    backup_cloud.pack.restore_packed_tree(
+        bc, "bucket", "base/backup/cfg", str(restore_dir), workers=2
+    )
+    assert sorted(fetched) == sorted(["base/backup/cfg/index.json.gpg", broken])
+    for name, data in files.items():
+        assert (restore_dir / name).read_bytes() == data
+    assert not (restore_dir / backup_cloud.pack.RESTORE_JOURNAL).exists()
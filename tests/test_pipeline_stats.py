@@ -0,0 +1,41 @@
+from backup_cloud.pipeline_stats import PipelineStats
+import io
+import time
+
+
+class _SlowStream(io.BytesIO):
+    def write(self, data):
+        time.sleep(0.05)
+        return super().write(data)
+
+
+def test_work_should_leave_out_time_blocked_on_pipes():
+    stats = PipelineStats()
+    source = stats.reader(io.BytesIO(b"x" * 100), "source_read")
+    sink = stats.writer(_SlowStream(), "encrypt_pipe_write")
+
+    with stats.work("encrypt") as work:
+        sink.write(source.read(50))
+        sink.write(source.read())
+        work.amount = sink.count
+
+    report = stats.report()
+    assert report["stages"]["source_read"]["bytes"] == 100
+    assert report["stages"]["encrypt"]["bytes"] == 100
+    assert report["stages"]["encrypt_pipe_write"]["calls"] == 2
+    assert report["stages"]["encrypt_pipe_write"]["seconds"] >= 0.1
+    assert report["stages"]["encrypt"]["seconds"] < 0.05
+    assert report["pipes"]["encrypt_pipe"]["limited_by"] == "part_upload"
+
+
+def test_report_should_name_the_busiest_stage_as_bottleneck():
+    stats = PipelineStats()
+    stats.add("download", 3.0, 3000)
+    stats.add("encrypt", 1.0, 3000)
+    stats.add("download_pipe_read", 2.0, 3000)
+    stats.add("download_pipe_write", 0.1, 3000)
+
+    report = stats.report()
+    assert report["bottleneck"] == "download"
+    assert report["pipes"]["download_pipe"]["limited_by"] == "download"
+    assert "encrypt_pipe" not in report["pipes"]
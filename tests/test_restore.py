@@ -0,0 +1,184 @@
+import backup_cloud.compress as compress
+from backup_cloud.base import CODEC_METADATA
+import backup_cloud.restore
+import io
+import os
+import pytest
+from unittest.mock import Mock
+
+
+def _fake_backup_context(objects):
+    """a context whose bucket holds objects and whose "decryption" upcases"""
+
+    def head_object(Bucket, Key):
+        return {"ContentLength": len(objects[Key]), "ETag": '"e"'}
+
+    def get_object(Bucket, Key, Range, IfMatch):
+        start, end = [int(x) for x in Range.split("=")[1].split("-")]
+        return {"Body": io.BytesIO(objects[Key][start : end + 1])}  # noqa: E203
+
+    def paginate(Bucket, Prefix, Delimiter=None):
+        keys = [key for key in sorted(objects) if key.startswith(Prefix)]
+        return [{"Contents": [{"Key": k, "Size": len(objects[k])} for k in keys]}]
+
+    def decrypt_stream(source, sink):
+        for chunk in iter(lambda: source.read(100), b""):
+            sink.write(chunk.upper())
+
+    bc = Mock()
+    bc.s3.head_object.side_effect = head_object
+    bc.s3.get_object.side_effect = get_object
+    bc.s3.get_paginator.return_value.paginate.side_effect = paginate
+    bc.decrypt_stream.side_effect = decrypt_stream
+    return bc
+
+
+def test_restore_object_should_stream_through_decryption():
+    data = b"abcdefghij" * 1000
+    bc = _fake_backup_context({"base/backup/dump.sql": data})
+    out = io.BytesIO()
+
+    backup_cloud.restore.restore_object_to_stream(
+        bc, "bucket", "base/backup/dump.sql", out, part_size=999, download_workers=3
+    )
+
+    assert out.getvalue() == data.upper()
+
+
+def test_failed_restore_should_not_leave_a_file(tmp_path):
+    bc = _fake_backup_context({"base/backup/dump.sql": b"secret"})
+    bc.decrypt_stream.side_effect = Exception("no secret key")
+    dest = str(tmp_path / "dump.sql")
+
+    with pytest.raises(Exception, match="no secret key"):
+        backup_cloud.restore.restore_object_to_file(
+            bc, "bucket", "base/backup/dump.sql", dest
+        )
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_restore_tree_should_rebuild_upload_path_layout(tmp_path):
+    bc = _fake_backup_context(
+        {
+            "base/backup/git/repos/a.git": b"aaa",
+            "base/backup/git/repos/sub/b.git": b"bbb",
+            "base/backup/gitlab/other": b"not ours",
+        }
+    )
+
+    backup_cloud.restore.restore_tree(
+        bc, "bucket", "base/backup/git", str(tmp_path), workers=2
+    )
+
+    assert (tmp_path / "repos" / "a.git").read_bytes() == b"AAA"
+    assert (tmp_path / "repos" / "sub" / "b.git").read_bytes() == b"BBB"
+    assert sorted(os.listdir(str(tmp_path))) == ["repos"]
+
+
+def test_restore_tree_should_follow_sharded_layout(tmp_path):
+    bc = _fake_backup_context(
+        {
+            "base/backup/git/3f/git/repos/a.git": b"aaa",
+            "base/backup/git/a0/git/repos/sub/b.git": b"bbb",
+            "base/backup/git/shards.json": b"{}",
+        }
+    )
+    layout = {
+        "base/backup/git/3f/git/repos/a.git": "git/repos/a.git",
+        "base/backup/git/a0/git/repos/sub/b.git": "git/repos/sub/b.git",
+    }
+
+    backup_cloud.restore.restore_tree(
+        bc, "bucket", "base/backup/git", str(tmp_path), layout=layout
+    )
+
+    assert (tmp_path / "git" / "repos" / "a.git").read_bytes() == b"AAA"
+    assert (tmp_path / "git" / "repos" / "sub" / "b.git").read_bytes() == b"BBB"
+    assert sorted(os.listdir(str(tmp_path))) == ["git"]
+
+
+def test_restore_tree_should_refuse_to_leave_destination(tmp_path):
+    bc = _fake_backup_context({"base/backup/git/../../escape": b"x"})
+
+    with pytest.raises(backup_cloud.restore.RestoreError):
+        backup_cloud.restore.restore_tree(
+            bc, "bucket", "base/backup/git", str(tmp_path / "restore")
+        )
+
+    assert not os.path.exists(str(tmp_path / "escape"))
+
+
+def test_restore_tree_should_start_largest_first_and_resume(tmp_path):
+    bc = _fake_backup_context(
+        {
+            "base/backup/git/small": b"s",
+            "base/backup/git/large": b"l" * 300,
+            "base/backup/git/medium": b"m" * 20,
+        }
+    )
+    decrypt = bc.decrypt_stream.side_effect
+    restored = []
+
+    def failing_decrypt(source, sink):
+        data = source.read()
+        restored.append(data[:1])
+        if data == b"s":
+            raise Exception("interrupted")
+        decrypt(io.BytesIO(data), sink)
+
+    bc.decrypt_stream.side_effect = failing_decrypt
+    with pytest.raises(backup_cloud.restore.RestoreError):
+        backup_cloud.restore.restore_tree(
+            bc, "bucket", "base/backup/git", str(tmp_path)
+        )
+    assert restored == [b"l", b"m", b"s"]
+    assert os.path.exists(str(tmp_path / backup_cloud.restore.RESTORE_JOURNAL))
+
+    bc.decrypt_stream.side_effect = decrypt
+    bc.s3.get_object.reset_mock()
+    backup_cloud.restore.restore_tree(bc, "bucket", "base/backup/git", str(tmp_path))
+
+    assert [x[1]["Key"] for x in bc.s3.get_object.call_args_list] == [
+        "base/backup/git/small"
+    ]
+    assert sorted(os.listdir(str(tmp_path))) == ["large", "medium", "small"]
+
+
+def test_restore_should_decompress_with_the_codec_in_the_metadata():
+    data = b"row\n" * 50000
+    stream, codec = compress.compression_stage(io.BytesIO(data), "gzip")
+    compressed = stream.read(-1)
+    bc = _fake_backup_context({"base/backup/dump.sql": compressed})
+    bc.s3.head_object.side_effect = lambda Bucket, Key: {
+        "ContentLength": len(compressed),
+        "ETag": '"e"',
+        "Metadata": {CODEC_METADATA: codec},
+    }
+    bc.decrypt_stream.side_effect = lambda source, sink: sink.write(source.read())
+    out = io.BytesIO()
+
+    backup_cloud.restore.restore_object_to_stream(
+        bc, "bucket", "base/backup/dump.sql", out, part_size=1000
+    )
+
+    assert out.getvalue() == data
+
+
+def test_segmented_backups_should_be_listed_as_one_object():
+    listing = [
+        {"Key": "p/plain", "Size": 5, "ETag": '"a"'},
+        {"Key": "p/split.sql.segments.json", "Size": 9, "ETag": '"m1"'},
+        {"Key": "p/split.sql.segments/000000.gpg", "Size": 10},
+        {"Key": "p/split.sql.segments/000001.gpg", "Size": 20},
+        {"Key": "p/resumed.sql", "Size": 40, "ETag": '"o"'},
+        {"Key": "p/resumed.sql.segments.json", "Size": 9, "ETag": '"m2"'},
+    ]
+
+    objects = backup_cloud.restore._logical_objects(listing)
+
+    assert sorted(objects, key=lambda obj: obj["Key"]) == [
+        {"Key": "p/plain", "Size": 5, "ETag": '"a"'},
+        {"Key": "p/resumed.sql", "Size": 40, "ETag": '"m2"', "segmented": True},
+        {"Key": "p/split.sql", "Size": 30, "ETag": '"m1"', "segmented": True},
+    ]
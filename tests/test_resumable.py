@@ -0,0 +1,131 @@
+import backup_cloud.resumable as resumable
+import backup_cloud.segment
+import datetime
+import io
+import os
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+
+def _thread_pool(processes, initializer, initargs):
+    return ThreadPoolExecutor(max_workers=processes)
+
+
+class _FakeMultipartS3:
+    """just enough of the S3 client for one multipart upload"""
+
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.parts = {}
+        self.objects = {}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata):
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentLength):
+        if PartNumber == self.fail_part:
+            raise Exception("connection lost")
+        self.parts[PartNumber] = Body
+        return {"ETag": '"part-{}"'.format(PartNumber)}
+
+    def get_paginator(self, name):
+        paginator = Mock()
+        parts = [
+            {"PartNumber": n, "ETag": '"part-{}"'.format(n)} for n in sorted(self.parts)
+        ]
+        paginator.paginate.return_value = [{"Parts": parts}]
+        return paginator
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        self.objects[Key] = b"".join(self.parts[n] for n in numbers)
+
+    def put_object(self, Bucket, Key, Body, ContentLength):
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self.objects[Key]
+        if Range is not None:
+            start, end = [int(x) for x in Range.split("=")[1].split("-")]
+            data = data[start : end + 1]  # noqa: E203
+        return {"Body": io.BytesIO(data)}
+
+
+def _fake_context(client):
+    def encrypt_segments(source, segment_size, processes):
+        for segment in iter(lambda: source.read(segment_size), b""):
+            yield b"<" + segment[::-1] + b">"
+
+    bc = Mock(envelope=False, armor=False)
+    bc.s3 = client
+    bc.format_metadata.return_value = {}
+    bc.encrypt_segments.side_effect = encrypt_segments
+    return bc
+
+
+@patch("backup_cloud.resumable.MIN_PART_SIZE", 1)
+@patch("backup_cloud.segment._segment_pool", _thread_pool)
+@patch("backup_cloud.segment._decrypt_segment", lambda data: data[1:-1][::-1])
+def test_interrupted_upload_should_resume_from_last_finished_part(tmp_path):
+    data = bytes(range(256)) * 40 + b"tail"
+    state_dir = str(tmp_path)
+    client = _FakeMultipartS3(fail_part=3)
+    bc = _fake_context(client)
+    offsets = []
+
+    def open_source(offset):
+        offsets.append(offset)
+        return io.BytesIO(data[offset:])
+
+    def backup():
+        return resumable.backup_stream_resumable(
+            bc,
+            open_source,
+            "source-v1",
+            "bucket",
+            "/base/huge.sql",
+            state_dir=state_dir,
+            segment_size=1000,
+            part_size=2000,
+        )
+
+    with pytest.raises(Exception, match="connection lost"):
+        backup()
+    client.fail_part = None
+    manifest = backup()
+
+    # two parts of two segments were kept; only the rest was read again
+    assert offsets == [0, 4000]
+    assert sorted(client.parts) == [1, 2, 3, 4, 5, 6]
+    assert len(manifest["segments"]) == 11
+    assert os.listdir(state_dir) == []
+    out = io.BytesIO()
+    backup_cloud.segment.restore_segmented_to_stream(
+        bc, "bucket", "base/huge.sql", out, transfer_workers=2
+    )
+    assert out.getvalue() == data
+
+
+def test_abandoned_uploads_should_be_aborted_unless_resumable_here(tmp_path):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    old = now - datetime.timedelta(days=30)
+    uploads = [
+        {"Key": "base/a", "UploadId": "old", "Initiated": old},
+        {"Key": "base/b", "UploadId": "recent", "Initiated": now},
+        {"Key": "base/c", "UploadId": "ours", "Initiated": old},
+    ]
+    resumable.UploadCheckpoint(str(tmp_path), "bucket", "base/c").save(
+        dict(upload_id="ours")
+    )
+    bc = Mock()
+    bc.s3.get_paginator.return_value.paginate.return_value = [{"Uploads": uploads}]
+
+    aborted = resumable.abort_abandoned_uploads(
+        bc, "bucket", "/base", state_dir=str(tmp_path)
+    )
+
+    assert aborted == 1
+    bc.s3.abort_multipart_upload.assert_called_once_with(
+        Bucket="bucket", Key="base/a", UploadId="old"
+    )
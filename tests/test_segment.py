@@ -0,0 +1,102 @@
+import backup_cloud.segment
+import io
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+
+def _thread_pool(processes, initializer, initargs):
+    return ThreadPoolExecutor(max_workers=processes)
+
+
+def _fake_store_bucket(store, fail_key=None):
+    def make_object(key):
+        obj = Mock()
+
+        def put(Body, ContentLength, Metadata=None):
+            if key == fail_key:
+                raise Exception("upload refused")
+            store[key] = Body
+
+        obj.put.side_effect = put
+        obj.delete.side_effect = lambda: store.pop(key, None)
+        return obj
+
+    bucket = Mock()
+    bucket.Object.side_effect = make_object
+    return bucket
+
+
+def _client(store):
+    client = Mock()
+    client.get_object.side_effect = lambda Bucket, Key: {"Body": io.BytesIO(store[Key])}
+    return client
+
+
+@patch("backup_cloud.segment._segment_pool", _thread_pool)
+@patch("backup_cloud.segment._encrypt_segment", lambda data: b"E" + data[::-1])
+@patch("backup_cloud.segment._decrypt_segment", lambda data: data[1:][::-1])
+def test_segmented_backup_should_restore_in_order():
+    data = bytes(range(256)) * 100
+    store = {}
+    bc = Mock(envelope=False, armor=False)
+    bc.s3 = _client(store)
+
+    manifest = backup_cloud.segment.backup_stream_segmented(
+        bc,
+        io.BytesIO(data),
+        _fake_store_bucket(store),
+        "/base//backup/huge.sql",
+        segment_size=1000,
+        processes=3,
+        transfer_workers=2,
+    )
+
+    assert len(manifest["segments"]) == 26
+    assert manifest["segments"][0]["key"] == "base/backup/huge.sql.segments/000000.gpg"
+    out = io.BytesIO()
+    backup_cloud.segment.restore_segmented_to_stream(
+        bc, "bucket", "base/backup/huge.sql", out, processes=3, transfer_workers=4
+    )
+    assert out.getvalue() == data
+
+
+@patch("backup_cloud.segment._segment_pool", _thread_pool)
+@patch("backup_cloud.segment._encrypt_segment", lambda data: data)
+def test_failed_segmented_backup_should_remove_segments():
+    store = {}
+    bucket = _fake_store_bucket(store, fail_key="huge.sql.segments/000003.gpg")
+
+    with pytest.raises(Exception, match="upload refused"):
+        backup_cloud.segment.backup_stream_segmented(
+            Mock(envelope=False, armor=False),
+            io.BytesIO(b"x" * 10000),
+            bucket,
+            "huge.sql",
+            segment_size=1000,
+            processes=2,
+        )
+
+    assert store == {}
+
+
+def test_segmented_metadata_should_give_the_real_encoding():
+    bc = Mock(envelope=False, armor=True)
+
+    backup_cloud.segment.segment_metadata(bc)
+
+    bc.format_metadata.assert_called_once_with(encoding="openpgp-armor")
+
+
+def test_segmented_backup_should_refuse_envelope_encryption():
+    store = {}
+
+    with pytest.raises(Exception, match="cannot use envelope encryption"):
+        backup_cloud.segment.backup_stream_segmented(
+            Mock(envelope=True, armor=False),
+            io.BytesIO(b"x" * 10000),
+            _fake_store_bucket(store),
+            "huge.sql",
+        )
+
+    assert store == {}
@@ -0,0 +1,107 @@
+from backup_cloud.base import BackupContext
+from backup_cloud.shard import (
+    ShardManifest,
+    open_shard_manifest,
+    shard_jobs,
+    shard_key,
+)
+from unittest.mock import patch
+import pytest
+
+
+def test_shard_keys_should_spread_names_over_prefixes():
+    names = ["dir/file%04d" % i for i in range(4096)]
+    shards = {shard_key(name).split("/")[0] for name in names}
+
+    assert shard_key("dir/a") == shard_key("dir/a")
+    assert shard_key("dir/a").endswith("/dir/a")
+    assert len(shards) == 256
+    assert all(len(shard) == 2 for shard in shards)
+
+
+def test_shard_jobs_should_rewrite_keys_and_record_names(tmp_path):
+    src = tmp_path / "f"
+    src.write_bytes(b"12345")
+    manifest = ShardManifest(3)
+    jobs = [(str(src), "/base/backup/dest//mydir/sub/f")]
+
+    [(src_name, dest_key)] = shard_jobs(jobs, "base/backup/dest", manifest)
+
+    key = shard_key("mydir/sub/f", 3)
+    assert dest_key == "base/backup/dest/" + key
+    assert manifest.files == {}
+    manifest.finished(dest_key)
+    assert manifest.files == {"mydir/sub/f": {"key": key, "size": 5}}
+    assert manifest.layout("base/backup/dest/") == {dest_key: "mydir/sub/f"}
+
+
+def test_manifest_should_list_by_directory_and_round_trip():
+    manifest = ShardManifest(2)
+    for name in ["mydir/a", "mydir/sub/b", "mydir/subway", "other/c"]:
+        manifest.finished(manifest.expect("prefix", name, 1))
+
+    assert manifest.names("mydir/sub") == ["mydir/sub/b"]
+    assert manifest.names() == ["mydir/a", "mydir/sub/b", "mydir/subway", "other/c"]
+    loaded = ShardManifest.from_json(manifest.to_json())
+    assert loaded.digits == 2
+    assert loaded.files == manifest.files
+
+
+def test_manifest_should_reject_bad_digits():
+    with pytest.raises(Exception, match="shard digits"):
+        ShardManifest(0)
+
+
+def test_later_uploads_should_keep_the_digits_of_the_first():
+    earlier = ShardManifest(3)
+    earlier.finished(earlier.expect("prefix", "dumps/old", 7))
+
+    with patch("backup_cloud.shard.read_shard_manifest", return_value=earlier):
+        assert open_shard_manifest(None, "bucket", "prefix", None).digits == 3
+        assert open_shard_manifest(None, "bucket", "prefix", 3).digits == 3
+        with pytest.raises(Exception, match="sharded with 3 digits, not 2"):
+            open_shard_manifest(None, "bucket", "prefix", 2)
+    with patch("backup_cloud.shard.read_shard_manifest", return_value=None):
+        assert open_shard_manifest(None, "bucket", "prefix", None).digits == 2
+        assert open_shard_manifest(None, "bucket", "prefix", 4).digits == 4
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_failed_sharded_upload_should_still_record_what_was_uploaded(tmp_path, workers):
+    src = tmp_path / "dumps"
+    src.mkdir()
+    for name in ["a", "b", "c"]:
+        (src / name).write_bytes(b"data")
+    earlier = ShardManifest(2)
+    earlier.finished(earlier.expect("base/backup/dest", "dumps/old", 7))
+    written = []
+    uploaded = []
+
+    def fake_backup(src_file, dest_bucket, dest_path, **kwargs):
+        if src_file.endswith("/b"):
+            raise Exception("upload refused")
+        uploaded.append("dumps/" + src_file[-1])
+
+    with patch("backup_cloud.base.boto3"):
+        with patch.object(BackupContext, "get_gpg_keys"):
+            c = BackupContext(ssm_path="/unit/test/fake")
+            with patch.object(c, "s3_path", return_value="base"), patch.object(
+                c, "ssm_parameter", return_value="bucket"
+            ), patch.object(c, "s3_bucket"), patch.object(
+                c, "backup_file_to_s3", side_effect=fake_backup
+            ), patch(
+                "backup_cloud.shard.read_shard_manifest", return_value=earlier
+            ), patch(
+                "backup_cloud.shard.write_shard_manifest",
+                side_effect=lambda bc, bucket, prefix, manifest: written.append(
+                    (prefix, manifest)
+                ),
+            ):
+                with pytest.raises(Exception):
+                    c.upload_path(str(src), "dest", workers=workers, sharded=True)
+
+    [(prefix, manifest)] = written
+    assert prefix == "base/backup/dest"
+    assert manifest.names() == sorted(uploaded + ["dumps/old"])
+    assert "dumps/b" not in manifest.files
+    assert manifest.files["dumps/old"] == earlier.files["dumps/old"]